@@ -4,7 +4,7 @@ Application entry-point for "pmcyg" tool
 
 import argparse, sys
 from . import apptools, core, gui, version
-from .core import PMbuilder
+from .core import PMbuilder, PackageSet
 from .version import PMCYG_VERSION
 
 
@@ -25,6 +25,18 @@ def TemplateMain(builder: PMbuilder, outfile: str,
     builder.TemplateFromLists(outfile, pkgfiles, cygwinReplica)
 
 
+def SizeReportMain(builder: PMbuilder, pkgfiles: list) -> None:
+    """Subsidiary program entry-point for reporting download sizes"""
+
+    builder.SizeReport(PackageSet(pkgfiles), sys.stdout)
+
+
+def ExplainMain(builder: PMbuilder, packages: list, pkgfiles: list) -> None:
+    """Subsidiary program entry-point for explaining package inclusion"""
+
+    builder.ExplainPackages(PackageSet(pkgfiles), packages, sys.stdout)
+
+
 def GUImain(builder: PMbuilder, pkgfiles: list) -> None:
     """Subsidiary program entry-point if used as GUI application"""
 
@@ -64,6 +76,14 @@ def main() -> None:
     bscopts.add_argument('-R', '--generate-replica', type=str,
             dest='cyg_list', default=None,
             help='Generate copy of existing Cygwin installation')
+    reportopts = bscopts.add_mutually_exclusive_group()
+    reportopts.add_argument('--size-report', action='store_true',
+            help='Report the download size attributable to each'
+                ' selected package, without downloading')
+    reportopts.add_argument('--why', type=str, action='append',
+            dest='why', default=[], metavar='PKG',
+            help='Explain why a package would be included in the mirror,'
+                ' without downloading (may be repeated)')
     bscopts.add_argument('package_files', nargs='*',
             help='Files containins list of Cygwin packages')
 
@@ -96,6 +116,51 @@ def main() -> None:
     advopts.add_argument('-I', '--iso-filename', type=str, default=None,
             help='Filename for generating ISO image for burning to CD/DVD'
                 ' (default=%(default)s)')
+    advopts.add_argument('-j', '--jobs', type=int,
+            default=builder.GetOption('DownloadWorkers'),
+            help='Number of packages to download concurrently'
+                ' (default=%(default)s)')
+    advopts.add_argument('--engine', type=str,
+            choices=('threads', 'asyncio'),
+            default=builder.GetOption('Engine'),
+            help='Mechanism for concurrent downloading'
+                ' (default=%(default)s)')
+    advopts.add_argument('--stripes', type=int,
+            default=builder.GetOption('MirrorStripes'),
+            help='Number of mirror sites to download from simultaneously'
+                ' (default=%(default)s)')
+    advopts.add_argument('--stripe-mirror', type=str, action='append',
+            dest='extra_mirrors', default=[],
+            help='Additional mirror site across which to spread downloads'
+                ' (may be repeated)')
+    advopts.add_argument('--auto-mirror', action='store_true',
+            default=builder.GetOption('AutoMirror'),
+            help='Probe all mirror sites and download from the fastest'
+                ' (default=%(default)s)')
+    advopts.add_argument('--failover', type=int,
+            default=builder.GetOption('MirrorFailover'),
+            help='Number of failures of a package on one mirror before'
+                ' trying another (0 to disable; default=%(default)s)')
+    advopts.add_argument('--mirror-error-rate', type=float,
+            default=builder.GetOption('MirrorErrorThreshold'),
+            help='Fraction of recent downloads failing which will suspend'
+                ' use of a mirror (default=%(default)s)')
+    advopts.add_argument('--lazy-index', action='store_true',
+            default=builder.GetOption('LazyIndex'),
+            help='Only parse package descriptions from setup.ini'
+                ' when they are needed (default=%(default)s)')
+    advopts.add_argument('--parse-jobs', type=int,
+            default=builder.GetOption('ParseWorkers'),
+            help='Number of processes amongst which to share'
+                ' parsing of setup.ini (default=%(default)s)')
+    advopts.add_argument('--retries', type=int,
+            default=builder.GetOption('MaxRetries'),
+            help='Number of times to retry each failed download'
+                ' (default=%(default)s)')
+    advopts.add_argument('--retry-delay', type=float,
+            default=builder.GetOption('RetryDelay'),
+            help='Initial delay in seconds before retrying a download,'
+                ' doubling on each subsequent failure (default=%(default)s)')
 
     args = parser.parse_args()
 
@@ -112,6 +177,17 @@ def main() -> None:
     builder.SetOption('IncludeSources', args.with_sources)
     builder.SetOption('RemoveOutdated', args.remove_outdated)
     builder.SetOption('ISOfilename', args.iso_filename)
+    builder.SetOption('DownloadWorkers', args.jobs)
+    builder.SetOption('Engine', args.engine)
+    builder.SetOption('MirrorStripes', args.stripes)
+    builder.SetOption('ExtraMirrors', args.extra_mirrors)
+    builder.SetOption('AutoMirror', args.auto_mirror)
+    builder.SetOption('MirrorFailover', args.failover)
+    builder.SetOption('MirrorErrorThreshold', args.mirror_error_rate)
+    builder.SetOption('LazyIndex', args.lazy_index)
+    builder.SetOption('ParseWorkers', args.parse_jobs)
+    builder.SetOption('MaxRetries', args.retries)
+    builder.SetOption('RetryDelay', args.retry_delay)
 
     if args.pkg_file:
         TemplateMain(builder, args.pkg_file, args.package_files)
@@ -120,6 +196,10 @@ def main() -> None:
             print('WARNING: pmcyg attempting to create replica of non-Cygwin host', file=sys.stderr)
         TemplateMain(builder, args.cyg_list,
                      args.package_files, cygwinReplica=True)
+    elif args.why:
+        ExplainMain(builder, args.why, args.package_files)
+    elif args.size_report:
+        SizeReportMain(builder, args.package_files)
     elif gui.HASGUI and not args.nogui:
         GUImain(builder, args.package_files)
     else:
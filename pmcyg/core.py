@@ -18,8 +18,10 @@ Core downloading and package-list management tools for pmcyg
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import  bz2, codecs, hashlib, io, lzma, os, os.path, re, \
-        string, subprocess, sys, threading, time, \
+import  array, asyncio, bisect, bz2, codecs, collections, concurrent.futures, \
+        email.utils, hashlib, heapq, http.client, io, json, lzma, marshal, os, \
+        os.path, random, re, shutil, socket, ssl, string, subprocess, sys, \
+        threading, time, \
         urllib.request, urllib.parse, urllib.error, urllib.parse
 from .version import PMCYG_VERSION
 
@@ -48,6 +50,14 @@ def ConcatShortDescription(desc: str) -> str:
         # A null or empty short-description shouldn't go unnoticed
 
 
+def _popcount(value: int) -> int:
+    """Count the number of bits set within a non-negative integer"""
+    return bin(value).count('1')
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+
+
 class PMCygException(Exception):
     """Wrapper for internally generated exceptions"""
 
@@ -73,34 +83,41 @@ class BuildViewer:
         self._operation = None
         self._verbThresh = verbosity
 
+        # Serialize output from concurrent download workers:
+        self._outLock = threading.RLock()
+
     def __call__(self, text: str, ctrl: int=SEV_NORMAL | VRB_MEDIUM) -> None:
         self.message(text, ctrl)
 
     def message(self, text: str, ctrl: int=SEV_NORMAL | VRB_MEDIUM) -> None:
-        if self._operation:
-            self._emit('  >>>\n', self._operation[1])
-        self._emit('{0}\n'.format(text), ctrl)
-        if self._operation:
-            self._emit('  >>> {0}...'.format(self._operation[0]),
-                       self._operation[1])
+        with self._outLock:
+            if self._operation:
+                self._emit('  >>>\n', self._operation[1])
+            self._emit('{0}\n'.format(text), ctrl)
+            if self._operation:
+                self._emit('  >>> {0}...'.format(self._operation[0]),
+                           self._operation[1])
 
     def startOperation(self, text: str, ctrl: int=VRB_MEDIUM) -> None:
-        self._operation = (text, ((ctrl & self.VRB_mask) | self.SEV_NORMAL))
-        self._emit('{0}...'.format(text), self.SEV_NORMAL)
+        with self._outLock:
+            self._operation = (text, ((ctrl & self.VRB_mask) | self.SEV_NORMAL))
+            self._emit('{0}...'.format(text), self.SEV_NORMAL)
 
     def endOperation(self, text: str, ctrl: int=SEV_NORMAL) -> None:
-        if not self._operation:
-            return
-        opVerbosity = (self._operation[1] & self.VRB_mask)
-        self._emit(' {0}\n'.format(text),
-                   ((ctrl & self.SEV_mask) | opVerbosity))
-        self._operation = None
+        with self._outLock:
+            if not self._operation:
+                return
+            opVerbosity = (self._operation[1] & self.VRB_mask)
+            self._emit(' {0}\n'.format(text),
+                       ((ctrl & self.SEV_mask) | opVerbosity))
+            self._operation = None
 
     def flushOperation(self) -> None:
-        if not self._operation:
-            return
-        self._emit('\n', (self._operation[1] & self.VRB_mask))
-        self._operation = None
+        with self._outLock:
+            if not self._operation:
+                return
+            self._emit('\n', (self._operation[1] & self.VRB_mask))
+            self._operation = None
 
     def _emit(self, text: str, ctrl: int) -> None:
         if (ctrl & self.VRB_mask) > self._verbThresh:
@@ -147,34 +164,476 @@ class BuildReporter:
 
 
 
+RE_CONTENT_RANGE = re.compile(r'^\s*bytes\s+(\d+)-', re.IGNORECASE)
+
+def ContentRangeStart(headers) -> int:
+    """Extract starting offset from HTTP Content-Range header"""
+    matches = RE_CONTENT_RANGE.match(headers.get('content-range', ''))
+    if matches:
+        return int(matches.group(1))
+    return None
+
+
+class ConnectionPool:
+    """Cache of persistent HTTP(S) connections, keyed on (scheme, host),
+    so that successive downloads from a mirror can share TCP/TLS sessions.
+
+    URLs with other schemes (e.g. file: or ftp:), or which would need
+    to pass via a proxy, are delegated to urllib.
+    """
+    PooledSchemes = { 'http':   http.client.HTTPConnection,
+                      'https':  http.client.HTTPSConnection }
+    MaxRedirects = 5
+    BlockSize = 1 << 16
+
+    def __init__(self, maxIdle: int=8, timeout: float=60) -> None:
+        self._lock = threading.Lock()
+        self._idle: dict = {}
+        self._maxIdle = maxIdle
+        self._timeout = timeout
+        self._proxies = urllib.request.getproxies()
+        self._sslContext = None
+        self._headers = { 'User-Agent': 'pmcyg/{0}'.format(PMCYG_VERSION) }
+
+    def urlopen(self, URL: str, headers: dict={}):
+        """Issue a GET request for the given URL, returning
+        a file-like response object, which should be closed after use."""
+        scheme = urllib.parse.urlsplit(URL).scheme.lower()
+        if scheme not in self.PooledSchemes or scheme in self._proxies:
+            request = urllib.request.Request(URL, headers=headers)
+            return urllib.request.urlopen(request, timeout=self._timeout)
+
+        allheaders = dict(self._headers)
+        allheaders.update(headers)
+
+        for redirect in range(self.MaxRedirects + 1):
+            (key, selector) = self._splitURL(URL)
+            (conn, response) = self._request(key, selector, allheaders)
+
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                response.read()
+                self._release(key, conn, response)
+                if not location:
+                    break
+                URL = urllib.parse.urljoin(URL, location)
+                continue
+
+            if response.status >= 400:
+                response.read()
+                self._release(key, conn, response)
+                raise urllib.error.HTTPError(URL, response.status,
+                                             response.reason,
+                                             response.msg, None)
+
+            return PooledResponse(self, key, conn, response, URL)
+
+        raise urllib.error.URLError('Too many redirections'
+                                    ' for {0}'.format(URL))
+
+    def retrieve(self, URL: str, path: str, resume: bool=False,
+                 digest=None) -> int:
+        """Download the given URL into a local file,
+        returning the final size of that file.
+
+        If resume is True, and the file already contains a partial
+        download, only the remaining data will be requested
+        via an HTTP Range request, falling back to downloading the
+        entire file if the server does not support this.
+
+        If a (freshly constructed) hashlib digest object is supplied,
+        it will be updated with the entire content of the file,
+        with newly downloaded data being hashed as they are received."""
+        offset = 0
+        headers = {}
+        if resume and os.path.isfile(path):
+            offset = os.path.getsize(path)
+            if offset > 0:
+                headers['Range'] = 'bytes={0:d}-'.format(offset)
+
+        try:
+            stream = self.urlopen(URL, headers)
+        except urllib.error.HTTPError as ex:
+            if offset and ex.code == 416:
+                # Partial download is presumably already complete:
+                if digest:
+                    HashChecker.UpdateFromFile(digest, path)
+                return offset
+            raise
+
+        with stream:
+            mode = 'wb'
+            if offset and getattr(stream, 'status', None) == 206:
+                if ContentRangeStart(stream.headers) != offset:
+                    raise urllib.error.URLError('Mismatched content-range'
+                                                ' for {0}'.format(URL))
+                mode = 'ab'
+                if digest:
+                    HashChecker.UpdateFromFile(digest, path)
+
+            with open(path, mode) as fp:
+                if not digest:
+                    shutil.copyfileobj(stream, fp, self.BlockSize)
+                    return fp.tell()
+                while True:
+                    chunk = stream.read(self.BlockSize)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    fp.write(chunk)
+                return fp.tell()
+
+    def close(self) -> None:
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _splitURL(self, URL):
+        (scheme, netloc, path, query, frag) = urllib.parse.urlsplit(URL)
+        selector = path or '/'
+        if query:
+            selector += '?' + query
+        return ((scheme.lower(), netloc.lower()), selector)
+
+    def _request(self, key, selector, headers):
+        """Send request via pooled connection, falling back to a new
+        connection if an idle one has been dropped by the server"""
+        while True:
+            (conn, reused) = self._acquire(key)
+            try:
+                conn.request('GET', selector, headers=headers)
+                return (conn, conn.getresponse())
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if not reused:
+                    raise
+
+    def _acquire(self, key):
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return (conns.pop(), True)
+
+        (scheme, netloc) = key
+        connclass = self.PooledSchemes[scheme]
+        if scheme == 'https':
+            if not self._sslContext:
+                self._sslContext = ssl.create_default_context()
+            conn = connclass(netloc, timeout=self._timeout,
+                             context=self._sslContext)
+        else:
+            conn = connclass(netloc, timeout=self._timeout)
+        return (conn, False)
+
+    def _release(self, key, conn, response):
+        """Return connection to pool, provided its response has been
+        fully consumed and the server has agreed to keep it open"""
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                conns = self._idle.setdefault(key, [])
+                if len(conns) < self._maxIdle:
+                    conns.append(conn)
+                    return
+        conn.close()
+
+
+class PooledResponse(io.RawIOBase):
+    """File-like wrapper for HTTP response borrowed from a ConnectionPool"""
+    def __init__(self, pool, key, conn, response, URL):
+        io.RawIOBase.__init__(self)
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = URL
+        self.status = response.status
+        self.headers = response.msg
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buff):
+        return self._response.readinto(buff)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self._response.read()
+        return self._response.read(size)
+
+    def close(self):
+        if self._conn:
+            (conn, self._conn) = (self._conn, None)
+            self._pool._release(self._key, conn, self._response)
+        io.RawIOBase.close(self)
+
+
+
+class PositionalWriter:
+    """Thread-safe writing of data blocks at given offsets within a file,
+    using os.pwrite() where available"""
+    def __init__(self, fd: int) -> None:
+        self._fd = fd
+        self._lock = threading.Lock()
+
+    def Write(self, data: bytes, offset: int) -> None:
+        view = memoryview(data)
+        if hasattr(os, 'pwrite'):
+            while view:
+                nbytes = os.pwrite(self._fd, view, offset)
+                (view, offset) = (view[nbytes:], offset + nbytes)
+        else:
+            with self._lock:
+                os.lseek(self._fd, offset, os.SEEK_SET)
+                while view:
+                    nbytes = os.write(self._fd, view)
+                    view = view[nbytes:]
+
+
+
 class SetupIniFetcher:
-    """Facade for fetching setup.ini from URL, with optional decompression"""
-    MaxIniFileLength = 1 << 26
+    """Facade for fetching setup.ini from URL, with optional decompression
+
+    The file is decompressed and decoded incrementally as it arrives,
+    yielding lines of text without holding the entire file in memory.
+
+    If a cache directory is supplied, the (compressed) file is stored there
+    together with its ETag and Last-Modified validators, so that later
+    fetches can use a conditional request, reusing the local copy
+    if the server reports that the file has not been modified.
+    Only files fetched over HTTP(S) are cached in this way.
+    """
+    BlockSize = 1 << 16
 
-    Decompressors = { 'bz2':    bz2.decompress,
-                      'xz':     lzma.decompress }
+    CachedSchemes = frozenset([ 'http', 'https' ])
 
-    def __init__(self, URL):
-        self._buffer = None
-        suffix = URL.rsplit('.', 1)[-1]
-        expander = self.Decompressors.get(suffix, (lambda x: x))
-        with urllib.request.urlopen(URL) as stream:
-            rawfile = expander(stream.read(self.MaxIniFileLength))
+    Decompressors = { 'bz2':    bz2.BZ2Decompressor,
+                      'xz':     lzma.LZMADecompressor }
 
-        self._buffer = io.StringIO(rawfile.decode(SI_TEXT_ENCODING, 'ignore'))
+    Validators = { 'ETag':           'If-None-Match',
+                   'Last-Modified':  'If-Modified-Since' }
+
+    def __init__(self, URL, pool=None, cacheDir=None):
+        self._URL = URL
+        self._stream = None
+        self._localPath = None
+        self._cacheUpdate = None
+        self.fromCache = False
+        self.digest = None
+
+        suffix = urllib.parse.urlsplit(URL).path.rsplit('.', 1)[-1]
+        self._decompressor = self.Decompressors.get(suffix)
+        self._open(URL, pool, cacheDir)
+        self._lines = self._generateLines()
 
     def __del__(self):
-        if self._buffer:
-            self._buffer.close()
+        self.close()
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        return next(self._buffer)
+        return next(self._lines)
 
     def close(self):
-        self._buffer.close()
+        if self._stream:
+            self._stream.close()
+            self._stream = None
+        if self._cacheUpdate:
+            # Discard incompletely downloaded copy:
+            (tmpfile, datapath, metapath, validators) = self._cacheUpdate
+            tmpfile.close()
+            try:
+                os.remove(tmpfile.name)
+            except OSError:
+                pass
+            self._cacheUpdate = None
+
+    def LocalDigest(self):
+        """Compute the sha512 hash-code of the decompressed file,
+        if available locally, without consuming any lines of text,
+        or return None if the file is being read from the network"""
+        if not self._localPath:
+            return None
+        hasher = hashlib.sha512()
+        with open(self._localPath, 'rb') as fp:
+            for chunk in self._expand(iter(lambda: fp.read(self.BlockSize),
+                                           b'')):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def CachePaths(cacheDir, URL):
+        """Find the locations of the cached copy of a file,
+        and of its HTTP validators"""
+        urlhash = hashlib.sha1(URL.encode('utf-8')).hexdigest()[:16]
+        basename = urllib.parse.urlsplit(URL).path.rsplit('/', 1)[-1]
+        datapath = os.path.join(cacheDir,
+                                '{0}-{1}'.format(urlhash, basename))
+        return (datapath, datapath + '.validators')
+
+    @classmethod
+    def IsCacheable(cls, URL):
+        """Test whether a file is fetched via a protocol for which
+        keeping a local copy can avoid repeated downloads"""
+        return urllib.parse.urlsplit(URL).scheme in cls.CachedSchemes
+
+    def _open(self, URL, pool, cacheDir):
+        """Open stream of compressed content, possibly from local cache"""
+        parts = urllib.parse.urlsplit(URL)
+        if not self.IsCacheable(URL):
+            cacheDir = None
+        headers = {}
+        if cacheDir:
+            (datapath, metapath) = self.CachePaths(cacheDir, URL)
+            validators = self._readValidators(metapath) \
+                            if os.path.isfile(datapath) else {}
+            for (field, condition) in self.Validators.items():
+                if field in validators:
+                    headers[condition] = validators[field]
+
+        try:
+            if pool:
+                stream = pool.urlopen(URL, headers=headers)
+            else:
+                stream = urllib.request.urlopen(
+                            urllib.request.Request(URL, headers=headers))
+        except urllib.error.HTTPError as ex:
+            if ex.code != 304 or not headers:
+                raise
+            stream = None
+
+        if stream is None or getattr(stream, 'status', 200) == 304:
+            if stream:
+                stream.close()
+            self._stream = open(datapath, 'rb')
+            self._localPath = datapath
+            self.fromCache = True
+            return
+
+        self._stream = stream
+        if parts.scheme == 'file':
+            self._localPath = urllib.request.url2pathname(parts.path)
+
+        validators = { field: stream.headers.get(field)
+                        for field in self.Validators
+                            if stream.headers.get(field) }
+        if cacheDir and validators:
+            try:
+                os.makedirs(cacheDir, exist_ok=True)
+                tmpfile = open(datapath + '.tmp', 'wb')
+                self._cacheUpdate = (tmpfile, datapath, metapath, validators)
+            except OSError:
+                pass
+
+    def ReadText(self) -> str:
+        """Decompress and decode the remainder of the incoming stream,
+        which is much faster than iterating over it line by line"""
+        return ''.join(self._generateText())
+
+    def _generateLines(self):
+        """Decompress and decode the incoming stream, line by line"""
+        remainder = ''
+        for text in self._generateText():
+            lines = (remainder + text).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if remainder:
+            yield remainder
+
+    def _generateText(self):
+        """Decompress and decode the incoming stream, block by block"""
+        hasher = hashlib.sha512()
+        decoder = codecs.getincrementaldecoder(SI_TEXT_ENCODING)('ignore')
+
+        try:
+            for chunk in self._expand(self._readBlocks()):
+                hasher.update(chunk)
+                yield decoder.decode(chunk)
+        except (OSError, EOFError, lzma.LZMAError,
+                http.client.HTTPException) as ex:
+            self.close()
+            raise PMCygException('Failed to read {0:s} - {1:s}' \
+                                    .format(self._URL, str(ex)))
+
+        yield decoder.decode(b'', final=True)
+
+        self.digest = hasher.hexdigest()
+        self._commitCache()
+        self.close()
+
+    def _readBlocks(self):
+        """Read blocks of compressed data, copying them into the cache"""
+        while True:
+            block = self._stream.read(self.BlockSize)
+            if not block:
+                break
+            if self._cacheUpdate:
+                self._cacheUpdate[0].write(block)
+            yield block
+
+    def _expand(self, blocks):
+        """Decompress an iterable of blocks, allowing for
+        files formed from several concatenated compressed streams"""
+        if not self._decompressor:
+            yield from blocks
+            return
+
+        decompressor = self._decompressor()
+        started = False
+        for block in blocks:
+            while block:
+                started = True
+                yield decompressor.decompress(block)
+                if decompressor.eof:
+                    block = decompressor.unused_data
+                    decompressor = self._decompressor()
+                    started = False
+                else:
+                    block = b''
+        if started:
+            raise EOFError('Compressed file ended before'
+                           ' the end-of-stream marker was reached')
+
+    def _commitCache(self):
+        """Store completely downloaded file and its validators,
+        silently ignoring any problems with the cache directory"""
+        if not self._cacheUpdate:
+            return
+        (tmpfile, datapath, metapath, validators) = self._cacheUpdate
+        self._cacheUpdate = None
+        metadata = ''.join('{0}: {1}\n'.format(field, value)
+                            for (field, value) in validators.items())
+        try:
+            tmpfile.close()
+            os.replace(tmpfile.name, datapath)
+            with open(metapath + '.tmp', 'wb') as fp:
+                fp.write(metadata.encode('ascii', 'ignore'))
+            os.replace(metapath + '.tmp', metapath)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _readValidators(metapath):
+        validators = {}
+        try:
+            with open(metapath, 'rt', encoding='ascii') as fp:
+                for line in fp:
+                    (field, sep, value) = line.strip().partition(': ')
+                    if sep:
+                        validators[field] = value
+        except (OSError, ValueError):
+            pass
+        return validators
 
 
 
@@ -188,21 +647,34 @@ class HashChecker:
     len2alg: dict = {}
 
     def __call__(self, path, tgthash, blksize=1<<14):
-        hasher = self._guessHashAlg(tgthash)
+        hasher = self.NewDigest(tgthash)
 
         try:
-            with open(path, 'rb') as fp:
-                while True:
-                    chunk = fp.read(blksize)
-                    if not chunk:
-                        break
-                    hasher.update(chunk)
+            self.UpdateFromFile(hasher, path, blksize)
         except:
             return False
 
-        filehash = hasher.hexdigest().lower()
+        return self.Matches(hasher, tgthash)
 
-        return (filehash == tgthash.lower())
+    def NewDigest(self, tgthash):
+        """Construct a digest object suitable for incrementally
+        verifying data against the supplied hash code"""
+        return self._guessHashAlg(tgthash)
+
+    @staticmethod
+    def UpdateFromFile(hasher, path, blksize=1<<16):
+        """Feed the entire content of a file into a digest object"""
+        with open(path, 'rb') as fp:
+            while True:
+                chunk = fp.read(blksize)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+
+    @staticmethod
+    def Matches(hasher, tgthash):
+        """Check whether a digest object agrees with the supplied hash code"""
+        return (hasher.hexdigest().lower() == tgthash.lower())
 
     @classmethod
     def _guessHashAlg(cls, tgthash):
@@ -235,6 +707,25 @@ class PMbuilder(BuildReporter):
     DL_SizeError =      3
     DL_HashError =      4
     DL_Failure =        5
+    DL_NotFound =       6
+    DL_Timeout =        7
+
+    DL_Descriptions = { DL_SizeError:   'size mismatch',
+                        DL_HashError:   'hash mismatch',
+                        DL_Failure:     'other error',
+                        DL_NotFound:    'not found',
+                        DL_Timeout:     'timeout' }
+
+    PartialSuffix = '.part'
+    SegmentSuffix = '.segments'
+    CacheDirectory = '.pmcyg-cache'
+
+    # Parameters for ranking mirror sites via RankMirrors():
+    MirrorProbeBytes = 1 << 18
+    MirrorProbeWorkers = 16
+    MirrorReferenceSize = 1 << 20
+    MirrorStaleness = 2 * 86400
+    MirrorProbeFile = 'mirror-probes.json'
 
     def __init__(self, BuildDirectory: str='.',
                 MirrorSite: str=DEFAULT_CYGWIN_MIRROR,
@@ -243,6 +734,7 @@ class PMbuilder(BuildReporter):
 
         BuildReporter.__init__(self, Viewer)
         self._hashCheck = HashChecker()
+        self._connPool = ConnectionPool()
 
         # Directory into which to assemble local mirror:
         self._tgtdir = BuildDirectory
@@ -262,11 +754,16 @@ class PMbuilder(BuildReporter):
         # Set of package age descriptors:
         self._epochs = ['curr']
 
-        self._masterList = MasterPackageList(Viewer=Viewer)
+        # Whether setup.ini etc. may be cached within the build directory:
+        self._caching = False
+
+        self._masterList = MasterPackageList(Viewer=Viewer,
+                                             ConnPool=self._connPool)
         self._pkgProc = PkgSetProcessor(self._masterList)
         self._garbage = GarbageCollector(Viewer=Viewer)
         self._cancelling = False
         self._mirrordict = None
+        self._mirrorProbes: dict = {}
         self._optiondict = {
             'AllPackages':      False,
             'DummyDownload':    False,
@@ -274,10 +771,28 @@ class PMbuilder(BuildReporter):
             'MakeAutorun':      False,
             'IncludeSources':   False,
             'RemoveOutdated':   'no',
-            'ISOfilename':      None
+            'ISOfilename':      None,
+            'DownloadWorkers':  1,
+            'Engine':           'threads',
+            'MirrorStripes':    1,
+            'ExtraMirrors':     [],
+            'SegmentThreshold': 1 << 26,
+            'DownloadSegments': 4,
+            'MaxRetries':       2,
+            'RetryDelay':       5.0,
+            'MaxRetryDelay':    120.0,
+            'MirrorFailover':   2,
+            'MirrorErrorThreshold': 0.5,
+            'AutoMirror':       False,
+            'MirrorProbeTimeout': 10.0,
+            'MirrorProbeLifetime': 3600.0,
+            'LazyIndex':        False,
+            'ParseWorkers':     1
         }
 
         self._fetchStats = FetchStats()
+        # Estimated (latency, throughput) of downloads from mirror:
+        self._transferModel = (0.25, float(1 << 20))
         self._cygcheck_list: list = []
         for (opt, val) in kwargs.items():
             self.SetOption(opt, val)
@@ -294,6 +809,7 @@ class PMbuilder(BuildReporter):
     def SetTargetDir(self, tgtdir: str) -> None:
         """Set the root directory beneath which packages will be downloaded"""
         self._tgtdir = tgtdir
+        self._enableCache(self._caching)
 
     @property
     def setup_exe_url(self) -> str:
@@ -320,6 +836,10 @@ class PMbuilder(BuildReporter):
         if not URL.endswith('/'):
             URL += '/'
         self._mirror = URL
+        if getattr(self, '_striper', None) is None:
+            self._striper = MirrorStriper([URL])
+        else:
+            self._striper.SetPrimary(URL)
 
     @property
     def setup_ini_url(self) -> str:
@@ -363,6 +883,10 @@ class PMbuilder(BuildReporter):
         except:
             raise PMCygException('Invalid configuration option "{0}"' \
                                     ' for PMbuilder'.format(optname))
+        if optname == 'LazyIndex':
+            self._masterList.SetLazy(bool(value))
+        elif optname == 'ParseWorkers':
+            self._masterList.SetParseWorkers(value)
         return oldval
 
     def ReadMirrorList(self, reload=False):
@@ -398,6 +922,139 @@ class PMbuilder(BuildReporter):
         fp.close()
         return self._mirrordict
 
+    def RankMirrors(self, candidates=None, reload: bool=False) -> list:
+        """Rank mirror sites by their estimated speed of downloading
+
+        Each candidate site (by default, the current mirror together with
+        all those from ReadMirrorList()) is probed in parallel,
+        by timing the fetching of the first part of its setup.xz file.
+        This measures both the time-to-first-byte and the throughput,
+        the results of which are cached, within the build directory,
+        for reuse over the next 'MirrorProbeLifetime' seconds.
+        Sites which are unreachable, or whose setup.xz appears
+        not to have been synchronized recently, are excluded.
+
+        Returns a list of (URL, latency, bytes-per-second) tuples,
+        fastest first."""
+        if candidates is None:
+            candidates = [ self._mirror ]
+            for countries in self.ReadMirrorList().values():
+                for sites in countries.values():
+                    candidates.extend(url for (ident, url) in sites)
+        candidates = [ (URL if URL.endswith('/') else URL + '/')
+                            for URL in candidates ]
+        candidates = list(collections.OrderedDict.fromkeys(candidates))
+
+        now = time.time()
+        lifetime = float(self._optiondict['MirrorProbeLifetime'] or 0)
+        if not reload:
+            self._loadMirrorProbes()
+        stale = [ URL for URL in candidates
+                    if reload or URL not in self._mirrorProbes
+                        or now - self._mirrorProbes[URL][0] > lifetime ]
+        if stale:
+            pool = ConnectionPool(maxIdle=0,
+                        timeout=float(self._optiondict['MirrorProbeTimeout']))
+            nworkers = min(len(stale), self.MirrorProbeWorkers)
+            with concurrent.futures.ThreadPoolExecutor(nworkers) as workers:
+                probes = workers.map(lambda URL: self._probeMirror(URL, pool),
+                                     stale)
+                for (URL, probe) in zip(stale, probes):
+                    self._mirrorProbes[URL] = (now,) + probe
+            pool.close()
+            self._saveMirrorProbes()
+
+        results = [ (URL,) + self._mirrorProbes[URL][1:]
+                        for URL in candidates ]
+        results = [ res for res in results if res[1] is not None ]
+        if not results:
+            return []
+
+        newest = max(modtime or 0 for (URL, ttfb, rate, modtime) in results)
+        reference = self.MirrorReferenceSize
+        ranking = [ (ttfb + reference / rate, URL, ttfb, rate)
+                        for (URL, ttfb, rate, modtime) in results
+                        if modtime is None
+                            or modtime >= newest - self.MirrorStaleness ]
+        ranking.sort()
+        return [ (URL, ttfb, rate) for (score, URL, ttfb, rate) in ranking ]
+
+    def _loadMirrorProbes(self) -> None:
+        """Merge any mirror-site probe results recorded by earlier runs
+        that are more recent than those already held in memory"""
+        path = os.path.join(self._getCacheDir(), self.MirrorProbeFile)
+        try:
+            with open(path, 'rt') as fp:
+                records = json.load(fp)
+            for (URL, probe) in records.items():
+                probe = tuple(probe)
+                if len(probe) != 4:
+                    continue
+                if URL not in self._mirrorProbes \
+                        or self._mirrorProbes[URL][0] < probe[0]:
+                    self._mirrorProbes[URL] = probe
+        except (OSError, ValueError, TypeError, AttributeError):
+            pass
+
+    def _saveMirrorProbes(self) -> None:
+        """Record mirror-site probe results for reuse by later runs"""
+        if not self._caching:
+            return
+        path = os.path.join(self._getCacheDir(), self.MirrorProbeFile)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wt') as fp:
+                json.dump(self._mirrorProbes, fp)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass
+
+    def _probeMirror(self, URL: str, pool):
+        """Measure the latency and throughput of fetching a small,
+        well-known, file from a mirror site, returning a tuple of
+        (latency, bytes-per-second, modification time),
+        or a tuple of Nones if the site could not be reached"""
+        probeURL = urllib.parse.urljoin(URL,
+                                        (self._cygarch or 'x86_64') + '/setup.xz')
+        try:
+            t0 = time.time()
+            with pool.urlopen(probeURL) as fp:
+                nbytes = len(fp.read(ConnectionPool.BlockSize))
+                t1 = time.time()
+                modtime = fp.headers.get('Last-Modified')
+                while nbytes < self.MirrorProbeBytes:
+                    block = fp.read(ConnectionPool.BlockSize)
+                    if not block:
+                        break
+                    nbytes += len(block)
+                t2 = time.time()
+        except Exception:
+            return (None, None, None)
+
+        if t2 > t1 and nbytes > ConnectionPool.BlockSize:
+            rate = (nbytes - ConnectionPool.BlockSize) / (t2 - t1)
+        else:
+            rate = nbytes / max(t2 - t0, 1e-6)
+        try:
+            modtime = email.utils.parsedate_to_datetime(modtime).timestamp()
+        except Exception:
+            modtime = None
+        return (t1 - t0, max(rate, 1.0), modtime)
+
+    def _autoSelectMirror(self) -> None:
+        """Switch to the fastest available mirror site"""
+        ranking = self.RankMirrors()
+        if not ranking:
+            self._statview('No mirror sites could be probed,'
+                           ' retaining {0}'.format(self._mirror),
+                           BuildViewer.SEV_WARNING)
+            return
+        (URL, ttfb, rate) = ranking[0]
+        self._statview('Selected mirror {0} (latency {1:.0f}ms, {2}/s)' \
+                        .format(URL, 1000 * ttfb,
+                                self._prettyfsize(int(rate))))
+        self.mirror_url = URL
+
 
     def ListInstalled(self):
         """Generate list of all packages on existing Cygwin installation"""
@@ -445,6 +1102,9 @@ class PMbuilder(BuildReporter):
         together with installer artefacts."""
 
         self._cancelling = False
+        self._enableCache(not self._optiondict['DummyDownload'])
+        if self._optiondict['AutoMirror']:
+            self._autoSelectMirror()
         self._masterList.SetSourceURL(self.setup_ini_url)
 
         userpackages = []
@@ -472,7 +1132,7 @@ class PMbuilder(BuildReporter):
 
         argv = [ 'genisoimage', '-o', isoname, '-quiet',
                 '-V', 'Cygwin(pmcyg)-' + time.strftime('%d%b%y'),
-                '-r', '-J', self._tgtdir ]
+                '-r', '-J', '-m', self.CacheDirectory, self._tgtdir ]
 
         self._statview.startOperation('Generating ISO image in ' + isoname)
         if self._optiondict['DummyDownload']:
@@ -496,6 +1156,49 @@ class PMbuilder(BuildReporter):
         """Signal that downloading should be terminated"""
         self._cancelling = flag
 
+    def ExplainPackages(self, pkgset, packages: list, stream) -> None:
+        """Describe why each of a list of packages would be included
+        as a result of resolving the dependencies of a set of packages"""
+        self._masterList.SetSourceURL(self.setup_ini_url)
+
+        userpackages = []
+        if pkgset:
+            userpackages = pkgset.extract(arch=self._cygarch)
+        self._resolveDependencies(userpackages)
+
+        for pkg in packages:
+            path = self._pkgProc.Explain(pkg)
+            if path:
+                reason = 'selected' if len(path) == 1 \
+                            else 'required by ' + ' <- '.join(path[-2::-1])
+                print('{0}: {1}'.format(pkg, reason), file=stream)
+            else:
+                print('{0}: not included'.format(pkg), file=stream)
+
+    def SizeReport(self, pkgset, stream) -> None:
+        """Describe how the download size of the selected packages,
+        and their dependencies, is attributable to each selected package"""
+        self._masterList.SetSourceURL(self.setup_ini_url)
+
+        userpackages = []
+        if pkgset:
+            userpackages = pkgset.extract(arch=self._cygarch)
+        selected = self._extendPkgSelection(userpackages)
+        (report, total) = self._pkgProc.AttributeSizes(selected, self._epochs,
+                                            self._optiondict['IncludeSources'])
+
+        print('# {0:>10s} {1:>10s}   {2:s}'.format('Exclusive', 'Shared',
+                                                   'Package'), file=stream)
+        for (pkg, exclusive, shared) in report:
+            print('  {0:>10s} {1:>10s}   {2:s}' \
+                    .format(self._prettyfsize(exclusive),
+                            self._prettyfsize(shared), pkg), file=stream)
+        common = total - sum(exclusive for (pkg, exclusive, shared) in report)
+        print('# Total size: {0}, of which {1} is shared'
+              ' between several packages' \
+                .format(self._prettyfsize(total), self._prettyfsize(common)),
+              file=stream)
+
     def TemplateFromLists(self, outfile: str, pkgfiles: list,
                           cygwinReplica: bool=False) -> None:
         """Wrapper for PkgSetProcessor.MakeTemplate(),
@@ -504,7 +1207,9 @@ class PMbuilder(BuildReporter):
 
         pkgset = PackageSet(pkgfiles)
         if cygwinReplica:
-            pkgset.extend(self.ListInstalled())
+            installed = self.ListInstalled()
+            pkgset.extend(self._pkgProc.ContractDependencies(installed,
+                                                        epochs=self._epochs))
 
         with codecs.open(outfile, 'w', SI_TEXT_ENCODING) as fp:
             self._pkgProc.MakeTemplate(fp, pkgset, terse=cygwinReplica)
@@ -528,7 +1233,8 @@ https://www.mirrorservice.org/sites/sourceware.org/pub/cygwin/;www.mirrorservice
         """Constuct list of packages, including all their dependencies"""
 
         selected = self._extendPkgSelection(usrpkgs)
-        return self._pkgProc.ExpandDependencies(selected, self._epochs)
+        return self._pkgProc.ExpandDependencies(selected, self._epochs,
+                                                recordPaths=True)
 
     def _extendPkgSelection(self, userpkgs=None):
         """Amend list of packages to include base or default packages"""
@@ -568,8 +1274,10 @@ https://www.mirrorservice.org/sites/sourceware.org/pub/cygwin/;www.mirrorservice
         """Convert list of packages into set of files to fetch from Cygwin server"""
         pkgdict = self._masterList.GetPackageDict()
 
-        # Construct list of compiled/source/current/previous variants:
+        # Construct list of compiled/source/current/previous variants,
+        # noting that several packages may share the same source tarball:
         downloads = []
+        fetched = set()
 
         for pkg in packages:
             pkginfo = pkgdict[pkg]
@@ -590,6 +1298,8 @@ https://www.mirrorservice.org/sites/sourceware.org/pub/cygwin/;www.mirrorservice
                     pkgref = flds[0]
                     pkgsize = int(flds[1])
                     pkghash = flds[2]
+                    if pkgref in fetched: continue
+                    fetched.add(pkgref)
                     downloads.append((pkgref, pkgsize, pkghash))
                 except:
                     self._statview('Cannot find package filename ' \
@@ -641,7 +1351,7 @@ https://www.mirrorservice.org/sites/sourceware.org/pub/cygwin/;www.mirrorservice
             fp.write('\n'.join(msgs))
             for pkg in packages:
                 fp.write('\n')
-                fp.write(pkgdict[pkg].GetAny('TEXT'))
+                fp.write(pkgdict[pkg].GetText())
             fp.write('\n')
         with open(spath, 'rb') as fp:
             hashfiles.append(inibz2)
@@ -654,7 +1364,7 @@ https://www.mirrorservice.org/sites/sourceware.org/pub/cygwin/;www.mirrorservice
         try:
             self._statview.startOperation('Retrieving {0} to {1}' \
                                                 .format(exeURL, tgtpath))
-            urllib.request.urlretrieve(exeURL, tgtpath)
+            self._connPool.retrieve(exeURL, tgtpath)
             self._statview.endOperation('done')
         except Exception as ex:
             self._statview.flushOperation()
@@ -695,47 +1405,49 @@ https://www.mirrorservice.org/sites/sourceware.org/pub/cygwin/;www.mirrorservice
 
         augdownloads = self._preparePaths(downloads)
 
-        retries = 3     # FIXME make this tunable
-        while augdownloads and retries > 0:
-            retrydownloads = []
-            retries -= 1
-
-            for DLsummary in augdownloads:
-                (pkgfile, pkgsize, pkghash, tgtpath) = DLsummary
-                if self._cancelling:
-                    self._statview('** Downloading cancelled **')
-                    break
-
-                mirpath = urllib.parse.urljoin(self._mirror, pkgfile)
-
-                self._statview.startOperation('  {0} ({1})'.format(
-                                                os.path.basename(pkgfile),
-                                                self._prettyfsize(pkgsize)))
-
-                (outcome, errmsg) = self._downloadSingle(mirpath, pkgsize,
-                                                        pkghash, tgtpath)
-
-                if outcome == self.DL_Success:
-                    self._statview.endOperation('done')
-                    self._fetchStats.AddNew(pkgfile, pkgsize)
-                elif outcome == self.DL_AlreadyPresent:
-                    self._statview.endOperation('already present')
-                    self._fetchStats.AddAlready(pkgfile, pkgsize)
-                else:
-                    self._statview.endOperation(' FAILED ({0})'.format(errmsg),
-                                                BuildViewer.SEV_WARNING)
-                    if os.path.isfile(tgtpath):
-                        os.remove(tgtpath)
-                    if retries > 0:
-                        retrydownloads.append(DLsummary)
-                    else:
-                        self._fetchStats.AddFail(pkgfile, pkgsize)
-
-            if retries > 0 and retrydownloads:
-                self._statview('\n** Retrying {0:d} download(s) **' \
-                                .format(len(retrydownloads)))
-                time.sleep(10)
-            augdownloads = retrydownloads
+        self._striper = MirrorStriper(self._selectMirrors(),
+                        fallbacks=self._rankedMirrors,
+                        failover=int(self._optiondict['MirrorFailover'] or 0),
+                        errorThreshold=float(
+                                self._optiondict['MirrorErrorThreshold']))
+        if len(self._striper) > 1:
+            self._statview('Striping downloads across {0:d} mirrors:\n\t{1}' \
+                            .format(len(self._striper),
+                                    '\n\t'.join(self._striper.Mirrors())))
+
+        augdownloads = self._scheduleDownloads(augdownloads)
+        scheduler = self._makeRetryScheduler(augdownloads)
+
+        self._fetchStats.StartClock()
+        self._fetchAll(scheduler)
+        self._fetchStats.StopClock()
+        model = self._fetchStats.TransferModel()
+        if model:
+            self._transferModel = model
+        makespan = self._fetchStats.Makespan()
+        self._statview('Download time: {0:.1f}s (predicted {1:.1f}s)' \
+                        .format(makespan['Actual'], makespan['Predicted']))
+
+        if len(self._striper) > 1:
+            for (mirror, nbytes, rate) in self._striper.Usage():
+                self._statview('  {0} from {1} ({2}/s)' \
+                                .format(self._prettyfsize(nbytes), mirror,
+                                        self._prettyfsize(int(rate))))
+
+        health = self._striper.Health()
+        if len(health) > 1 or any(nfail for (m, nok, nfail, s) in health):
+            self._statview('Mirror health:')
+            for (mirror, nok, nfail, suspended) in health:
+                self._statview('  {0}: {1:d} succeeded, {2:d} failed{3}' \
+                                .format(mirror, nok, nfail,
+                                        ' (suspended)' if suspended else ''))
+
+        failures = scheduler.FailureCounts()
+        if failures:
+            self._statview('Download errors: {0}' \
+                            .format(', '.join('{0:d} {1}' \
+                                        .format(n, self.DL_Descriptions[o])
+                                        for (o, n) in sorted(failures.items()))))
 
         counts = self._fetchStats.Counts()
         if not counts['Fail']:
@@ -746,49 +1458,434 @@ https://www.mirrorservice.org/sites/sourceware.org/pub/cygwin/;www.mirrorservice
                             .format(counts['Fail'], counts['Total']),
                            BuildViewer.SEV_WARNING)
 
+    def _scheduleDownloads(self, augdownloads):
+        """Order downloads so as to minimize the overall time taken by
+        concurrent workers, by starting with the longest transfers,
+        and record the predicted makespan within FetchStats
+
+        Repeated targets are discarded first, because sorting by size
+        would otherwise hand identical downloads to separate workers
+        simultaneously."""
+        (latency, rate) = self._transferModel
+        unique = collections.OrderedDict()
+        for DLsummary in augdownloads:
+            unique.setdefault(DLsummary[3], DLsummary)
+
+        def duration(DLsummary):
+            (pkgfile, pkgsize, pkghash, tgtpath) = DLsummary
+            if os.path.isfile(tgtpath) and os.path.getsize(tgtpath) == pkgsize:
+                return 0.0
+            return latency + pkgsize / rate
+
+        durations = [ (duration(DLsummary), DLsummary)
+                        for DLsummary in unique.values() ]
+        if self._numWorkers() > 1:
+            durations.sort(key=lambda pair: pair[0], reverse=True)
+
+        makespan = self._predictMakespan([ d for (d, DL) in durations ],
+                                         self._numWorkers())
+        self._fetchStats.SetPredictedMakespan(makespan)
+
+        return [ DLsummary for (d, DLsummary) in durations ]
+
+    @staticmethod
+    def _predictMakespan(durations, nworkers):
+        """Simulate list-scheduling of a sequence of tasks
+        onto a set of workers, returning the time to complete all tasks"""
+        workers = [ 0.0 ] * max(1, nworkers)
+        for d in durations:
+            heapq.heappush(workers, heapq.heappop(workers) + d)
+        return max(workers)
+
+    def _numWorkers(self):
+        return max(1, int(self._optiondict['DownloadWorkers'] or 1))
+
+    def _makeRetryScheduler(self, augdownloads):
+        """Construct queue of downloads, with retry policy
+        based on user-configurable options"""
+        maxRetries = int(self._optiondict['MaxRetries'] or 0)
+        return RetryScheduler(augdownloads,
+                        maxRetries=maxRetries,
+                        baseDelay=float(self._optiondict['RetryDelay'] or 0),
+                        maxDelay=float(self._optiondict['MaxRetryDelay'] or 0),
+                        retryLimits={ self.DL_NotFound: min(1, maxRetries) },
+                        isCancelled=(lambda: self._cancelling))
+
+    def _fetchAll(self, scheduler):
+        """Download all packages from a RetryScheduler, either serially,
+        via a pool of worker threads, or via an asyncio event-loop"""
+        nworkers = self._numWorkers()
+        engine = self._optiondict['Engine']
+
+        if engine == 'asyncio':
+            self._statview('Downloading with up to {0:d} concurrent'
+                           ' asyncio transfers'.format(nworkers))
+            fetcher = AsyncDownloader(self, nworkers)
+            fetcher.FetchAll(scheduler)
+            return
+        elif engine != 'threads':
+            raise PMCygException('Unrecognized download engine'
+                                 ' "{0}"'.format(engine))
+
+        if nworkers == 1:
+            self._fetchWorker(scheduler)
+            return
+
+        self._statview('Downloading with {0:d} concurrent workers' \
+                        .format(nworkers))
+        with concurrent.futures.ThreadPoolExecutor(nworkers) as pool:
+            workers = [ pool.submit(self._fetchWorker, scheduler, True)
+                            for w in range(nworkers) ]
+            for worker in workers:
+                worker.result()
+
+    def _fetchWorker(self, scheduler, concurrent=False):
+        """Repeatedly download packages as they become due,
+        until the RetryScheduler is exhausted"""
+        while True:
+            DLsummary = scheduler.Next()
+            if DLsummary is None:
+                break
+            self._fetchOne(DLsummary, scheduler, concurrent)
+        self._checkCancelled()
+
+    def _fetchOne(self, DLsummary, scheduler, concurrent=False):
+        """Download a single package, reporting its outcome
+        to both the user and the RetryScheduler"""
+        (pkgfile, pkgsize, pkghash, tgtpath) = DLsummary
+
+        try:
+            mirror = self._striper.Acquire(pkgsize, pkgfile)
+            mirpath = urllib.parse.urljoin(mirror, pkgfile)
+
+            if not concurrent:
+                self._statview.startOperation(self._fetchLabel(DLsummary))
+
+            t0 = time.time()
+            (outcome, errmsg) = self._downloadSingle(mirpath, pkgsize,
+                                                     pkghash, tgtpath)
+            elapsed = time.time() - t0
+            self._releaseMirror(mirror, DLsummary, outcome, elapsed)
+
+            self._reportOutcome(DLsummary, outcome, errmsg,
+                                scheduler, concurrent, elapsed)
+        except BaseException:
+            scheduler.Interrupted(DLsummary, self.DL_Failure)
+            raise
+
+    def _selectMirrors(self):
+        """Choose the set of mirror sites from which packages
+        will be downloaded, always starting with the primary mirror
+        (from which setup.ini is obtained), followed by any user-chosen
+        mirrors, and supplemented by nearby sites from ReadMirrorList()"""
+        mirrors = [ self._mirror ]
+        for URL in self._optiondict['ExtraMirrors'] or []:
+            if not URL.endswith('/'):
+                URL += '/'
+            if URL not in mirrors:
+                mirrors.append(URL)
+
+        nstripes = int(self._optiondict['MirrorStripes'] or 1)
+        if len(mirrors) >= nstripes:
+            return mirrors
+
+        for URL in self._rankedMirrors():
+            if len(mirrors) >= nstripes:
+                break
+            if URL not in mirrors:
+                mirrors.append(URL)
+
+        return mirrors
+
+    def _rankedMirrors(self):
+        """List candidate mirror sites in order of preference, either
+        by probing their speed, or favouring those near the primary mirror"""
+        if self._optiondict['AutoMirror']:
+            return [ URL for (URL, ttfb, rate) in self.RankMirrors() ]
+
+        candidates = []
+        for (region, countries) in self.ReadMirrorList().items():
+            sites = [ (url if url.endswith('/') else url + '/')
+                            for sites in countries.values()
+                                for (ident, url) in sites ]
+            if self._mirror in sites:
+                candidates = sites + candidates
+            else:
+                candidates.extend(sites)
+        return candidates
+
+    def _checkCancelled(self):
+        """Test whether downloading has been cancelled,
+        announcing this on the first occasion it is noticed"""
+        if self._cancelling:
+            if not self._fetchStats.MarkCancelled():
+                self._statview('** Downloading cancelled **')
+            return True
+        return False
+
+    def _fetchLabel(self, DLsummary):
+        (pkgfile, pkgsize) = DLsummary[0:2]
+        return '  {0} ({1})'.format(os.path.basename(pkgfile),
+                                    self._prettyfsize(pkgsize))
+
+    def _releaseMirror(self, mirror, DLsummary, outcome, elapsed):
+        """Record the outcome of a download against its mirror site"""
+        (pkgfile, pkgsize, pkghash, tgtpath) = DLsummary
+        if outcome == self.DL_AlreadyPresent:
+            success = None
+        else:
+            success = (outcome == self.DL_Success)
+        permanent = outcome in (self.DL_NotFound, self.DL_HashError)
+        if self._striper.Release(mirror, pkgsize, elapsed, success,
+                                 key=pkgfile, permanent=permanent):
+            self._statview('Suspending downloads from {0}'
+                           ' after repeated errors'.format(mirror),
+                           BuildViewer.SEV_WARNING)
+
+    def _reportOutcome(self, DLsummary, outcome, errmsg,
+                       scheduler, concurrent=False, elapsed=None):
+        """Record the outcome of a single download,
+        re-queueing it within the RetryScheduler if it failed"""
+        (pkgfile, pkgsize, pkghash, tgtpath) = DLsummary
+
+        if outcome == self.DL_Success:
+            (status, severity) = ('done', BuildViewer.SEV_NORMAL)
+            self._fetchStats.AddNew(pkgfile, pkgsize, elapsed)
+            scheduler.Succeeded(DLsummary)
+        elif outcome == self.DL_AlreadyPresent:
+            (status, severity) = ('already present', BuildViewer.SEV_NORMAL)
+            self._fetchStats.AddAlready(pkgfile, pkgsize)
+            scheduler.Succeeded(DLsummary)
+        else:
+            (status, severity) = ('FAILED ({0})'.format(errmsg),
+                                  BuildViewer.SEV_WARNING)
+            delay = scheduler.Failed(DLsummary, outcome)
+            if delay is None:
+                self._fetchStats.AddFail(pkgfile, pkgsize)
+            else:
+                status += ' - retrying in {0:.0f}s'.format(delay)
+
+        if concurrent:
+            # Report each transfer on a single line, tagged with progress,
+            # so that output from overlapping downloads remains legible:
+            self._statview('{0}... {1} [{2:d}/{3:d}]' \
+                            .format(self._fetchLabel(DLsummary), status,
+                                    self._fetchStats.Completed(),
+                                    self._fetchStats.Counts()['Total']),
+                           severity)
+        else:
+            self._statview.endOperation(status, severity)
+
+    def _classifyError(self, ex):
+        """Map exception raised during download onto a DL_* outcome code"""
+        if isinstance(ex, urllib.error.HTTPError):
+            if ex.code in (404, 410):
+                return self.DL_NotFound
+        elif isinstance(ex, urllib.error.URLError):
+            ex = ex.reason
+        if isinstance(ex, (socket.timeout, asyncio.TimeoutError)):
+            return self.DL_Timeout
+        return self.DL_Failure
+
     def _downloadSingle(self, mirpath, pkgsize, pkghash, tgtpath):
-        """Attempt to download and validate a single package from the mirror"""
+        """Attempt to download and validate a single package from the mirror
+
+        Data are accumulated in a ".part" file, which is only renamed
+        to the target filename once its size and hash-code have been
+        verified. An interrupted download can therefore be resumed
+        on a later attempt, rather than restarting from scratch.
+        The hash-code is accumulated while data arrive from the mirror,
+        avoiding a second pass over the downloaded file."""
         outcome = self.DL_Failure
         errmsg = None
 
         if os.path.isfile(tgtpath) and os.path.getsize(tgtpath) == pkgsize:
-            outcome = self.DL_AlreadyPresent
-        else:
-            try:
-                dlsize = 0
-                urllib.request.urlretrieve(mirpath, tgtpath)
-                dlsize = os.path.getsize(tgtpath)
-                if dlsize == pkgsize:
+            if self._hashCheck(tgtpath, pkghash):
+                return (self.DL_AlreadyPresent, None)
+            # Replace corrupt local copy, without blaming the mirror for it:
+            os.remove(tgtpath)
+
+        partpath = tgtpath + self.PartialSuffix
+        try:
+            dlsize = 0
+            self._recoverPartial(partpath)
+            if self._isSegmented(pkgsize):
+                dlsize = self._downloadSegmented(mirpath, pkgsize, partpath,
+                                    int(self._optiondict['DownloadSegments']))
+                hashok = self._hashCheck(partpath, pkghash)
+            else:
+                hasher = self._hashCheck.NewDigest(pkghash)
+                dlsize = self._connPool.retrieve(mirpath, partpath,
+                                                 resume=True, digest=hasher)
+                hashok = HashChecker.Matches(hasher, pkghash)
+            if dlsize == pkgsize:
+                if hashok:
+                    os.replace(partpath, tgtpath)
                     outcome = self.DL_Success
                 else:
-                    outcome = self.DL_SizeError
-                    errmsg = 'mismatched size: {0} vs {1}' \
-                                .format(self._prettyfsize(dlsize),
-                                        self._prettyfsize(pkgsize))
-            except Exception as ex:
-                errmsg = str(ex)
-
-        if outcome == self.DL_AlreadyPresent or outcome == self.DL_Success:
-            if not self._hashCheck(tgtpath, pkghash):
-                outcome = self.DL_HashError
-                errmsg = 'mismatched checksum'
+                    outcome = self.DL_HashError
+                    errmsg = 'mismatched checksum'
+            else:
+                outcome = self.DL_SizeError
+                errmsg = 'mismatched size: {0} vs {1}' \
+                            .format(self._prettyfsize(dlsize),
+                                    self._prettyfsize(pkgsize))
+        except Exception as ex:
+            outcome = self._classifyError(ex)
+            errmsg = str(ex) or type(ex).__name__
+
+        if outcome == self.DL_HashError or \
+                (outcome == self.DL_SizeError and dlsize > pkgsize):
+            # Partial download cannot be salvaged by resuming:
+            os.remove(partpath)
 
         return (outcome, errmsg)
 
+    def _isSegmented(self, pkgsize):
+        """Test whether a package is large enough to be downloaded
+        as several byte-ranges in parallel"""
+        threshold = self._optiondict['SegmentThreshold']
+        nsegments = int(self._optiondict['DownloadSegments'] or 1)
+        return bool(threshold) and nsegments > 1 and pkgsize >= threshold
+
+    def _downloadSegmented(self, mirpath, pkgsize, partpath, nsegments):
+        """Download a large package as several byte-ranges in parallel,
+        writing each into its place within a preallocated ".part" file.
+
+        Any data already present in the ".part" file are retained,
+        and if any segment fails, or the download is interrupted,
+        the file is truncated to the contiguous prefix that was
+        successfully downloaded, so that a later attempt can resume
+        from there. The length of the prefix present before the download
+        started is recorded in a ".segments" file, in case the process
+        is killed before the file can be truncated."""
+        offset = 0
+        if os.path.isfile(partpath):
+            offset = os.path.getsize(partpath)
+            if offset >= pkgsize:
+                return self._connPool.retrieve(mirpath, partpath, resume=True)
+
+        seglen = -(-(pkgsize - offset) // nsegments)
+        segments = [ (start, min(start + seglen, pkgsize))
+                        for start in range(offset, pkgsize, seglen) ]
+        progress = [ 0 ] * len(segments)
+
+        # Check that mirror supports byte-ranges, using first segment:
+        stream0 = self._connPool.urlopen(mirpath,
+                        { 'Range': 'bytes={0:d}-{1:d}'.format(segments[0][0],
+                                                        segments[0][1] - 1) })
+        if getattr(stream0, 'status', None) != 206 \
+                or ContentRangeStart(stream0.headers) != segments[0][0]:
+            stream0.close()
+            return self._connPool.retrieve(mirpath, partpath, resume=True)
+
+        try:
+            fd = os.open(partpath,
+                         os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        except BaseException:
+            stream0.close()
+            raise
+        writer = PositionalWriter(fd)
+        aborted = threading.Event()
+
+        def fetchSegment(idx, stream=None):
+            (start, end) = segments[idx]
+            if not stream:
+                stream = self._connPool.urlopen(mirpath,
+                            { 'Range': 'bytes={0:d}-{1:d}'.format(start,
+                                                                  end - 1) })
+            with stream:
+                if getattr(stream, 'status', None) != 206 \
+                        or ContentRangeStart(stream.headers) != start:
+                    raise urllib.error.URLError('Mismatched content-range'
+                                                ' for {0}'.format(mirpath))
+                pos = start
+                while pos < end:
+                    if self._cancelling or aborted.is_set():
+                        raise PMCygException('Download cancelled')
+                    chunk = stream.read(min(ConnectionPool.BlockSize,
+                                            end - pos))
+                    if not chunk:
+                        raise http.client.IncompleteRead(b'', end - pos)
+                    writer.Write(chunk, pos)
+                    pos += len(chunk)
+                    progress[idx] = pos - start
+
+        logpath = partpath + self.SegmentSuffix
+        complete = False
+        try:
+            with open(logpath, 'wt') as fp:
+                fp.write('{0:d}\n'.format(offset))
+            os.ftruncate(fd, pkgsize)
+            with concurrent.futures.ThreadPoolExecutor(len(segments)) as pool:
+                futures = [ pool.submit(fetchSegment, 0, stream0) ]
+                futures.extend(pool.submit(fetchSegment, idx)
+                                for idx in range(1, len(segments)))
+                try:
+                    errors = [ fut.exception() for fut in futures
+                                    if fut.exception() ]
+                except BaseException:
+                    # Stop remaining segments promptly, e.g. after Ctrl-C:
+                    aborted.set()
+                    raise
+
+            if errors:
+                raise errors[0]
+
+            complete = True
+            return os.fstat(fd).st_size
+        finally:
+            try:
+                if not complete:
+                    prefix = offset
+                    for (idx, (start, end)) in enumerate(segments):
+                        prefix = start + progress[idx]
+                        if prefix < end:
+                            break
+                    os.ftruncate(fd, prefix)
+            finally:
+                os.close(fd)
+            if os.path.isfile(logpath):
+                os.remove(logpath)
+
+    def _recoverPartial(self, partpath):
+        """Truncate any ".part" file left by a segmented download which
+        was killed before completion, to the prefix known to be contiguous"""
+        logpath = partpath + self.SegmentSuffix
+        if not os.path.isfile(logpath):
+            return
+        try:
+            with open(logpath, 'rt') as fp:
+                prefix = int(fp.read().strip())
+        except (OSError, ValueError):
+            prefix = 0
+        if os.path.isfile(partpath) and os.path.getsize(partpath) > prefix:
+            os.truncate(partpath, prefix)
+        os.remove(logpath)
+
     def _preparePaths(self, downloads):
-        """Setup directories for packages due to be downloaded"""
+        """Setup directories for packages due to be downloaded,
+        discarding any repeated targets, which would otherwise be
+        downloaded concurrently into the same file"""
         augdownloads = []
+        targets = set()
 
         for (pkgfile, pkgsize, pkghash) in downloads:
             if os.path.isabs(pkgfile):
                 raise SyntaxError('{0} is an absolute path'.format(pkgfile))
 
             tgtpath = os.path.join(self._tgtdir, pkgfile)
+            if tgtpath in targets:
+                continue
+            targets.add(tgtpath)
             tgtdir = os.path.dirname(tgtpath)
             if not os.path.isdir(tgtdir):
                 os.makedirs(tgtdir)
 
             self._garbage.RescueFile(tgtpath)
+            self._garbage.RescueFile(tgtpath + self.PartialSuffix)
+            self._garbage.RescueFile(tgtpath + self.PartialSuffix
+                                        + self.SegmentSuffix)
             augdownloads.append((pkgfile, pkgsize, pkghash, tgtpath))
 
         return augdownloads
@@ -806,6 +1903,18 @@ https://www.mirrorservice.org/sites/sourceware.org/pub/cygwin/;www.mirrorservice
             pure = basename
         return (basename, pure)
 
+    def _getCacheDir(self) -> str:
+        """Find the directory in which to cache the Cygwin package database"""
+        return os.path.join(self._tgtdir, self.CacheDirectory)
+
+    def _enableCache(self, enabled: bool=True) -> None:
+        """Choose whether setup.ini, and other information about
+        the mirror site, should be cached within the build directory.
+        This is only done while building a mirror, so that queries
+        such as generating a template leave no files behind."""
+        self._caching = enabled
+        self._masterList.SetCacheDir(self._getCacheDir() if enabled else None)
+
     def _getArchDir(self, create=False):
         """Get the local directory in which architecture-dependent
         Cygwin packages will be assembled"""
@@ -943,41 +2052,151 @@ class PkgSetProcessor(BuildReporter):
     def __init__(self, masterList):
         BuildReporter.__init__(self, Peer=masterList)
         self._masterList = masterList
+        self._explanation = None
 
     def ExpandDependencies(self, selected, epochs=['curr'],
-                           ignoreUnresolved=False):
-        """Expand list of packages to include all their dependencies"""
-        pkgdict = self._masterList.GetPackageDict()
+                           ignoreUnresolved=False, recordPaths=False):
+        """Expand list of packages to include all their dependencies
 
-        additions = set(selected)
-        packages = set()
-        badpkgnames = []
-        badrequires = set()
+        If recordPaths is set, the route by which each package was reached
+        is retained, for subsequent use by Explain().
+        """
+        graph = self._masterList.GetDependencyGraph()
+        (seeds, badpkgnames) = self._lookupPackages(graph, selected)
+        parents = {} if recordPaths else None
+        closure = graph.Closure(seeds, epochs, parents)
+        if recordPaths:
+            self._explanation = (graph, parents)
+
+        return self._reportClosure(graph, closure, badpkgnames,
+                                   epochs, ignoreUnresolved)
+
+    def ExpandMany(self, selections, epochs=['curr'],
+                   ignoreUnresolved=False):
+        """Expand several lists of packages to include all their dependencies
+
+        The dependencies of each package, or loop of mutually dependent
+        packages, are only computed once, and then reused by any other
+        list of packages, until the underlying setup.ini is reloaded.
+        """
+        graph = self._masterList.GetDependencyGraph()
+        expansions = []
+        for selected in selections:
+            (seeds, badpkgnames) = self._lookupPackages(graph, selected)
+            closure = graph.MemoizedClosure(seeds, epochs)
+            expansions.append(self._reportClosure(graph, closure, badpkgnames,
+                                                  epochs, ignoreUnresolved))
+        return expansions
+
+    def AttributeSizes(self, selected, epochs=['curr'], includeSources=False):
+        """Apportion the download size of a set of packages,
+        together with their dependencies, amongst the selected packages
+
+        For each selected package, this finds the exclusive size,
+        of the package and any dependencies which would not be needed
+        if that package were deselected, together with the shared size,
+        of its remaining dependencies which are also needed by other
+        selected packages. This supplies a list of (package, exclusive,
+        shared) tuples, largest first, and the total size of all packages.
+        """
+        graph = self._masterList.GetDependencyGraph()
+        (seeds, badpkgnames) = self._lookupPackages(graph, selected)
+        closure = graph.Closure(seeds, epochs)
+        self._reportClosure(graph, closure, badpkgnames,
+                            epochs, ignoreUnresolved=False)
+
+        (order, idom) = graph.Dominators(seeds, epochs)
+        sizes = [ 0 ] * len(graph)
+        for idx in order:
+            sizes[idx] = self._packageSize(graph.GetName(idx), epochs,
+                                           includeSources)
+
+        # Accumulate sizes of each subtree of the dominator tree:
+        exclusive = { idx: sizes[idx] for idx in order }
+        for idx in reversed(order):
+            if idom[idx] is not None:
+                exclusive[idom[idx]] += exclusive[idx]
+
+        # Packages which are dependencies of other selected packages,
+        # including those within loops, bring in nothing by themselves:
+        component = graph.Components(epochs)[0]
+        cover = set(graph.MinimalCover(seeds, epochs))
+        loops = collections.Counter(component[idx] for idx in seeds)
+        for idx in seeds:
+            if idx not in cover or loops[component[idx]] > 1:
+                exclusive[idx] = 0
+
+        totals = graph.ClosureWeights(seeds, sizes, epochs)
+        report = [ (graph.GetName(idx), exclusive[idx], total - exclusive[idx])
+                    for (idx, total) in zip(seeds, totals) ]
+        report.sort(key=lambda entry: (-entry[1], entry[0]))
+
+        return (report, sum(sizes))
+
+    def _packageSize(self, pkg, epochs, includeSources=False):
+        """Find the total size of files needed to install a package"""
+        pkginfo = self._masterList.GetPackageDict()[pkg]
+        pkgtypes = set([ pkginfo.GetDefaultFile() ])
+        if includeSources:
+            pkgtypes.add('source')
+
+        size = 0
+        for ptype in pkgtypes:
+            for epoch in epochs:
+                installs = pkginfo.GetAny(ptype, [epoch]) if ptype else None
+                try:
+                    size += int(installs.split()[1])
+                except (AttributeError, IndexError, ValueError):
+                    pass
+        return size
+
+    def Explain(self, pkg):
+        """Find the shortest chain of dependencies by which a package
+        was included by the most recent ExpandDependencies(recordPaths=True)
+
+        This supplies a list of package names, starting with one of
+        the originally selected packages, and ending with the given package,
+        or None if that package was not included.
+        """
+        if not self._explanation:
+            raise PMCygException('No record of dependency expansion'
+                                 ' from which to explain {0}'.format(pkg))
+        (graph, parents) = self._explanation
+
+        idx = graph.GetId(pkg)
+        if idx is None or idx not in parents:
+            return None
+        path = []
+        while idx is not None:
+            path.append(graph.GetName(idx))
+            idx = parents[idx]
+        path.reverse()
 
-        while additions:
-            pkg = additions.pop()
-            packages.add(pkg)
+        return path
 
-            pkginfo = pkgdict.get(pkg, None)
-            if not pkginfo:
+    @staticmethod
+    def _lookupPackages(graph, selected):
+        """Find the graph indices of a list of package names,
+        together with a list of any unrecognized names"""
+        seeds = []
+        badpkgnames = []
+        for pkg in set(selected):
+            idx = graph.GetId(pkg)
+            if idx is None:
                 badpkgnames.append(pkg)
-                continue
+            else:
+                seeds.append(idx)
+        return (seeds, badpkgnames)
 
-            # Find dependencies of current package & add to stack:
-            for epoch in epochs:
-                try:
-                    reqlist = pkginfo.GetDependencies([epoch])
-                    for r in reqlist:
-                        if not pkgdict.get(r):
-                            badrequires.add((pkg, r))
-                            continue
-                        if not r in packages:
-                            additions.add(r)
-                except:
-                    if not pkginfo.HasFileContent():
-                        self._statview('Cannot find epoch \'{0}\' for {1}' \
-                                        .format(epoch, pkg),
-                                       BuildViewer.SEV_WARNING)
+    def _reportClosure(self, graph, closure, badpkgnames,
+                       epochs, ignoreUnresolved):
+        """Convert a set of package indices into a sorted list of names,
+        after reporting any unrecognized or unresolvable packages"""
+        badrequires = set()
+        for (idx, deps) in graph.Unresolved(epochs).items():
+            if idx in closure:
+                pkg = graph.GetName(idx)
+                badrequires.update((pkg, dep) for dep in deps)
 
         if badpkgnames and not ignoreUnresolved:
             badpkgnames.sort()
@@ -998,40 +2217,48 @@ class PkgSetProcessor(BuildReporter):
                            ' dependencies: {0}'.format(', '.join(links)),
                            BuildViewer.SEV_WARNING)
 
-        packages = list(packages)
-        packages.sort()
+        pkgdict = self._masterList.GetPackageDict()
+        for idx in sorted(closure):
+            pkg = graph.GetName(idx)
+            pkginfo = pkgdict[pkg]
+            for epoch in epochs:
+                if not pkginfo.HasEpoch(epoch) \
+                        and not pkginfo.HasFileContent():
+                    self._statview('Cannot find epoch \'{0}\' for {1}' \
+                                    .format(epoch, pkg),
+                                   BuildViewer.SEV_WARNING)
+
+        packages = [ graph.GetName(idx) for idx in sorted(closure) ]
+        if badpkgnames:
+            packages = sorted(packages + badpkgnames)
 
         return packages
 
-    def ContractDependencies(self, pkglist, minvotes=6):
-        """Remove (most) automatically installed packages from list,
-        such that an initial selection of packages can be reduced to
-        a minimal subset that has the same effect after dependency expansion."""
-        dependencies = self._buildDependencies()
-        votes = { p: 0 for p in pkglist }
+    def ContractDependencies(self, pkglist, minvotes=None, epochs=['curr']):
+        """Remove automatically installed packages from list,
+        such that an initial selection of packages is reduced to
+        a minimal subset that has the same effect after dependency expansion.
 
-        # Find number of times each package is cited as a dependency:
+        Packages are only retained if they cannot be reached from
+        any other selected package, with one package being chosen
+        to represent any loop of mutual dependencies (e.g. between
+        gcc-mingw-g++ and gcc-g++). The minvotes argument is no longer used.
+        The epochs should match those used to expand the selection.
+        """
+        graph = self._masterList.GetDependencyGraph()
+
+        seeds = set()
+        unknown = set()
         for pkg in pkglist:
-            reqs = dependencies.get(pkg, [])
-            for req in reqs:
-                votes[req] = votes.get(req, 0) + 1
-
-        # Finding zero-vote packages would be sufficient if the graph of
-        # dependencies did not contain loops (e.g. gcc-mingw-g++ <-> gcc-g++).
-        # We add packages with many votes because they are probably worth
-        # listing explicitly, even if they would be installed as dependencies
-        # of zero-vote packages.
-        primaries = [pkg for pkg, n in votes.items()
-                            if n == 0 or n >= minvotes]
-
-        # Preserve any packages not covered by the tree grown from
-        # the zero-vote packages, to handle segments of the dependency graph
-        # containing loops, allowing for packages (e.g. zlib0) that might be
-        # in the process of being declared obsolete:
-        coverage = self.ExpandDependencies(primaries, ignoreUnresolved=True)
-        contracted = set(pkglist).difference(coverage)
-
-        packages = list(contracted.union(primaries))
+            idx = graph.GetId(pkg)
+            if idx is None:
+                unknown.add(pkg)
+            else:
+                seeds.add(idx)
+
+        packages = [ graph.GetName(idx)
+                        for idx in graph.MinimalCover(seeds, epochs) ]
+        packages.extend(unknown)
         packages.sort()
 
         return packages
@@ -1129,38 +2356,429 @@ class PkgSetProcessor(BuildReporter):
             os.rename(newfn, fn)
 
 
-    def _buildDependencies(self, epoch='curr'):
-        """Build lookup table of dependencies of each available package"""
-        pkgdict = self._masterList.GetPackageDict()
-        dependencies = {}
-        for pkg, pkginfo in pkgdict.items():
-            try:
-                dependencies[pkg] = pkginfo.GetDependencies([epoch])
-            except:
-                pass
-        return dependencies
+
+class DependencyGraph:
+    """Graph of dependencies between all packages within setup.ini
+
+    Packages are identified by integer indices, in order of their names,
+    and the dependencies for each epoch are held in compressed sparse-row
+    form, with offsets[idx]:offsets[idx+1] selecting the range of targets
+    that are dependencies of package idx. The reverse graph,
+    of packages requiring each package, is held in the same form.
+    Where a list of several epochs is supplied in place of a single epoch,
+    the union of the dependencies within each epoch is used.
+    """
+    def __init__(self, pkgdict):
+        self._pkgdict = pkgdict
+        self._names = sorted(pkgdict)
+        self._ids = { name: idx for (idx, name) in enumerate(self._names) }
+        self._epochs = {}
+        self._components = {}
+        self._members = {}
+        self._closures = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def GetId(self, pkgname):
+        return self._ids.get(pkgname)
+
+    def GetName(self, idx):
+        return self._names[idx]
+
+    def Requires(self, idx, epoch='curr'):
+        """Find indices of the packages on which a package depends"""
+        (offsets, targets) = self._getEdges(epoch)[0]
+        return targets[offsets[idx]:offsets[idx+1]]
+
+    def RequiredBy(self, idx, epoch='curr'):
+        """Find indices of the packages which depend on a package"""
+        (offsets, sources) = self._getEdges(epoch)[1]
+        return sources[offsets[idx]:offsets[idx+1]]
+
+    def Unresolved(self, epoch='curr'):
+        """Find the names of dependencies which do not match any package,
+        as a dictionary keyed on the index of the requiring package"""
+        return self._getEdges(epoch)[2]
+
+    def Closure(self, seeds, epochs=['curr'], parents=None):
+        """Find the indices of a set of packages and all their dependencies
+
+        If a dictionary of parents is supplied, this will be populated
+        with the package through which each dependency was first reached,
+        such that these trace the shortest paths from the seeds.
+        """
+        (offsets, targets) = self._getEdges(epochs)[0]
+        visited = bytearray(len(self._names))
+        closure = set(seeds)
+        for idx in closure:
+            visited[idx] = 1
+        queue = sorted(closure)
+        if parents is not None:
+            parents.update(dict.fromkeys(queue))
+
+        # Traverse breadth-first, with the queue growing during iteration:
+        for idx in queue:
+            for tgt in targets[offsets[idx]:offsets[idx+1]]:
+                if not visited[tgt]:
+                    visited[tgt] = 1
+                    closure.add(tgt)
+                    queue.append(tgt)
+                    if parents is not None:
+                        parents[tgt] = idx
+
+        return closure
+
+    def ClosureWeights(self, seeds, weights, epochs=['curr']):
+        """Find the total weight of the closure of each of a set of packages,
+        given a sequence of non-negative integer weights indexed by package
+
+        The closure of each component of the graph is represented
+        as a bitset, accumulated in topological order, with the weights
+        of all packages within it being found from the population counts
+        of its intersection with each binary digit of the weights.
+        """
+        (offsets, targets) = self._getEdges(epochs)[0]
+        (component, ncomponents) = self.Components(epochs)
+        members = self._getCached(self._members, epochs, self._groupMembers)
+
+        closure = sorted(self.Closure(seeds, epochs))
+        position = { idx: pos for (pos, idx) in enumerate(closure) }
+        nbits = max([ weights[idx] for idx in closure ] + [ 0 ]).bit_length()
+        masks = [ int(''.join('1' if (weights[idx] >> bit) & 1 else '0'
+                              for idx in reversed(closure)) or '0', 2)
+                    for bit in range(nbits) ]
+
+        # Count references to each component, so its bitset can be discarded
+        # once all components which depend on it have been processed:
+        comps = sorted(set(component[idx] for idx in closure))
+        pending = dict.fromkeys(comps, 0)
+        for comp in comps:
+            for idx in members[comp]:
+                for tgt in targets[offsets[idx]:offsets[idx+1]]:
+                    if component[tgt] != comp:
+                        pending[component[tgt]] += 1
+
+        targetComps = {}
+        for seed in seeds:
+            targetComps.setdefault(component[seed], []).append(seed)
+        totals = {}
+        reach = {}
+        for comp in comps:
+            bits = 0
+            for idx in members[comp]:
+                bits |= 1 << position[idx]
+                for tgt in targets[offsets[idx]:offsets[idx+1]]:
+                    succ = component[tgt]
+                    if succ == comp:
+                        continue
+                    bits |= reach[succ]
+                    pending[succ] -= 1
+                    if not pending[succ]:
+                        del reach[succ]
+            if comp in targetComps:
+                total = sum(_popcount(bits & mask) << bit
+                            for (bit, mask) in enumerate(masks))
+                for seed in targetComps[comp]:
+                    totals[seed] = total
+            if pending[comp]:
+                reach[comp] = bits
+
+        return [ totals[seed] for seed in seeds ]
+
+    def MemoizedClosure(self, seeds, epochs=['curr']):
+        """Find the indices of a set of packages and all their dependencies,
+        reusing the closures of any components previously encountered"""
+        component = self.Components(epochs)[0]
+        closures = [ self._componentClosure(comp, epochs)
+                        for comp in set(component[idx] for idx in seeds) ]
+        if len(closures) == 1:
+            return closures[0]
+        return frozenset().union(*closures)
+
+    def Components(self, epoch='curr'):
+        """Find the strongly connected components of the graph
+
+        This supplies an array mapping each package index onto
+        the index of its component, together with the number of components.
+        Components are numbered in reverse topological order, such that
+        dependencies between components always point to lower indices.
+        """
+        return self._getCached(self._components, epoch, self._findComponents)
+
+    def MinimalCover(self, seeds, epochs=['curr']):
+        """Find the smallest subset of a set of package indices whose
+        dependencies include all the remaining packages"""
+        (offsets, targets) = self._getEdges(epochs)[0]
+        (component, ncomponents) = self.Components(epochs)
+
+        # Choose a single representative of each component, such as a loop:
+        chosen = {}
+        for idx in seeds:
+            comp = component[idx]
+            if comp not in chosen or idx < chosen[comp]:
+                chosen[comp] = idx
+
+        # Propagate reachability from selected components, in topological
+        # order, through the condensation of the dependency graph:
+        members = self._getCached(self._members, epochs, self._groupMembers)
+        reached = bytearray(ncomponents)
+        for comp in range(ncomponents - 1, -1, -1):
+            if not (reached[comp] or comp in chosen):
+                continue
+            for idx in members[comp]:
+                for tgt in targets[offsets[idx]:offsets[idx+1]]:
+                    if component[tgt] != comp:
+                        reached[component[tgt]] = 1
+
+        return sorted(idx for (comp, idx) in chosen.items()
+                            if not reached[comp])
+
+    def _componentClosure(self, comp, epochs):
+        """Find the dependencies of all packages within a component,
+        recording these for reuse by subsequent queries"""
+        memo = self._getCached(self._closures, epochs, lambda key: {})
+        closure = memo.get(comp)
+        if closure is not None:
+            return closure
+
+        (offsets, targets) = self._getEdges(epochs)[0]
+        (component, ncomponents) = self.Components(epochs)
+        members = self._getCached(self._members, epochs, self._groupMembers)
+
+        # Traverse the condensed graph, merging any closures already known:
+        visited = bytearray(ncomponents)
+        visited[comp] = 1
+        stack = [ comp ]
+        (indices, known) = ([], [])
+        while stack:
+            current = stack.pop()
+            if current != comp and current in memo:
+                known.append(memo[current])
+                continue
+            for idx in members[current]:
+                indices.append(idx)
+                for tgt in targets[offsets[idx]:offsets[idx+1]]:
+                    if not visited[component[tgt]]:
+                        visited[component[tgt]] = 1
+                        stack.append(component[tgt])
+
+        closure = frozenset(indices).union(*known)
+        memo[comp] = closure
+        return closure
+
+    def Dominators(self, seeds, epochs=['curr']):
+        """Find the immediate dominator of each package within the
+        dependencies of a set of selected packages
+
+        All selected packages are treated as dependencies of a single
+        virtual root, so the dominator of a package is the package through
+        which every path from that root must pass. This supplies a list
+        of package indices in reverse postorder, such that dominators
+        precede the packages they dominate, together with a dictionary of
+        immediate dominators, in which None denotes the virtual root.
+        (See Cooper, Harvey & Kennedy, "A Simple, Fast Dominance Algorithm")
+        """
+        (offsets, targets) = self._getEdges(epochs)[0]
+        (revOffsets, sources) = self._getEdges(epochs)[1]
+        root = len(self._names)
+        seeds = sorted(set(seeds))
+
+        visited = bytearray(root)
+        postorder = []
+        for seed in seeds:
+            if visited[seed]:
+                continue
+            visited[seed] = 1
+            work = [ [ seed, offsets[seed] ] ]
+            while work:
+                frame = work[-1]
+                (node, pos) = frame
+                if pos < offsets[node + 1]:
+                    frame[1] = pos + 1
+                    tgt = targets[pos]
+                    if not visited[tgt]:
+                        visited[tgt] = 1
+                        work.append([ tgt, offsets[tgt] ])
+                else:
+                    work.pop()
+                    postorder.append(node)
+        order = postorder[::-1]
+
+        rank = array.array('l', [ -1 ]) * (root + 1)
+        rank[root] = 0
+        for (pos, node) in enumerate(order, 1):
+            rank[node] = pos
+        idom = array.array('l', [ -1 ]) * (root + 1)
+        idom[root] = root
+        for seed in seeds:
+            idom[seed] = root
+
+        changed = True
+        while changed:
+            changed = False
+            for node in order:
+                if idom[node] == root:
+                    continue
+                best = -1
+                for pred in sources[revOffsets[node]:revOffsets[node+1]]:
+                    if idom[pred] < 0:
+                        continue
+                    if best < 0:
+                        best = pred
+                        continue
+                    while pred != best:
+                        while rank[pred] > rank[best]:
+                            pred = idom[pred]
+                        while rank[best] > rank[pred]:
+                            best = idom[best]
+                if idom[node] != best:
+                    idom[node] = best
+                    changed = True
+
+        return (order, { node: (idom[node] if idom[node] != root else None)
+                            for node in order })
+
+    def _getEdges(self, epochs):
+        return self._getCached(self._epochs, epochs, self._buildEdges)
+
+    def _getCached(self, cache, epochs, builder):
+        key = (epochs,) if isinstance(epochs, str) \
+                        else tuple(sorted(set(epochs)))
+        value = cache.get(key)
+        if value is None:
+            with self._lock:
+                value = cache.get(key)
+                if value is None:
+                    value = builder(key)
+                    cache[key] = value
+        return value
+
+    def _groupMembers(self, epochs):
+        """Construct lists of the package indices within each component"""
+        (component, ncomponents) = self.Components(epochs)
+        members = [ [] for comp in range(ncomponents) ]
+        for (idx, comp) in enumerate(component):
+            members[comp].append(idx)
+        return members
+
+    def _findComponents(self, epoch):
+        """Apply Tarjan's algorithm, without recursion,
+        to find strongly connected components of the dependency graph"""
+        (offsets, targets) = self._getEdges(epoch)[0]
+        npkgs = len(self._names)
+        order = array.array('l', [ -1 ]) * npkgs
+        lowlink = array.array('l', [ 0 ]) * npkgs
+        component = array.array('l', [ -1 ]) * npkgs
+        onstack = bytearray(npkgs)
+        stack = []
+        (counter, ncomponents) = (0, 0)
+
+        for root in range(npkgs):
+            if order[root] >= 0:
+                continue
+            order[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            onstack[root] = 1
+            work = [ [ root, offsets[root] ] ]
+
+            while work:
+                frame = work[-1]
+                (node, pos) = frame
+                if pos < offsets[node + 1]:
+                    frame[1] = pos + 1
+                    tgt = targets[pos]
+                    if order[tgt] < 0:
+                        order[tgt] = lowlink[tgt] = counter
+                        counter += 1
+                        stack.append(tgt)
+                        onstack[tgt] = 1
+                        work.append([ tgt, offsets[tgt] ])
+                    elif onstack[tgt] and order[tgt] < lowlink[node]:
+                        lowlink[node] = order[tgt]
+                    continue
+
+                work.pop()
+                if work and lowlink[node] < lowlink[work[-1][0]]:
+                    lowlink[work[-1][0]] = lowlink[node]
+                if lowlink[node] == order[node]:
+                    while True:
+                        member = stack.pop()
+                        onstack[member] = 0
+                        component[member] = ncomponents
+                        if member == node:
+                            break
+                    ncomponents += 1
+
+        return (component, ncomponents)
+
+    def _buildEdges(self, epochs):
+        """Construct forward and reverse adjacency arrays for a set of epochs"""
+        npkgs = len(self._names)
+        offsets = array.array('l', [ 0 ])
+        targets = array.array('l')
+        unresolved = {}
+
+        for (idx, name) in enumerate(self._names):
+            deps = set()
+            for epoch in epochs:
+                try:
+                    deps.update(self._pkgdict[name].GetDependencies([epoch]))
+                except Exception:
+                    pass
+            for dep in sorted(deps):
+                tgt = self._ids.get(dep)
+                if tgt is None:
+                    unresolved.setdefault(idx, []).append(dep)
+                else:
+                    targets.append(tgt)
+            offsets.append(len(targets))
+
+        # Invert the graph via a counting sort on the target indices:
+        revOffsets = array.array('l', [ 0 ]) * (npkgs + 1)
+        for tgt in targets:
+            revOffsets[tgt + 1] += 1
+        for idx in range(npkgs):
+            revOffsets[idx + 1] += revOffsets[idx]
+        sources = array.array('l', [ 0 ]) * len(targets)
+        fill = revOffsets[:-1]
+        for idx in range(npkgs):
+            for tgt in targets[offsets[idx]:offsets[idx+1]]:
+                sources[fill[tgt]] = idx
+                fill[tgt] += 1
+
+        return ((offsets, targets), (revOffsets, sources), unresolved)
 
 
 
 class MasterPackageList(BuildReporter):
     """Database of available Cygwin packages built from 'setup.ini' file"""
 
-    RE_DBline = re.compile(r'''
-          ((?P<relinfo>^(release|arch|setup-\S+)) :
-                                \s+ (?P<relParam>\S+) $)
-        | (?P<comment>\# .* $)
-        | (?P<package>^@ \s+ (?P<pkgName> \S+) $)
-        | (?P<epoch>^\[ (?P<epochName>[a-z]+) \] $)
-        | ((?P<field>^[a-zA-Z][-a-zA-Z0-9]+) : \s+ (?P<fieldVal> .*) $)
-        | (?P<blank>^\s* $)
-        ''', re.VERBOSE)
+    # Characters permitted within names of fields within setup.ini:
+    FieldChars = frozenset(string.ascii_letters + string.digits + '-')
+    EpochChars = frozenset(string.ascii_lowercase)
+    HeaderFields = frozenset([ 'release', 'arch' ])
 
     RE_RSTRIP = re.compile(r'\s+$')
+    RE_PKGSTART = re.compile(r'@[^\S\n]+(\S+)$', re.MULTILINE)
 
-    def __init__(self, iniURL=None, Viewer=None):
+    # Format of binary snapshots of parsed setup.ini:
+    SnapshotSuffix = '.snapshot'
+    SnapshotVersion = 5
+
+    def __init__(self, iniURL=None, Viewer=None, ConnPool=None,
+                 CacheDir=None, Lazy=False, Workers=1):
         BuildReporter.__init__(self, Viewer)
 
+        self._connPool = ConnPool
+        self._cacheDir = CacheDir
+        self._lazy = Lazy
+        self._workers = Workers
+        self._fieldNames: set = set()
         self._pkgLock = threading.Lock()
+        self._parseLock = threading.RLock()
         self._iniURL = None
         self.ClearCache()
         self.SetSourceURL(iniURL)
@@ -1170,6 +2788,12 @@ class MasterPackageList(BuildReporter):
             self._pkgLock.acquire()
             self._ini_header = None
             self._ini_packages = None
+            self._blockDigests = {}
+            self._previous = None
+            self._changes = None
+            self._categories = None
+            self._staleCategories = None
+            self._graph = None
         finally:
             self._pkgLock.release()
 
@@ -1177,10 +2801,32 @@ class MasterPackageList(BuildReporter):
         return self._iniURL
 
     def SetSourceURL(self, iniURL=None, reload=False):
+        """Set the location of setup.ini, retaining any package information
+        which can be reused if the index is only partially changed"""
         if reload or iniURL != self._iniURL:
-            self.ClearCache()
+            self._retainBlocks()
         self._iniURL = iniURL
 
+    def GetChangedPackages(self):
+        """Find the names of packages added, removed or modified
+        when setup.ini was last reloaded, or None if unknown"""
+        self._ingest()
+        return self._changes
+
+    def SetLazy(self, lazy=True):
+        """Choose whether packages should only be parsed on first use"""
+        if lazy != self._lazy:
+            self.ClearCache()
+        self._lazy = lazy
+
+    def SetParseWorkers(self, workers=1):
+        """Set the number of processes amongst which parsing is shared"""
+        self._workers = max(1, workers)
+
+    def SetCacheDir(self, cacheDir=None):
+        """Set the directory in which to cache copies of setup.ini"""
+        self._cacheDir = cacheDir
+
     def GetHeaderInfo(self):
         self._ingest()
         return self._ini_header
@@ -1200,21 +2846,44 @@ class MasterPackageList(BuildReporter):
         """Construct lists of packages grouped into categories"""
 
         pkgdict = self.GetPackageDict()
-        allpkgs = []
-        catlists = {}
+        members = self._categories
+
+        if members is None:
+            (members, self._staleCategories) = (self._staleCategories, None)
+            if members is not None and self._changes is not None:
+                # Only revise the categories of packages which have changed:
+                changed = self._changes
+                for ctg in list(members):
+                    members[ctg].difference_update(changed)
+                    if not members[ctg]:
+                        del members[ctg]
+                self._classifyPackages(members, pkgdict,
+                                       changed.intersection(pkgdict))
+            else:
+                members = {}
+                self._classifyPackages(members, pkgdict, pkgdict)
+            self._categories = members
 
-        for pkg, pkginfo in pkgdict.items():
-            allpkgs.append(pkg)
+        catlists = { ctg: sorted(pkgs) for (ctg, pkgs) in members.items() }
+        catlists['All'] = sorted(pkgdict)
 
-            cats = pkginfo.GetAny('category').split()
-            for ctg in cats:
-                catlists.setdefault(ctg, []).append(pkg)
+        return catlists
 
-        catlists['All'] = allpkgs
-        for cats in catlists.values():
-            cats.sort()
+    def GetDependencyGraph(self):
+        """Find the graph of dependencies between all available packages"""
+        pkgdict = self.GetPackageDict()
+        graph = self._graph
+        if graph is None:
+            graph = DependencyGraph(pkgdict)
+            self._graph = graph
+        return graph
 
-        return catlists
+    @staticmethod
+    def _classifyPackages(members, pkgdict, pkgnames):
+        for pkg in pkgnames:
+            cats = pkgdict[pkg].GetAny('category').split()
+            for ctg in cats:
+                members.setdefault(ctg, set()).add(pkg)
 
     def _ingest(self):
         try:
@@ -1224,6 +2893,7 @@ class MasterPackageList(BuildReporter):
             self._statview.startOperation('Scanning mirror index at {0:s}' \
                                             .format(self._iniURL))
             self._parseSource()
+            self._noteChanges()
             self._statview.endOperation('done')
         finally:
             self._statview.flushOperation()
@@ -1237,14 +2907,120 @@ class MasterPackageList(BuildReporter):
         """
         self._ini_header = {}
         self._ini_packages = {}
+        self._blockDigests = {}
 
         try:
-            fp = SetupIniFetcher(self._iniURL)
+            fp = SetupIniFetcher(self._iniURL, pool=self._connPool,
+                                 cacheDir=self._cacheDir)
         except Exception as ex:
             raise PMCygException("Failed to open {0:s} - {1:s}" \
                                     .format(self._iniURL, str(ex)))
 
-        lineno = 0
+        snapshot = None
+        if self._cacheDir and SetupIniFetcher.IsCacheable(self._iniURL):
+            snapshot = SetupIniFetcher.CachePaths(self._cacheDir,
+                                                  self._iniURL)[0] \
+                        + self.SnapshotSuffix
+            # The snapshot can only be validated in advance of parsing
+            # if setup.ini is available from the local cache,
+            # rather than being streamed:
+            if os.path.isfile(snapshot):
+                digest = fp.LocalDigest()
+                if digest and self._loadSnapshot(snapshot, digest):
+                    fp.close()
+                    return
+
+        with self._parseLock:
+            if self._lazy:
+                iniText = self._scanPackages(fp)
+            elif self._previous:
+                iniText = None
+                self._parseIncremental(fp.ReadText())
+            elif self._workers > 1:
+                iniText = None
+                self._parseParallel(fp.ReadText())
+            else:
+                iniText = None
+                self._resetParser()
+                for (lineno, line) in enumerate(fp, 1):
+                    self._ingestLine(line, lineno)
+                self._finalizePackage()
+            fp.close()
+
+        if snapshot and fp.digest:
+            self._saveSnapshot(snapshot, fp.digest, iniText)
+
+    def _retainBlocks(self):
+        """Discard package information, but retain the descriptions of
+        individual packages for reuse by the next ingest of setup.ini
+
+        Information derived from the set of packages is discarded,
+        except that the categories are retained for incremental revision
+        once the packages which have changed are known."""
+        try:
+            self._pkgLock.acquire()
+            if self._ini_packages and self._blockDigests:
+                self._previous = (self._ini_packages, self._blockDigests)
+                self._staleCategories = self._categories
+            self._ini_header = None
+            self._ini_packages = None
+            self._blockDigests = {}
+            self._changes = None
+            self._categories = None
+            self._graph = None
+        finally:
+            self._pkgLock.release()
+
+    def _noteChanges(self):
+        """Record which packages differ from those of the previous ingest"""
+        if not self._previous:
+            self._changes = None
+            return
+        (packages, digests) = self._previous
+        self._previous = None
+        if not self._blockDigests:
+            self._changes = None
+            return
+        changed = set(pkg for (pkg, digest) in self._blockDigests.items()
+                        if digests.get(pkg) != digest)
+        changed.update(pkg for pkg in packages
+                        if pkg not in self._ini_packages)
+        self._changes = changed
+
+    def _parseIncremental(self, text):
+        """Parse setup.ini, reusing the descriptions of any packages
+        whose text is unchanged since the previous ingest"""
+        (packages, digests) = self._previous
+        reusable = { digest: pkg for (pkg, digest) in digests.items() }
+        starts = self._findPackages(text)
+
+        self._resetParser()
+        header = text[:starts[0][0]] if starts else text
+        for (lineno, line) in enumerate(io.StringIO(header), 1):
+            self._ingestLine(line, lineno)
+
+        ends = [ start for (start, pkgname) in starts[1:] ] + [ len(text) ]
+        (lineno, prev) = (1, 0)
+        for ((start, pkgname), end) in zip(starts, ends):
+            block = text[start:end]
+            lineno += text.count('\n', prev, start)
+            prev = start
+            digest = self._blockDigest(block)
+            if reusable.get(digest) == pkgname:
+                pkgdict = packages[pkgname]
+            else:
+                pkgdict = self._parsePackageText(block, lineno)
+                pkgdict.Set('TEXT', self.RE_RSTRIP.sub('', block))
+            self._ini_packages[pkgname] = pkgdict
+            self._blockDigests[pkgname] = digest
+
+    @staticmethod
+    def _blockDigest(block):
+        return hashlib.blake2b(block.encode(SI_TEXT_ENCODING),
+                               digest_size=16).digest()
+
+    def _resetParser(self):
+        self._fieldNames = set()
         self._pkgname = None
         self._pkgtxt = []
         self._pkgdict = PackageSummary()
@@ -1253,19 +3029,224 @@ class MasterPackageList(BuildReporter):
         self._fieldlines = None
         self._inquote = False
 
-        for line in fp:
-            lineno += 1
+    def _ingestLine(self, line, lineno=None):
+        if self._inquote and self._fieldname:
+            self._ingestQuotedLine(line)
+        else:
+            self._ingestOrdinaryLine(line, lineno=lineno)
+
+        if self._pkgname:
+            self._pkgtxt.append(line)
+
+    def _findPackages(self, text):
+        """Find the offset and name of each package within setup.ini
+
+        Apparent package headers within multi-line quotations are ignored,
+        with quotations being tracked in the same way as by _ingestLine(),
+        such that a quotation only ends on a line ending with a quote."""
+        starts = []
+        candidates = list(self._lineStarts(text, '@'))
+        idx = 0
+        pos = 0
+
+        while True:
+            quote = text.find('"', pos)
+            linestart = (text.rfind('\n', 0, quote) + 1) if quote >= 0 \
+                            else len(text)
+            while idx < len(candidates) and candidates[idx] <= linestart:
+                match = self.RE_PKGSTART.match(text, candidates[idx])
+                if match:
+                    starts.append((candidates[idx], match.group(1)))
+                idx += 1
+            if quote < 0:
+                break
+
+            pos = self._lineEnd(text, quote) + 1
+            if not self._opensQuote(text[linestart:(pos - 1)]):
+                continue
+
+            # Skip to the line on which the quotation ends:
+            while pos < len(text):
+                quote = text.find('"', pos)
+                if quote < 0:
+                    pos = len(text)
+                    break
+                linestart = text.rfind('\n', 0, quote) + 1
+                pos = self._lineEnd(text, quote) + 1
+                if text[linestart:(pos - 1)].rstrip().endswith('"'):
+                    break
+            idx = bisect.bisect_left(candidates, pos)
+
+        return starts
+
+    @staticmethod
+    def _lineEnd(text, pos):
+        end = text.find('\n', pos)
+        return end if end >= 0 else len(text)
+
+    def _opensQuote(self, line):
+        """Determine whether a line outside any quotation starts
+        a multi-line quoted value, in the manner of _ingestOrdinaryLine()"""
+        if not line[:1].isalpha():
+            return False
+        (name, colon, value) = line.partition(':')
+        value = value.lstrip().rstrip('\n')
+        if name in self.HeaderFields \
+                or (name.startswith('setup-') and len(name) > 6):
+            if value.split() == [ value ] and name.split() == [ name ]:
+                return False
+        quotepos = value.find('"')
+        if quotepos < 0:
+            return False
+        elif quotepos == 0:
+            return not value[1:].endswith('"')
+        else:
+            return not value[(quotepos + 2):].endswith('"')
 
-            if self._inquote and self._fieldname:
-                self._ingestQuotedLine(line)
+    @staticmethod
+    def _lineStarts(text, lead):
+        """Find the offsets of all lines starting with a given character"""
+        if text.startswith(lead):
+            yield 0
+        pos = text.find('\n' + lead)
+        while pos >= 0:
+            yield pos + 1
+            pos = text.find('\n' + lead, pos + 1)
+
+    def _scanPackages(self, fp):
+        """Locate the text of each package within setup.ini,
+        deferring the parsing of its fields until they are first needed"""
+        iniText = SetupIniText(fp.ReadText(), self._parsePackageText)
+        text = iniText.text
+        starts = self._findPackages(text)
+
+        self._resetParser()
+        header = text[:starts[0][0]] if starts else text
+        for (lineno, line) in enumerate(io.StringIO(header), 1):
+            self._ingestLine(line, lineno)
+
+        ends = [ start for (start, pkgname) in starts[1:] ] + [ len(text) ]
+        for ((start, pkgname), end) in zip(starts, ends):
+            self._ini_packages[pkgname] = LazyPackageSummary(iniText,
+                                                             start, end)
+        return iniText
+
+    def _parsePackageText(self, text, firstLine=None):
+        """Parse the fields of a single package from its text within setup.ini,
+        optionally given the number of its first line, for error reports"""
+        lines = io.StringIO(text)
+        with self._parseLock:
+            self._resetParser()
+            if firstLine is None:
+                for line in lines:
+                    self._ingestLine(line)
             else:
-                self._ingestOrdinaryLine(line, lineno=lineno)
+                for (lineno, line) in enumerate(lines, firstLine):
+                    self._ingestLine(line, lineno)
+            pkgdict = self._pkgdict
+            self._resetParser()
+        return pkgdict
+
+    def _parseParallel(self, text):
+        """Parse setup.ini within a pool of processes, after dividing
+        it into chunks of similar size at package boundaries"""
+        offsets = [ start for (start, pkgname) in self._findPackages(text) ]
+        bounds = [ 0 ]
+        for chunk in range(1, self._workers):
+            idx = bisect.bisect_left(offsets,
+                                     chunk * len(text) // self._workers)
+            if idx < len(offsets) and offsets[idx] > bounds[-1]:
+                bounds.append(offsets[idx])
+        bounds.append(len(text))
+
+        chunks = []
+        lineno = 1
+        for (start, end) in zip(bounds[:-1], bounds[1:]):
+            chunks.append((text[start:end], lineno))
+            lineno += text.count('\n', start, end)
+
+        with concurrent.futures.ProcessPoolExecutor(len(chunks)) as pool:
+            for (header, fields, packages) in pool.map(self._parseChunk,
+                                                       *zip(*chunks)):
+                self._ini_header.update(header)
+                mapping = PackageSummary._fieldMapping(fields)
+                for (pkgname, epochs, arrays, extra, digest) in packages:
+                    self._ini_packages[pkgname] = \
+                        PackageSummary._fromArrays(epochs, arrays,
+                                                   mapping, extra)
+                    self._blockDigests[pkgname] = digest
 
-            if self._pkgname:
-                self._pkgtxt.append(line)
-        fp.close()
+    @staticmethod
+    def _parseChunk(text, firstLine=1):
+        """Parse a portion of setup.ini, starting at a package boundary"""
+        pkglist = MasterPackageList(Viewer=SilentBuildViewer())
+        pkglist._ini_header = {}
+        pkglist._ini_packages = {}
+        pkglist._blockDigests = {}
+        pkglist._resetParser()
+        for (lineno, line) in enumerate(io.StringIO(text), firstLine):
+            pkglist._ingestLine(line, lineno)
+        pkglist._finalizePackage()
+        # Plain lists are much faster to transfer than PackageSummary objects:
+        return (pkglist._ini_header, list(PackageSummary._fieldNames),
+                [ (pkgname, info._epochs, info._arrays, info._extra,
+                   pkglist._blockDigests[pkgname])
+                    for (pkgname, info) in pkglist._ini_packages.items() ])
+
+    def _loadSnapshot(self, path, digest) -> bool:
+        """Attempt to restore parsed package information from
+        a snapshot of an identical (decompressed) setup.ini
+
+        Snapshots contain only plain strings, tuples, lists and
+        dictionaries, so that, unlike pickle, reading a snapshot
+        cannot cause arbitrary code to be executed."""
+        try:
+            with open(path, 'rb') as fp:
+                (version, key, lazy, header, fields, packages,
+                 text, blockDigests) = marshal.load(fp)
+            if version != self.SnapshotVersion or key != digest \
+                    or lazy != self._lazy:
+                return False
+
+            if lazy:
+                iniText = SetupIniText(text, self._parsePackageText)
+                pkgdict = { pkgname: LazyPackageSummary(iniText, start, end)
+                            for (pkgname, start, end) in packages }
+            else:
+                mapping = PackageSummary._fieldMapping(fields)
+                pkgdict = { pkgname: PackageSummary._fromArrays(epochs,
+                                                    arrays, mapping, extra)
+                            for (pkgname, epochs, arrays, extra) in packages }
+        except Exception:
+            return False
 
-        self._finalizePackage()
+        (self._ini_header, self._ini_packages) = (dict(header), pkgdict)
+        self._blockDigests = dict(blockDigests)
+        return True
+
+    def _saveSnapshot(self, path, digest, iniText=None) -> None:
+        """Record parsed package information, keyed on
+        the hash-code of the decompressed setup.ini"""
+        if iniText:
+            packages = [ (pkgname, info._start, info._end)
+                            for (pkgname, info) in self._ini_packages.items() ]
+            text = iniText.text
+        else:
+            packages = [ (pkgname, info._epochs,
+                          [ list(array) for array in info._arrays ],
+                          info._extra)
+                            for (pkgname, info) in self._ini_packages.items() ]
+            text = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as fp:
+                marshal.dump((self.SnapshotVersion, digest, self._lazy,
+                              self._ini_header,
+                              list(PackageSummary._fieldNames), packages,
+                              text, self._blockDigests), fp)
+            os.replace(path + '.tmp', path)
+        except (OSError, ValueError):
+            pass
 
     def _ingestQuotedLine(self, line):
         trimmed = line.rstrip()
@@ -1279,57 +3260,88 @@ class MasterPackageList(BuildReporter):
             self._fieldlines.append(trimmed)
 
     def _ingestOrdinaryLine(self, line, lineno=None):
-        """Classify current line as package definition/field etc"""
-        matches = self.RE_DBline.match(line)
-        if not matches:
-            raise SyntaxError("Unrecognized content on line {0:d}" \
-                                .format(lineno))
-
-        if matches.group('relinfo'):
-            self._ini_header[matches.group('relinfo')] = matches.group('relParam')
-        elif matches.group('comment'):
-            pass
-        elif matches.group('package'):
+        """Classify current line as package definition/field etc
+
+        Lines are classified by their first character,
+        which is much faster than general regular-expression matching."""
+        lead = line[:1]
+
+        if lead.isalpha():
+            (name, colon, value) = line.partition(':')
+            if not value[:1].isspace() or len(name) < 2:
+                self._rejectLine(lineno)
+            value = value.lstrip().rstrip('\n')
+
+            if name in self._fieldNames:
+                self._ingestField(name, value)
+            elif name in self.HeaderFields \
+                    or (name.startswith('setup-') and len(name) > 6):
+                if value.split() == [ value ] and name.split() == [ name ]:
+                    self._ini_header[name] = value
+                elif self.FieldChars.issuperset(name):
+                    self._ingestField(name, value)
+                else:
+                    self._rejectLine(lineno)
+            elif self.FieldChars.issuperset(name):
+                self._fieldNames.add(name)
+                self._ingestField(name, value)
+            else:
+                self._rejectLine(lineno)
+        elif lead == '@':
+            pkgname = line[1:]
+            if pkgname.endswith('\n'):
+                pkgname = pkgname[:-1]
+            if not pkgname[:1].isspace():
+                self._rejectLine(lineno)
+            pkgname = pkgname.lstrip()
+            if pkgname.split() != [ pkgname ]:
+                self._rejectLine(lineno)
             self._finalizePackage()
 
-            self._pkgname = matches.group('pkgName')
+            self._pkgname = pkgname
             self._epoch = 'curr'
             self._fieldname = None
-        elif matches.group('epoch'):
-            self._epoch = matches.group('epochName')
-        elif matches.group('field'):
-            self._fieldname = matches.group('field')
-            self._fieldtext = matches.group('fieldVal')
-            quotepos = self._fieldtext.find('"')
-            if quotepos < 0:
-                # Field value appears without quotation marks on single line:
-                self._pkgdict.Set(self._fieldname,
-                                    self._fieldtext, self._epoch)
-            if quotepos >= 0:
-                if quotepos > 0:
-                    # Field value contains additional metadata prefix:
-                    prefix = self._fieldtext[0:quotepos].strip()
-                    self._fieldname += '_' + prefix
-                    self._fieldtext = self._fieldtext[(quotepos+1):]
-                if self._fieldtext[1:].endswith('"'):
-                    # Quoted string starts and ends on current line:
-                    self._pkgdict.Set(self._fieldname,
-                                        self._fieldtext[1:-1], self._epoch)
-                else:
-                    # Quoted string starts on current line, presumably ending later:
-                    self._fieldlines = [ self._fieldtext[1:] ]
-                    self._inquote = True
-
-            if self._fieldtext.startswith('"'):
-                if self._fieldtext[1:].endswith('"'):
-                    self._pkgdict.Set(self._fieldname,
-                                        self._fieldtext[1:-1], self._epoch)
-                else:
-                    self._fieldlines = [ self._fieldtext[1:] ]
-                    self._inquote = True
+        elif lead == '[':
+            epoch = line[:-1] if line.endswith('\n') else line
+            epoch = epoch[1:-1] if epoch.endswith(']') else ''
+            if not epoch or not self.EpochChars.issuperset(epoch):
+                self._rejectLine(lineno)
+            self._epoch = epoch
+        elif lead == '#':
+            pass
+        elif not line.isspace() and line:
+            self._rejectLine(lineno)
+
+    @staticmethod
+    def _rejectLine(lineno):
+        raise SyntaxError("Unrecognized content on line {0:d}" \
+                            .format(lineno or 0))
+
+    def _ingestField(self, fieldname, fieldtext):
+        """Record value of field, or start of multi-line quoted value"""
+        self._fieldname = fieldname
+        self._fieldtext = fieldtext
+        quotepos = fieldtext.find('"')
+        if quotepos < 0:
+            # Field value appears without quotation marks on single line:
+            self._pkgdict.Set(fieldname, fieldtext, self._epoch)
+        elif quotepos == 0:
+            if fieldtext[1:].endswith('"'):
+                # Quoted string starts and ends on current line:
+                self._pkgdict.Set(fieldname, fieldtext[1:-1], self._epoch)
             else:
-                self._pkgdict.Set(self._fieldname,
-                                    self._fieldtext, self._epoch)
+                # Quoted string starts on current line, presumably ending later:
+                self._fieldlines = [ fieldtext[1:] ]
+                self._inquote = True
+        else:
+            # Field value contains additional metadata prefix:
+            prefix = fieldtext[0:quotepos].strip()
+            self._fieldname += '_' + prefix
+            self._fieldtext = fieldtext[(quotepos+1):]
+            if not self._fieldtext[1:].endswith('"'):
+                self._fieldlines = [ self._fieldtext[1:] ]
+                self._inquote = True
+            self._pkgdict.Set(self._fieldname, self._fieldtext, self._epoch)
 
     def _finalizePackage(self):
         """Final assembly of text & field records describing single package"""
@@ -1337,8 +3349,10 @@ class MasterPackageList(BuildReporter):
         if not self._pkgname:
             return
 
-        self._pkgdict.Set('TEXT', self.RE_RSTRIP.sub('', ''.join(self._pkgtxt)))
+        block = ''.join(self._pkgtxt)
+        self._pkgdict.Set('TEXT', self.RE_RSTRIP.sub('', block))
         self._ini_packages[self._pkgname] = self._pkgdict
+        self._blockDigests[self._pkgname] = self._blockDigest(block)
 
         self._pkgname = None
         self._pkgtxt = []
@@ -1348,11 +3362,35 @@ class MasterPackageList(BuildReporter):
 
 class PackageSummary:
     """Dictionary-like container of package information,
-    specialized to cope with multiple epochs"""
+    specialized to cope with multiple epochs
+
+    To economize on memory, field names are mapped onto indices
+    shared by all packages, and field values are stored within
+    one array per epoch, indexed by those field indices.
+    Fields qualified by a prefix (e.g. "message_<id>"), whose names
+    are often unique to a single package, are instead held within
+    a small dictionary, so that they do not enlarge the shared table.
+    """
+    __slots__ = ('_epochs', '_arrays', '_deps', '_extra')
+
+    _fieldIndices: dict = {}
+    _fieldNames: list = []
+    _fieldLock = threading.Lock()
 
     def __init__(self):
-        self._pkginfo = {}
-        self._epochs = set()
+        self._epochs: tuple = ()
+        self._arrays: tuple = ()
+        self._deps = None
+        self._extra = None
+
+    def __getstate__(self):
+        # Field indices are specific to each process, so pickle by name:
+        return tuple(self.Items())
+
+    def __setstate__(self, state):
+        PackageSummary.__init__(self)
+        for ((field, epoch), value) in state:
+            PackageSummary.Set(self, field, value, epoch)
 
     def GetAny(self, field, epochset=[]):
         """Lookup the value of a particular field for a set of possible epochs.
@@ -1366,8 +3404,11 @@ class PackageSummary:
         if not None in epochset:
             epochset = list(epochset)
             epochset.append(None)
+        idx = self._fieldIndices.get(field)
+        if idx is None and not self._extra:
+            return None
         for epoch in epochset:
-            value = self._pkginfo.get((field, epoch), None)
+            value = self._lookup(idx, epoch, field)
             if value: break
         return value
 
@@ -1377,11 +3418,28 @@ class PackageSummary:
         values = []
         if not epochset:
             epochset = self._epochs
+        idx = self._fieldIndices.get(field)
+        if idx is None and not self._extra:
+            return values
         for epoch in epochset:
-            val = self._pkginfo.get((field, epoch), None)
+            val = self._lookup(idx, epoch, field)
             if val: values.append(val)
         return values
 
+    def Items(self):
+        """Iterate over all ((field, epoch), value) records"""
+        names = self._fieldNames
+        for (epoch, array) in zip(self._epochs, self._arrays):
+            for (idx, value) in enumerate(array):
+                if value is not None:
+                    yield ((names[idx], epoch), value)
+        if self._extra:
+            yield from self._extra.items()
+
+    def HasEpoch(self, epoch) -> bool:
+        """Determine whether any fields are recorded for the given epoch"""
+        return epoch in self._epochs
+
     def HasFileContent(self):
         """Determine whether package has non-empty binary or source file"""
         for variant in ('install', 'source'):
@@ -1403,20 +3461,518 @@ class PackageSummary:
             return True
         return False
 
-    def GetDependencies(self, epochset=[]):
-        """Return a list of other packages on which this package depends."""
-        all_deps = []
-        deps, reqs = ( self.GetAny(f) for f in ('depends2', 'requires') )
+    def GetDependencies(self, epochset=None):
+        """Return a list of other packages on which this package depends,
+        within any of the supplied epochs (by default the current epoch)."""
+        epochs = tuple(epochset) if epochset else ( 'curr', )
+        if len(epochs) == 1:
+            return list(self._epochDependencies(epochs[0]))
+        all_deps = set()
+        for epoch in epochs:
+            all_deps.update(self._epochDependencies(epoch))
+        return sorted(all_deps)
+
+    def GetText(self):
+        """Find the original text describing the package within setup.ini"""
+        return self.GetAny('TEXT')
+
+    def Set(self, field, value, epoch=None):
+        """Record field=value for a particular epoch (e.g. curr/prev/None)"""
+        array = self._epochArray(epoch)
+        if self._isQualified(field):
+            if self._extra is None:
+                self._extra = {}
+            self._extra[(field, epoch)] = value
+        else:
+            self._store(array, field, value)
+        self._deps = None
+
+    def _epochDependencies(self, epoch):
+        """Find the sorted tuple of dependencies within a single epoch,
+        which is parsed from the package's fields only once"""
+        deps = self._deps.get(epoch) if self._deps else None
+        if deps is not None:
+            return deps
+
+        all_deps = set()
+        deps, reqs = ( self.GetAny(f, [epoch])
+                        for f in ('depends2', 'requires') )
         if deps:
-            all_deps.extend(x.strip() for x in deps.split(','))
+            all_deps.update(x.strip() for x in deps.split(','))
         if reqs:
-            all_deps.extend(x.split())
-        return sorted(set(all_deps))
+            all_deps.update(reqs.split())
+        all_deps.discard('')
+        deps = tuple(sorted(all_deps))
+
+        if self._deps is None:
+            self._deps = {}
+        self._deps[epoch] = deps
+        return deps
+
+    def _lookup(self, idx, epoch, field=None):
+        if idx is None:
+            return self._extra.get((field, epoch)) if self._extra else None
+        try:
+            return self._arrays[self._epochs.index(epoch)][idx]
+        except (ValueError, IndexError):
+            return None
+
+    def _epochArray(self, epoch):
+        """Find, or create, the array of field values for an epoch"""
+        try:
+            return self._arrays[self._epochs.index(epoch)]
+        except ValueError:
+            array: list = []
+            self._epochs += (sys.intern(epoch) if epoch else epoch,)
+            self._arrays += (array,)
+            return array
+
+    @classmethod
+    def _fromArrays(cls, epochs, arrays, mapping=None, extra=None):
+        """Construct from field arrays, possibly from another process"""
+        info = cls()
+        info._extra = extra or None
+        if mapping is None:
+            (info._epochs, info._arrays) = (tuple(epochs), tuple(arrays))
+            return info
+        for (epoch, array) in zip(epochs, arrays):
+            local = info._epochArray(epoch)
+            for (idx, value) in enumerate(array):
+                if value is not None:
+                    pos = mapping[idx]
+                    if pos >= len(local):
+                        local.extend([ None ] * (pos + 1 - len(local)))
+                    local[pos] = value
+        return info
+
+    @classmethod
+    def _fieldMapping(cls, names):
+        """Translate field indices used by another process into local indices,
+        or None if these are identical"""
+        indices = [ cls._fieldIndex(name) for name in names ]
+        if indices == list(range(len(names))):
+            return None
+        return indices
+
+    @staticmethod
+    def _isQualified(field):
+        """Check whether a field name includes a prefix, such as within
+        "message_<id>", given that setup.ini itself never uses underscores"""
+        return '_' in field
+
+    @classmethod
+    def _fieldIndex(cls, field):
+        idx = cls._fieldIndices.get(field)
+        if idx is None:
+            with cls._fieldLock:
+                idx = cls._fieldIndices.get(field)
+                if idx is None:
+                    idx = len(cls._fieldNames)
+                    cls._fieldNames.append(sys.intern(field))
+                    cls._fieldIndices[cls._fieldNames[idx]] = idx
+        return idx
+
+    @classmethod
+    def _store(cls, array, field, value):
+        idx = cls._fieldIndex(field)
+        if idx >= len(array):
+            array.extend([ None ] * (idx + 1 - len(array)))
+        array[idx] = value
+
+
+class LazyPackageSummary(PackageSummary):
+    """Package information which is only parsed from setup.ini when needed
+
+    Until then, only the location of the package's text
+    within the shared SetupIniText is recorded.
+    """
+    __slots__ = ('_source', '_start', '_end')
+
+    def __init__(self, source, start: int, end: int):
+        self._source = source
+        self._start = start
+        self._end = end
+        self._epochs = None
+        self._arrays = None
+        self._deps = None
+        self._extra = None
+
+    def __getstate__(self):
+        return (self._source, self._start, self._end)
+
+    def __setstate__(self, state):
+        (self._source, self._start, self._end) = state
+        self._epochs = None
+        self._arrays = None
+        self._deps = None
+        self._extra = None
+
+    def GetAny(self, field, epochset=[]):
+        if self._epochs is None: self._parse()
+        return PackageSummary.GetAny(self, field, epochset)
+
+    def GetAll(self, field, epochset=[]):
+        if self._epochs is None: self._parse()
+        return PackageSummary.GetAll(self, field, epochset)
+
+    def HasEpoch(self, epoch):
+        if self._epochs is None: self._parse()
+        return PackageSummary.HasEpoch(self, epoch)
+
+    def HasFileContent(self):
+        if self._epochs is None: self._parse()
+        return PackageSummary.HasFileContent(self)
+
+    def Items(self):
+        if self._epochs is None: self._parse()
+        return PackageSummary.Items(self)
 
     def Set(self, field, value, epoch=None):
-        """Record field=value for a particular epoch (e.g. curr/prev/None)"""
-        self._pkginfo[(field, epoch)] = value
-        self._epochs.add(epoch)
+        if self._epochs is None: self._parse()
+        PackageSummary.Set(self, field, value, epoch)
+
+    def GetText(self):
+        return self._source.text[self._start:self._end].rstrip()
+
+    def _parse(self):
+        parsed = self._source.parser(self._source.text[self._start:self._end])
+        (self._arrays, self._epochs) = (parsed._arrays, parsed._epochs)
+        self._extra = parsed._extra
+        PackageSummary.Set(self, 'TEXT', self.GetText())
+
+
+class SetupIniText:
+    """Decoded text of an entire setup.ini, shared between the
+    LazyPackageSummary objects describing each of its packages"""
+    __slots__ = ('text', 'parser')
+
+    def __init__(self, text: str, parser=None):
+        self.text = text
+        self.parser = parser
+
+    def __getstate__(self):
+        return self.text
+
+    def __setstate__(self, text):
+        self.text = text
+        self.parser = None
+
+
+
+##
+## Retry scheduling
+##
+
+class RetryScheduler:
+    """Queue of pending downloads, shared between download workers,
+    in which each failed download is re-queued after an exponentially
+    increasing, randomized delay, while other downloads proceed.
+
+    Failures are classified by outcome code (e.g. PMbuilder.DL_HashError),
+    each of which may be given its own limit on the number of retries.
+    """
+    PollInterval = 0.25
+
+    def __init__(self, items, maxRetries: int=2, baseDelay: float=5.0,
+                 maxDelay: float=120.0, retryLimits: dict={},
+                 isCancelled=None) -> None:
+        self._cond = threading.Condition()
+        self._ready = collections.deque(items)
+        self._waiting: list = []
+        self._sequence = 0
+        self._active = 0
+        self._running: dict = {}
+        self._attempts: dict = {}
+        self._failures: dict = {}
+
+        self._maxRetries = maxRetries
+        self._baseDelay = baseDelay
+        self._maxDelay = maxDelay
+        self._retryLimits = dict(retryLimits)
+        self._isCancelled = isCancelled or (lambda: False)
+
+    def Next(self):
+        """Wait until a download is due, returning None once
+        all downloads have been settled, or downloading is cancelled"""
+        with self._cond:
+            while not self._isCancelled():
+                (item, delay) = self._poll()
+                if item is not None or delay is None:
+                    return item
+                self._cond.wait(min(delay, self.PollInterval))
+        return None
+
+    def Poll(self):
+        """Return (item, None) if a download is due, or (None, delay)
+        if one may become due later, or (None, None) if all are settled"""
+        with self._cond:
+            return self._poll()
+
+    def Succeeded(self, item) -> None:
+        with self._cond:
+            self._settle(item)
+            self._cond.notify_all()
+
+    def Failed(self, item, errclass: int):
+        """Record failure of a download, returning the delay
+        before it will be retried, or None if it has been abandoned"""
+        with self._cond:
+            self._settle(item)
+            self._failures[errclass] = self._failures.get(errclass, 0) + 1
+            attempts = self._attempts.get(item, 0) + 1
+            self._attempts[item] = attempts
+            self._cond.notify_all()
+
+            if attempts > self._retryLimits.get(errclass, self._maxRetries):
+                return None
+
+            delay = min(self._maxDelay,
+                        self._baseDelay * (1 << (attempts - 1)))
+            delay = 0.5 * delay * (1.0 + random.random())
+            heapq.heappush(self._waiting,
+                           (time.time() + delay, self._sequence, item))
+            self._sequence += 1
+            return delay
+
+    def Interrupted(self, item, errclass: int):
+        """Record failure of a download which was interrupted by
+        an unexpected exception, unless its outcome was already recorded
+        via Succeeded() or Failed(), so that other workers do not
+        wait indefinitely for it to be settled"""
+        with self._cond:
+            if item in self._running:
+                return self.Failed(item, errclass)
+        return None
+
+    def Attempts(self, item) -> int:
+        """Find the number of failed attempts to download an item"""
+        return self._attempts.get(item, 0)
+
+    def FailureCounts(self) -> dict:
+        """Find the number of failed attempts of each class"""
+        with self._cond:
+            return dict(self._failures)
+
+    def _poll(self):
+        now = time.time()
+        while self._waiting and self._waiting[0][0] <= now:
+            self._ready.append(heapq.heappop(self._waiting)[2])
+        if self._ready:
+            item = self._ready.popleft()
+            self._active += 1
+            self._running[item] = self._running.get(item, 0) + 1
+            return (item, None)
+        if self._waiting:
+            return (None, self._waiting[0][0] - now)
+        if self._active:
+            # Downloads still in progress may yet need to be retried:
+            return (None, self.PollInterval)
+        return (None, None)
+
+    def _settle(self, item) -> None:
+        self._active -= 1
+        count = self._running.pop(item, 0)
+        if count > 1:
+            self._running[item] = count - 1
+
+
+
+##
+## Multi-mirror downloading
+##
+
+class MirrorStriper:
+    """Allocation of package downloads across several mirror sites,
+    weighted by the throughput that each site has achieved so far.
+
+    Each new download is assigned to the mirror which is expected
+    to complete it soonest, given that mirror's outstanding workload.
+    All packages are still verified against the hash-codes within
+    the setup.ini obtained from the primary mirror.
+
+    A package which repeatedly fails on one mirror is retried on another,
+    if necessary drawing on a list of standby mirrors, and any mirror
+    whose recent error-rate is excessive is suspended by a circuit-breaker,
+    being retried only occasionally thereafter.
+    """
+    PriorBytes = 1 << 20        # Optimistic initial throughput estimate,
+    PriorSeconds = 1.0          # equivalent to 1MB/s over one second
+
+    BreakerWindow = 10          # Number of recent downloads, and minimum
+    BreakerMinimum = 4          # number, used to assess mirror error-rates
+    BreakerCooldown = 60.0      # Seconds before a suspended mirror is retried
+
+    def __init__(self, mirrors, fallbacks=None, failover: int=0,
+                 errorThreshold: float=1.0) -> None:
+        """Construct allocator for striping mirrors, optionally
+        with a function returning further mirrors in order of preference,
+        to which packages will be moved after 'failover' failures"""
+        self._lock = threading.Lock()
+        self._standbyLock = threading.Lock()
+        self._mirrors = list(mirrors)
+        self._standby = None
+        self._fallbacks = fallbacks
+        self._failover = failover
+        self._errorThreshold = errorThreshold
+        self._stats: dict = {}
+        self._fileFailures: dict = {}
+        for mirror in self._mirrors:
+            self._addMirror(mirror)
+
+    def __len__(self):
+        return len(self._mirrors)
+
+    def Mirrors(self):
+        return list(self._mirrors)
+
+    def SetPrimary(self, mirror: str) -> None:
+        """Replace the primary mirror, i.e. that from which setup.ini
+        is obtained, while retaining the other mirrors, and the record
+        of how reliably each mirror has performed"""
+        with self._lock:
+            others = [ m for m in self._mirrors[1:] if m != mirror ]
+            self._mirrors = [ mirror ] + others
+            if self._standby is not None and mirror in self._standby:
+                self._standby.remove(mirror)
+            self._addMirror(mirror)
+
+    def Acquire(self, size: int, key=None) -> str:
+        """Choose mirror from which to download a package of given size,
+        avoiding any on which the package identified by 'key' has failed"""
+        with self._lock:
+            now = time.time()
+            exhausted = not any(self._isUsable(m, key, now)
+                                    for m in self._mirrors)
+        if exhausted and self._standby is None:
+            self._resolveStandby()
+
+        with self._lock:
+            now = time.time()
+            usable = [ m for m in self._mirrors
+                            if self._isUsable(m, key, now) ]
+            if not usable:
+                usable = [ m for m in self._standby or []
+                                if self._isUsable(m, key, now) ][:1]
+            if not usable:
+                # All mirrors exhausted, so fall back to the least-bad:
+                usable = [ min(self._mirrors,
+                               key=lambda m: self._fileFailures.get((key, m),
+                                                                    0)) ]
+
+            best = min(usable,
+                       key=lambda m: ((self._stats[m]['pending'] + size)
+                                        / self.Throughput(m)))
+            stats = self._stats[best]
+            stats['pending'] += size
+            if stats['suspended'] is not None:
+                # Allow single trial download after cool-down period:
+                stats['suspended'] = now
+        return best
+
+    def Release(self, mirror: str, size: int, elapsed: float,
+                success=True, key=None, permanent: bool=False) -> bool:
+        """Record completion of download previously assigned by Acquire()
+
+        'success' may be None if no data were requested from the mirror,
+        and 'permanent' indicates that any failure is likely to recur
+        on the same mirror. Returns True if the mirror has just
+        been suspended by the circuit-breaker."""
+        with self._lock:
+            stats = self._stats[mirror]
+            stats['pending'] = max(0, stats['pending'] - size)
+            if success is None:
+                return False
+
+            if success:
+                stats['bytes'] += size
+                stats['seconds'] += elapsed
+                stats['successes'] += 1
+                if stats['suspended'] is not None:
+                    stats['suspended'] = None
+                    stats['recent'].clear()
+                stats['recent'].append(True)
+                return False
+
+            stats['failures'] += 1
+            stats['recent'].append(False)
+            if key is not None:
+                nfail = (self._failover if permanent
+                            else self._fileFailures.get((key, mirror), 0) + 1)
+                self._fileFailures[(key, mirror)] = nfail
+
+            recent = stats['recent']
+            if len(recent) >= self.BreakerMinimum \
+                    and (recent.count(False) / len(recent)
+                            >= self._errorThreshold):
+                newlyTripped = stats['suspended'] is None
+                stats['suspended'] = time.time()
+                return newlyTripped
+            return False
+
+    def Throughput(self, mirror: str) -> float:
+        """Estimate the throughput (in bytes/second) of a mirror site"""
+        stats = self._stats[mirror]
+        return ((stats['bytes'] + self.PriorBytes)
+                    / (stats['seconds'] + self.PriorSeconds))
+
+    def Usage(self):
+        """List volume of data and throughput achieved from each mirror"""
+        with self._lock:
+            return [ (mirror, self._stats[mirror]['bytes'],
+                      (self._stats[mirror]['bytes']
+                            / max(self._stats[mirror]['seconds'], 1e-3)))
+                     for mirror in self._mirrors ]
+
+    def Health(self):
+        """List numbers of successful and failed downloads from
+        each mirror that has been used, and whether it is now suspended"""
+        with self._lock:
+            return [ (mirror, stats['successes'], stats['failures'],
+                      stats['suspended'] is not None)
+                     for (mirror, stats) in self._stats.items()
+                        if mirror in self._mirrors
+                            or stats['successes'] or stats['failures'] ]
+
+    def _addMirror(self, mirror: str) -> None:
+        self._stats.setdefault(mirror, {
+                'bytes': 0, 'seconds': 0.0, 'pending': 0,
+                'successes': 0, 'failures': 0, 'suspended': None,
+                'recent': collections.deque(maxlen=self.BreakerWindow) })
+
+    def _isUsable(self, mirror: str, key, now: float) -> bool:
+        suspended = self._stats[mirror]['suspended']
+        if suspended is not None and now < suspended + self.BreakerCooldown:
+            return False
+        return (not self._failover or key is None
+                    or self._fileFailures.get((key, mirror), 0)
+                            < self._failover)
+
+    def _resolveStandby(self) -> None:
+        """Lazily construct list of mirrors to be used only for failover
+
+        Finding candidate mirrors may involve probing many sites
+        over the network, so this is done without holding the lock
+        that governs allocation of downloads to the existing mirrors.
+        """
+        with self._standbyLock:
+            if self._standby is not None:
+                return
+            candidates = []
+            if self._fallbacks and self._failover:
+                try:
+                    candidates = self._fallbacks()
+                except Exception:
+                    candidates = []
+
+            with self._lock:
+                standby = []
+                for mirror in candidates:
+                    if mirror not in self._mirrors \
+                            and mirror not in standby:
+                        standby.append(mirror)
+                        self._addMirror(mirror)
+                self._standby = standby
+
 
 
 ##
@@ -1428,6 +3984,10 @@ class FetchStats:
     of package downloads."""
 
     def __init__(self, downloads=None):
+        # Guard against updates from concurrent download workers:
+        self._lock = threading.Lock()
+        self._cancelled = False
+
         # Record of total bytes downloaded:
         self._newSize = 0
         self._alreadySize = 0
@@ -1440,6 +4000,13 @@ class FetchStats:
         self._failCount = 0
         self._totalCount = 0
 
+        # Record of (size, duration) of each new download,
+        # and of overall time taken by all downloads:
+        self._timings: list = []
+        self._predictedMakespan = 0.0
+        self._startTime = None
+        self._stopTime = None
+
         if downloads:
             self._totalSize = sum([size for (ref, size, hash) in downloads])
             self._totalCount = len(downloads)
@@ -1459,22 +4026,429 @@ class FetchStats:
     def Failures(self):
         return self._failCount
 
-    def AddNew(self, pkg, size):
-        """Mark the named package as being newly downloaded"""
-        self._newSize += size
-        self._newCount += 1
+    def Completed(self):
+        """Find the number of packages whose downloading has been settled"""
+        return self._newCount + self._alreadyCount + self._failCount
+
+    def MarkCancelled(self):
+        """Record that downloading has been cancelled,
+        returning True if this has already been recorded"""
+        with self._lock:
+            (previous, self._cancelled) = (self._cancelled, True)
+        return previous
+
+    def AddNew(self, pkg, size, elapsed=None):
+        """Mark the named package as being newly downloaded,
+        optionally noting the time taken to download it"""
+        with self._lock:
+            self._newSize += size
+            self._newCount += 1
+            if elapsed is not None:
+                self._timings.append((size, elapsed))
+
+    def SetPredictedMakespan(self, seconds):
+        """Record the expected time needed to complete all downloads"""
+        self._predictedMakespan = seconds
+
+    def StartClock(self):
+        self._startTime = time.time()
+        self._stopTime = None
+
+    def StopClock(self):
+        self._stopTime = time.time()
+
+    def Makespan(self):
+        """Find the predicted and actual time taken to complete all downloads"""
+        actual = 0.0
+        if self._startTime is not None:
+            actual = (self._stopTime or time.time()) - self._startTime
+        return { 'Predicted': self._predictedMakespan,
+                 'Actual': actual }
+
+    def TransferModel(self):
+        """Estimate the (latency, throughput) of downloads,
+        via a least-squares fit of download duration against size"""
+        with self._lock:
+            timings = list(self._timings)
+        if len(timings) < 2:
+            return None
+
+        n = len(timings)
+        meanSize = sum(size for (size, t) in timings) / n
+        meanTime = sum(t for (size, t) in timings) / n
+        varSize = sum((size - meanSize) ** 2 for (size, t) in timings)
+        if varSize <= 0:
+            return None
+        slope = sum((size - meanSize) * (t - meanTime)
+                        for (size, t) in timings) / varSize
+        if slope <= 0:
+            return None
+        latency = max(0.0, meanTime - slope * meanSize)
+
+        return (latency, 1.0 / slope)
 
     def AddAlready(self, pkg, size):
         """Mark the named package as having previously been
         successfully downloaded."""
-        self._alreadySize += size
-        self._alreadyCount += 1
+        with self._lock:
+            self._alreadySize += size
+            self._alreadyCount += 1
 
     def AddFail(self, pkg, size):
         """Mark the named package as having failed
         to download successfully"""
-        self._failSize += size
-        self._failCount += 1
+        with self._lock:
+            self._failSize += size
+            self._failCount += 1
+
+
+
+##
+## Asynchronous downloading
+##
+
+class AsyncDownloader:
+    """Single-threaded engine for downloading many packages concurrently,
+    using non-blocking sockets driven by an asyncio event-loop.
+
+    Each HTTP(S) transfer is checked for size and hash-code incrementally
+    as data arrives, with persistent connections being shared between
+    successive transfers from the same host. Other URL schemes,
+    and packages large enough to be fetched as several segments,
+    are delegated to PMbuilder._downloadSingle() via a thread-pool,
+    which also handles file-writing and hashing so that these
+    do not stall the event-loop.
+    """
+    ChunkSize = 1 << 16
+    MaxRedirects = 5
+    PollInterval = 0.1
+
+    def __init__(self, builder, maxTransfers: int=16,
+                 timeout: float=60) -> None:
+        self._builder = builder
+        self._maxTransfers = max(1, maxTransfers)
+        self._timeout = timeout
+        self._idle: dict = {}
+        self._sslContext = None
+
+    def FetchAll(self, scheduler):
+        """Download all packages supplied by a RetryScheduler"""
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._fetchAll(scheduler))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+    async def _fetchAll(self, scheduler):
+        workers = [ asyncio.ensure_future(self._worker(scheduler))
+                        for w in range(self._maxTransfers) ]
+        monitor = asyncio.ensure_future(self._watchCancellation(workers))
+
+        try:
+            results = await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            monitor.cancel()
+            self._closeIdle()
+        self._builder._checkCancelled()
+
+        for result in results:
+            if isinstance(result, BaseException) \
+                    and not isinstance(result, asyncio.CancelledError):
+                raise result
+
+    async def _watchCancellation(self, tasks):
+        """Cancel outstanding transfers once PMbuilder.Cancel() is called"""
+        while not self._builder._cancelling:
+            await asyncio.sleep(self.PollInterval)
+        for task in tasks:
+            task.cancel()
+
+    async def _worker(self, scheduler):
+        """Repeatedly download packages as they become due"""
+        while not self._builder._cancelling:
+            (DLsummary, delay) = scheduler.Poll()
+            if DLsummary is None:
+                if delay is None:
+                    break
+                await asyncio.sleep(min(delay, scheduler.PollInterval))
+                continue
+            await self._fetchOne(DLsummary, scheduler)
+
+    async def _fetchOne(self, DLsummary, scheduler):
+        (pkgfile, pkgsize, pkghash, tgtpath) = DLsummary
+        builder = self._builder
+
+        try:
+            mirror = builder._striper.Acquire(pkgsize, pkgfile)
+            mirpath = urllib.parse.urljoin(mirror, pkgfile)
+            t0 = time.time()
+            try:
+                (outcome, errmsg) = await self._download(mirpath, pkgsize,
+                                                         pkghash, tgtpath)
+            except asyncio.CancelledError:
+                # Any partial download is retained for later resumption:
+                builder._striper.Release(mirror, pkgsize, 0, None)
+                raise
+            elapsed = time.time() - t0
+            builder._releaseMirror(mirror, DLsummary, outcome, elapsed)
+
+            builder._reportOutcome(DLsummary, outcome, errmsg,
+                                   scheduler, True, elapsed)
+        except BaseException:
+            scheduler.Interrupted(DLsummary, builder.DL_Failure)
+            raise
+
+    async def _download(self, mirpath, pkgsize, pkghash, tgtpath):
+        """Download and validate a single package, in the manner
+        of PMbuilder._downloadSingle()"""
+        builder = self._builder
+
+        scheme = urllib.parse.urlsplit(mirpath).scheme.lower()
+        if scheme not in ConnectionPool.PooledSchemes \
+                or scheme in builder._connPool._proxies \
+                or builder._isSegmented(pkgsize):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, builder._downloadSingle,
+                                              mirpath, pkgsize,
+                                              pkghash, tgtpath)
+
+        if os.path.isfile(tgtpath) and os.path.getsize(tgtpath) == pkgsize:
+            if await self._offload(builder._hashCheck, tgtpath, pkghash):
+                return (builder.DL_AlreadyPresent, None)
+            # Replace corrupt local copy, without blaming the mirror for it:
+            os.remove(tgtpath)
+
+        partpath = tgtpath + builder.PartialSuffix
+        builder._recoverPartial(partpath)
+        offset = 0
+        if os.path.isfile(partpath):
+            offset = os.path.getsize(partpath)
+            if offset > pkgsize:
+                os.remove(partpath)
+                offset = 0
+
+        hasher = builder._hashCheck.NewDigest(pkghash)
+        dlsize = 0
+        try:
+            (key, reader, writer, length, resumed) = \
+                                    await self._open(mirpath, offset)
+            complete = False
+            try:
+                if resumed:
+                    # Include previously downloaded data within hash-code:
+                    await self._offload(HashChecker.UpdateFromFile,
+                                        hasher, partpath)
+                    dlsize = offset
+                with open(partpath, ('ab' if resumed else 'wb')) as fp:
+                    async for chunk in self._body(reader, length):
+                        dlsize += len(chunk)
+                        if dlsize > pkgsize:
+                            break
+                        await self._offload(self._consume, hasher, fp, chunk)
+                    else:
+                        complete = True
+            finally:
+                self._release(key, reader, writer, complete)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            return (builder._classifyError(ex), str(ex) or type(ex).__name__)
+
+        if dlsize != pkgsize:
+            if dlsize > pkgsize:
+                os.remove(partpath)
+            return (builder.DL_SizeError,
+                    'mismatched size: {0} vs {1}' \
+                        .format(builder._prettyfsize(dlsize),
+                                builder._prettyfsize(pkgsize)))
+        if not HashChecker.Matches(hasher, pkghash):
+            os.remove(partpath)
+            return (builder.DL_HashError, 'mismatched checksum')
+
+        os.replace(partpath, tgtpath)
+        return (builder.DL_Success, None)
+
+    @staticmethod
+    def _consume(hasher, fp, chunk):
+        hasher.update(chunk)
+        fp.write(chunk)
+
+    async def _offload(self, func, *args):
+        """Run a blocking operation, such as file-writing or hashing,
+        within the thread-pool, so that other transfers are not stalled.
+        If the calling task is cancelled, the operation is still
+        allowed to finish before the cancellation propagates."""
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(None, func, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([ future ])
+            raise
+
+    async def _open(self, URL, offset=0):
+        """Issue GET request, returning connection and content-length
+        once the response headers have been received, together with
+        a flag indicating whether the request resumes from the given offset"""
+        for redirect in range(self.MaxRedirects + 1):
+            parts = urllib.parse.urlsplit(URL)
+            key = (parts.scheme.lower(), parts.netloc.lower())
+            selector = parts.path or '/'
+            if parts.query:
+                selector += '?' + parts.query
+            request = ('GET {0} HTTP/1.1\r\n'
+                       'Host: {1}\r\n'
+                       'User-Agent: pmcyg/{2}\r\n'
+                       'Accept-Encoding: identity\r\n') \
+                            .format(selector, parts.netloc, PMCYG_VERSION)
+            if offset:
+                request += 'Range: bytes={0:d}-\r\n'.format(offset)
+            request += '\r\n'
+
+            while True:
+                (reader, writer, reused) = await self._acquire(key, parts)
+                try:
+                    writer.write(request.encode('latin-1'))
+                    await writer.drain()
+                    (status, reason, headers) = \
+                        await asyncio.wait_for(self._readHeaders(reader),
+                                               self._timeout)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # A pooled connection may have been closed by the server
+                    # while idle, in which case a fresh one is tried:
+                    writer.close()
+                    if not reused:
+                        raise
+                except BaseException:
+                    # e.g. timeout, or malformed response headers:
+                    writer.close()
+                    raise
+
+            try:
+                length = headers.get('content-length')
+                if headers.get('transfer-encoding', '').lower() == 'chunked':
+                    length = 'chunked'
+                elif length is not None:
+                    length = int(length)
+                if headers.get('connection', '').lower() == 'close':
+                    key = None
+
+                if status in (301, 302, 303, 307, 308) \
+                        and headers.get('location'):
+                    async for chunk in self._body(reader, length):
+                        pass
+                    self._release(key, reader, writer, True)
+                    URL = urllib.parse.urljoin(URL, headers['location'])
+                    continue
+
+                if status == 416 and offset:
+                    # Partial download is presumably already complete:
+                    async for chunk in self._body(reader, length):
+                        pass
+                    return (key, reader, writer, 0, True)
+
+                if status == 206 and offset:
+                    if ContentRangeStart(headers) != offset:
+                        raise urllib.error.URLError('Mismatched content-range'
+                                                    ' for {0}'.format(URL))
+                    return (key, reader, writer, length, True)
+
+                if status >= 300:
+                    raise urllib.error.HTTPError(URL, status, reason,
+                                                 None, None)
+            except BaseException:
+                writer.close()
+                raise
+
+            return (key, reader, writer, length, False)
+
+        raise urllib.error.URLError('Too many redirections'
+                                    ' for {0}'.format(URL))
+
+    async def _readHeaders(self, reader):
+        statusline = await reader.readline()
+        if not statusline:
+            raise asyncio.IncompleteReadError(statusline, None)
+        fields = statusline.decode('latin-1').split(None, 2)
+        (status, reason) = (int(fields[1]), ' '.join(fields[2:]).strip())
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise asyncio.IncompleteReadError(line, None)
+            line = line.decode('latin-1').strip()
+            if not line:
+                break
+            (name, sep, value) = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        return (status, reason, headers)
+
+    async def _body(self, reader, length):
+        """Iterate over chunks of response body"""
+        if length == 'chunked':
+            while True:
+                sizeline = await self._timed(reader.readline())
+                chunklen = int(sizeline.split(b';')[0].strip(), 16)
+                if chunklen == 0:
+                    while (await self._timed(reader.readline())).strip():
+                        pass
+                    return
+                yield await self._timed(reader.readexactly(chunklen))
+                await self._timed(reader.readline())
+        elif length is None:
+            while True:
+                chunk = await self._timed(reader.read(self.ChunkSize))
+                if not chunk:
+                    return
+                yield chunk
+        else:
+            remaining = length
+            while remaining > 0:
+                chunk = await self._timed(
+                                reader.read(min(remaining, self.ChunkSize)))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(chunk, remaining)
+                remaining -= len(chunk)
+                yield chunk
+
+    def _timed(self, awaitable):
+        return asyncio.wait_for(awaitable, self._timeout)
+
+    async def _acquire(self, key, parts):
+        conns = self._idle.get(key)
+        if conns:
+            (reader, writer) = conns.pop()
+            return (reader, writer, True)
+
+        if key[0] == 'https':
+            if not self._sslContext:
+                self._sslContext = ssl.create_default_context()
+            (ssl_ctx, port) = (self._sslContext, parts.port or 443)
+        else:
+            (ssl_ctx, port) = (None, parts.port or 80)
+
+        (reader, writer) = await self._timed(
+                                asyncio.open_connection(parts.hostname, port,
+                                                        ssl=ssl_ctx))
+        return (reader, writer, False)
+
+    def _release(self, key, reader, writer, reusable):
+        """Return connection to idle pool, provided its response
+        has been fully consumed"""
+        if key and reusable and not reader.at_eof():
+            self._idle.setdefault(key, []).append((reader, writer))
+        else:
+            writer.close()
+
+    def _closeIdle(self):
+        for conns in self._idle.values():
+            for (reader, writer) in conns:
+                writer.close()
+        self._idle = {}
 
 
 
@@ -2,8 +2,9 @@
 # Unit-tests for Cygwin Partial Mirror (pmcyg)
 # RW Penney, August 2009
 
-import codecs, os, random, re, string, io, sys, \
-       tempfile, unittest, urllib.parse
+import codecs, functools, hashlib, http.server, lzma, os, random, re, shutil, \
+       signal, string, io, pickle, sys, tempfile, threading, time, \
+       tracemalloc, unittest, unittest.mock, urllib.parse
 sys.path.insert(0, '..')
 from pmcyg.core import *
 
@@ -20,6 +21,265 @@ def getSetupURL():
     return 'http://www.mirrorservice.org/sites/sourceware.org/pub/cygwin/x86_64/setup.xz'
 
 
+def makeLargeSetupIni(path, npkgs=12000, seed=0):
+    """Write synthetic setup.ini comparable in size and structure
+    to that of a full Cygwin x86_64 mirror"""
+    rng = random.Random(seed)
+    words = [ ''.join(rng.choice(string.ascii_lowercase)
+                        for i in range(rng.randint(2, 9)))
+                for w in range(500) ]
+    pkgnames = [ 'pkg{0:05d}-{1}'.format(idx, rng.choice(words))
+                    for idx in range(npkgs) ]
+    with open(path, 'wt', encoding='utf-8') as fp:
+        fp.write('# This file was automatically generated\n'
+                 'release: cygwin\narch: x86_64\n'
+                 'setup-timestamp: 1700000000\nsetup-version: 2.926\n\n')
+        for (idx, pkg) in enumerate(pkgnames):
+            deps = sorted(set(rng.choice(pkgnames[:idx + 1])
+                                for d in range(rng.randint(0, 6))) - {pkg})
+            fp.write('@ {0}\n'.format(pkg))
+            fp.write('sdesc: "{0}"\n'.format(' '.join(rng.sample(words, 5))))
+            fp.write('ldesc: "{0}\n{1}"\n'.format(
+                            ' '.join(rng.sample(words, 12)),
+                            ' '.join(rng.sample(words, 8))))
+            fp.write('category: {0}\n'.format(rng.choice(words[:40])))
+            fp.write('requires: {0}\n'.format(' '.join(deps)))
+            for (epoch, version) in (('', '2.0-1'), ('[prev]\n', '1.9-3')):
+                fp.write(epoch)
+                fp.write('version: {0}\n'.format(version))
+                for (kind, suffix) in (('install', ''), ('source', '-src')):
+                    fp.write('{0}: x86_64/release/{1}/{1}-{2}{3}.tar.xz'
+                             ' {4:d} {5}\n'.format(kind, pkg, version, suffix,
+                                    rng.randint(1 << 10, 1 << 24),
+                                    '{0:0128x}'.format(rng.getrandbits(512))))
+                fp.write('depends2: {0}\n'.format(', '.join(deps)))
+            fp.write('\n')
+    return pkgnames
+
+
+
+class LocalMirror:
+    """Synthetic Cygwin mirror, served over HTTP from a temporary directory,
+    or sharing the content of another LocalMirror"""
+    def __init__(self, npkgs=12, maxsize=1<<16, delay=0.0, arch='x86_64',
+                 source=None):
+        self.arch = arch
+        self.delay = delay
+        self.connections = 0
+        self.requests = 0
+        self.ranges = []
+        self.faults = {}
+        self.missing = set()
+        self.etags = True
+        self.notModified = 0
+        self.rate = None
+        self._lock = threading.Lock()
+
+        if source:
+            self._tmpdir = None
+            self.topdir = source.topdir
+            self.packages = source.packages
+        else:
+            self._tmpdir = tempfile.TemporaryDirectory()
+            self.topdir = self._tmpdir.name
+            self.packages = {}
+            self._populate(npkgs, maxsize)
+
+        handler = functools.partial(LocalMirror._handler, self,
+                                    directory=self.topdir)
+        self._server = LocalMirror._server(('127.0.0.1', 0), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        self.url = 'http://127.0.0.1:{0:d}/'.format(self._server.server_port)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._tmpdir:
+            self._tmpdir.cleanup()
+
+    def _populate(self, npkgs, maxsize):
+        arch = self.arch
+        archdir = os.path.join(self.topdir, arch)
+        os.makedirs(archdir)
+        lines = [ 'release: cygwin', 'arch: ' + arch,
+                  'setup-timestamp: 1700000000', 'setup-version: 2.926', '' ]
+        for idx in range(npkgs):
+            pkg = 'pkg{0:d}'.format(idx)
+            relpath = '{0}/release/{1}/{1}-1.0-1.tar.xz'.format(arch, pkg)
+            payload = os.urandom(random.randint(1, maxsize))
+            os.makedirs(os.path.join(self.topdir, os.path.dirname(relpath)))
+            with open(os.path.join(self.topdir, relpath), 'wb') as fp:
+                fp.write(payload)
+            self.packages[pkg] = (relpath, payload)
+
+            lines.extend([ '@ ' + pkg,
+                           'sdesc: "Synthetic package {0:d}"'.format(idx),
+                           'category: Test',
+                           'requires: ' + ('pkg{0:d}'.format(idx + 1)
+                                           if (idx + 1) % 4 else ''),
+                           'version: 1.0-1',
+                           'install: {0} {1:d} {2}'.format(relpath,
+                                    len(payload),
+                                    hashlib.sha512(payload).hexdigest()),
+                           '' ])
+        with open(os.path.join(archdir, 'setup.ini'), 'wt',
+                  encoding='utf-8') as fp:
+            fp.write('\n'.join(lines))
+        with lzma.open(os.path.join(archdir, 'setup.xz'), 'wt',
+                       encoding='utf-8') as fp:
+            fp.write('\n'.join(lines))
+        with open(os.path.join(self.topdir, 'setup-{0}.exe'.format(arch)),
+                  'wb') as fp:
+            fp.write(os.urandom(1 << 10))
+
+    def configure(self, builder, tgtdir):
+        """Point a PMbuilder at this mirror, with a local build directory"""
+        builder.SetArch(self.arch)
+        builder.SetTargetDir(tgtdir)
+        builder.mirror_url = self.url
+        builder.setup_exe_url = self.url + 'setup${_arch}.exe'
+        builder.setup_ini_url = self.url + self.arch + '/setup.ini'
+        builder.SetOption('IncludeBase', False)
+
+    class _server(http.server.ThreadingHTTPServer):
+        request_queue_size = 256
+        daemon_threads = True
+
+    class _handler(http.server.SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def __init__(self, mirror, *args, **kwargs):
+            self.mirror = mirror
+            with mirror._lock:
+                mirror.connections += 1
+            http.server.SimpleHTTPRequestHandler.__init__(self, *args, **kwargs)
+
+        def do_GET(self):
+            with self.mirror._lock:
+                self.mirror.requests += 1
+                fault = self.mirror.faults.pop(self.path.lstrip('/'), None)
+            if self.mirror.delay > 0:
+                time.sleep(self.mirror.delay)
+            if self.path.lstrip('/') in self.mirror.missing:
+                # Simulate mirror which has not been fully synchronized:
+                self.send_error(404)
+                return
+
+            path = self.translate_path(self.path)
+            rangehdr = self.headers.get('Range')
+            self._etag = None
+            if os.path.isfile(path) and self.mirror.etags:
+                stat = os.stat(path)
+                self._etag = '"{0:x}-{1:x}"'.format(stat.st_mtime_ns,
+                                                   stat.st_size)
+            if self._etag and self.headers.get('If-None-Match') == self._etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            if not os.path.isfile(path) \
+                    or (not rangehdr and fault is None and not self.mirror.rate):
+                http.server.SimpleHTTPRequestHandler.do_GET(self)
+                return
+
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            (start, end) = (0, len(data))
+            if rangehdr:
+                matches = re.match(r'bytes=(\d+)-(\d*)$', rangehdr)
+                start = int(matches.group(1))
+                if matches.group(2):
+                    end = min(end, int(matches.group(2)) + 1)
+                with self.mirror._lock:
+                    self.mirror.ranges.append((self.path, start, end))
+                if start >= len(data):
+                    self.send_response(416)
+                    self.send_header('Content-Range',
+                                     'bytes */{0:d}'.format(len(data)))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {0:d}-{1:d}/{2:d}' \
+                                    .format(start, end - 1, len(data)))
+            else:
+                self.send_response(200)
+            body = data[start:end]
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+
+            if fault is not None:
+                # Simulate connection being dropped part-way through:
+                self.wfile.write(body[:fault])
+                self.close_connection = True
+            elif self.mirror.rate:
+                # Simulate limited bandwidth per connection:
+                blksize = 1 << 14
+                for pos in range(0, len(body), blksize):
+                    self.wfile.write(body[pos:(pos + blksize)])
+                    time.sleep(blksize / self.mirror.rate)
+            else:
+                self.wfile.write(body)
+
+        def send_response(self, code, *args):
+            if code == 304:
+                with self.mirror._lock:
+                    self.mirror.notModified += 1
+            http.server.SimpleHTTPRequestHandler.send_response(self, code,
+                                                               *args)
+
+        def end_headers(self):
+            if getattr(self, '_etag', None):
+                self.send_header('ETag', self._etag)
+            http.server.SimpleHTTPRequestHandler.end_headers(self)
+
+        def log_message(self, *args):
+            pass
+
+
+
+class testConnectionPool(unittest.TestCase):
+    """Tests of persistent HTTP connections to local mirror"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = LocalMirror(npkgs=8)
+
+    def tearDown(self):
+        self.mirror.close()
+        self._tmpdir.cleanup()
+
+    def testReuse(self):
+        pool = ConnectionPool()
+        for (relpath, payload) in self.mirror.packages.values():
+            tgtpath = os.path.join(self._tmpdir.name, 'download')
+            nbytes = pool.retrieve(self.mirror.url + relpath, tgtpath)
+            self.assertEqual(nbytes, len(payload))
+            with open(tgtpath, 'rb') as fp:
+                self.assertEqual(fp.read(), payload)
+        self.assertEqual(self.mirror.connections, 1)
+        pool.close()
+
+    def testErrors(self):
+        pool = ConnectionPool()
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            pool.urlopen(self.mirror.url + 'nonexistent.tar.xz')
+        self.assertEqual(cm.exception.code, 404)
+
+        with pool.urlopen(self.mirror.url + 'x86_64/setup.ini') as stream:
+            self.assertTrue(stream.read(16).startswith(b'release:'))
+        pool.close()
+
+    def testFallback(self):
+        pool = ConnectionPool()
+        (relpath, payload) = self.mirror.packages['pkg0']
+        URL = 'file://' + os.path.join(self.mirror.topdir, relpath)
+        with pool.urlopen(URL) as stream:
+            self.assertEqual(stream.read(), payload)
+
+
+
 class testSetupIniFetcher(unittest.TestCase):
     """Test for opening of optionally compressed setup.ini via URL"""
     def setUp(self):
@@ -49,6 +309,100 @@ class testSetupIniFetcher(unittest.TestCase):
 
         self._validate(tmpfile, seed, count)
 
+    def testConcatenated(self):
+        seed = random.randint(0, 1<<31)
+        count = 1 << 12
+
+        tmpfile = os.path.join(self._tmpdir.name, 'multi.xz')
+        with open(tmpfile, 'wb') as fp:
+            state = seed
+            for part in range(4):
+                chunk = io.BytesIO()
+                self._generate(chunk, state, count // 4)
+                fp.write(lzma.compress(chunk.getvalue()))
+                for step in range(count // 4):
+                    state = self._step(state)
+
+        self._validate(tmpfile, seed, count)
+
+    def testStreaming(self):
+        """Check that lines are available before download completes"""
+        inipath = os.path.join(self._tmpdir.name, 'setup.ini')
+        makeLargeSetupIni(inipath, npkgs=3000)
+        with open(inipath, 'rb') as fp:
+            rawdata = fp.read()
+        mirror = LocalMirror(npkgs=0)
+        try:
+            xzpath = os.path.join(mirror.topdir, 'setup.xz')
+            with open(xzpath, 'wb') as fp:
+                fp.write(lzma.compress(rawdata))
+            xzsize = os.path.getsize(xzpath)
+
+            fetcher = SetupIniFetcher(mirror.url + 'setup.xz')
+            received = []
+            def readBlocks(_original=fetcher._readBlocks):
+                for block in _original():
+                    received.append(len(block))
+                    yield block
+            fetcher._readBlocks = readBlocks
+            next(fetcher)
+            firstBytes = sum(received)
+            nlines = 1 + sum(1 for line in fetcher)
+        finally:
+            mirror.close()
+
+        self.assertEqual(nlines, rawdata.count(b'\n'))
+        self.assertEqual(fetcher.digest, hashlib.sha512(rawdata).hexdigest())
+        self.assertEqual(sum(received), xzsize)
+        self.assertLess(firstBytes, 0.25 * sum(received))
+
+    def testMemory(self):
+        """Check that memory usage does not grow with size of file"""
+        peaks = []
+        for npkgs in (2000, 6000):
+            inipath = os.path.join(self._tmpdir.name,
+                                   'setup-{0:d}.ini'.format(npkgs))
+            makeLargeSetupIni(inipath, npkgs=npkgs)
+            xzpath = inipath + '.xz'
+            with open(inipath, 'rb') as src, lzma.open(xzpath, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+            tracemalloc.start()
+            fetcher = SetupIniFetcher('file:' + xzpath)
+            nlines = sum(1 for line in fetcher)
+            (current, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            self.assertEqual(fetcher.LocalDigest(), fetcher.digest)
+            self.assertGreater(nlines, npkgs * 10)
+            peaks.append((peak, os.path.getsize(inipath)))
+
+        # Beyond the fixed-size decompression buffers,
+        # memory usage should be much less than the file size:
+        ((peak0, size0), (peak1, size1)) = peaks
+        self.assertLess(peak1 - peak0, (size1 - size0) // 16)
+
+    def testTruncated(self):
+        inipath = os.path.join(self._tmpdir.name, 'setup.ini')
+        makeLargeSetupIni(inipath, npkgs=200)
+        mirror = LocalMirror(npkgs=0)
+        try:
+            with open(inipath, 'rb') as src, \
+                    lzma.open(os.path.join(mirror.topdir, 'setup.xz'),
+                              'wb') as dst:
+                dst.write(src.read())
+            mirror.faults['setup.xz'] = 2000
+            cachedir = os.path.join(self._tmpdir.name, 'cache')
+            fetcher = SetupIniFetcher(mirror.url + 'setup.xz',
+                                      cacheDir=cachedir)
+            with self.assertRaises(PMCygException):
+                for line in fetcher:
+                    pass
+            self.assertIsNone(fetcher.digest)
+            self.assertEqual(os.listdir(cachedir), [])
+        finally:
+            mirror.close()
+
     def _validate(self, filename, seed, count):
         fetcher = SetupIniFetcher('file:' + filename)
         nlines = 0
@@ -73,6 +427,98 @@ class testSetupIniFetcher(unittest.TestCase):
 
 
 
+class testSetupIniCache(unittest.TestCase):
+    """Tests of conditional fetching of setup.ini via a local cache"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.cachedir = os.path.join(self._tmpdir.name, 'cache')
+        self.mirror = LocalMirror(npkgs=4)
+        self.iniURL = self.mirror.url + self.mirror.arch + '/setup.xz'
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.mirror.close()
+        self._tmpdir.cleanup()
+
+    def fetch(self):
+        fetcher = SetupIniFetcher(self.iniURL, pool=self.pool,
+                                  cacheDir=self.cachedir)
+        lines = list(fetcher)
+        fetcher.close()
+        return (fetcher.fromCache, lines)
+
+    def testETag(self):
+        (cached, original) = self.fetch()
+        self.assertFalse(cached)
+        (datapath, metapath) = SetupIniFetcher.CachePaths(self.cachedir,
+                                                          self.iniURL)
+        with open(metapath, 'rt') as fp:
+            self.assertTrue(fp.read().startswith('ETag: "'))
+
+        self.assertEqual(self.fetch(), (True, original))
+        self.assertEqual(self.mirror.notModified, 1)
+
+        xzpath = os.path.join(self.mirror.topdir, self.mirror.arch,
+                              'setup.xz')
+        with lzma.open(xzpath, 'at', encoding='utf-8') as fp:
+            fp.write('\n@ extra\nsdesc: "Late addition"\n')
+        (cached, updated) = self.fetch()
+        self.assertFalse(cached)
+        self.assertEqual(updated[-2:], ['@ extra\n', 'sdesc: "Late addition"\n'])
+        self.assertEqual(self.fetch(), (True, updated))
+
+    def testLastModified(self):
+        self.mirror.etags = False
+        (cached, original) = self.fetch()
+        self.assertEqual(self.fetch(), (True, original))
+        self.assertEqual(self.mirror.notModified, 1)
+
+    def testLocalFile(self):
+        path = os.path.join(self.mirror.topdir, self.mirror.arch, 'setup.xz')
+        fetcher = SetupIniFetcher('file:' + path, cacheDir=self.cachedir)
+        self.assertGreater(len(list(fetcher)), 4)
+        fetcher.close()
+        self.assertFalse(fetcher.fromCache)
+        self.assertFalse(os.path.exists(self.cachedir))
+
+    def testBuilder(self):
+        builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                            Viewer=SilentBuildViewer())
+        self.mirror.configure(builder, self._tmpdir.name)
+        builder.setup_ini_url = None
+        pkgset = PackageSet()
+        pkgset.extend(self.mirror.packages.keys())
+        builder.BuildMirror(pkgset)
+        self.assertEqual(len(builder._masterList.GetPackageDict()), 4)
+
+        builder._masterList.SetSourceURL(builder.setup_ini_url, reload=True)
+        self.assertEqual(len(builder._masterList.GetPackageDict()), 4)
+        self.assertEqual(self.mirror.notModified, 1)
+        self.assertTrue(os.path.isdir(os.path.join(self._tmpdir.name,
+                                                   PMbuilder.CacheDirectory)))
+
+    def testQueries(self):
+        """Check that operations which download no packages
+        leave no cached files in the build directory"""
+        builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                            Viewer=SilentBuildViewer())
+        self.mirror.configure(builder, self._tmpdir.name)
+        builder.setup_ini_url = None
+        pkgset = PackageSet()
+        pkgset.extend(self.mirror.packages.keys())
+
+        builder.TemplateFromLists(os.path.join(self._tmpdir.name,
+                                               'template.txt'), [])
+        builder.SizeReport(pkgset, io.StringIO())
+        builder.ExplainPackages(pkgset, [ 'pkg1' ], io.StringIO())
+        builder.SetOption('DummyDownload', True)
+        builder.BuildMirror(pkgset)
+        self.assertFalse(os.path.exists(os.path.join(self._tmpdir.name,
+                                                     PMbuilder.CacheDirectory)))
+
+
+
 class testHashChecker(unittest.TestCase):
     def testAlgMatch(self):
         HC = HashChecker()
@@ -210,6 +656,1111 @@ class testMasterPackageList(unittest.TestCase):
                               'zsh' } - packages, set())
 
 
+class testIndexSnapshot(unittest.TestCase):
+    """Tests of binary snapshots of parsed setup.ini"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.cachedir = os.path.join(self._tmpdir.name, 'cache')
+        self.mirror = LocalMirror(npkgs=0)
+        self.path = os.path.join(self.mirror.topdir, 'setup.ini')
+        self.iniURL = self.mirror.url + 'setup.ini'
+
+    def tearDown(self):
+        self.mirror.close()
+        self._tmpdir.cleanup()
+
+    def ingest(self, path):
+        pkglist = MasterPackageList(iniURL=self.iniURL,
+                                    Viewer=SilentBuildViewer(),
+                                    CacheDir=self.cachedir)
+        lines = []
+        def countingIngest(line, lineno=None,
+                           _original=pkglist._ingestOrdinaryLine):
+            lines.append(lineno)
+            return _original(line, lineno=lineno)
+        pkglist._ingestOrdinaryLine = countingIngest
+        (header, packages) = pkglist.GetHeaderAndPackages()
+        return (header, packages, len(lines))
+
+    def testRoundTrip(self):
+        path = self.path
+        shutil.copy(os.path.join(TESTDIR, 'setup-awkward.ini'), path)
+
+        (header, packages, nparsed) = self.ingest(path)
+        self.assertGreater(nparsed, 0)
+        (header2, packages2, nparsed2) = self.ingest(path)
+        self.assertEqual(nparsed2, 0)
+        self.assertEqual(header2, header)
+        self.assertEqual(sorted(packages2), sorted(packages))
+        for (pkg, info) in packages.items():
+            for epoch in (None, 'curr', 'prev'):
+                for field in ('sdesc', 'ldesc', 'requires', 'install',
+                              'message_messaging', 'TEXT'):
+                    self.assertEqual(packages2[pkg].GetAny(field, [epoch]),
+                                     info.GetAny(field, [epoch]))
+
+        # Any change to the index should invalidate the snapshot:
+        with open(path, 'at', encoding='utf-8') as fp:
+            fp.write('\n@ late-addition\nsdesc: "Something new"\n')
+        (header3, packages3, nparsed3) = self.ingest(path)
+        self.assertGreater(nparsed3, nparsed)
+        self.assertIn('late-addition', packages3)
+
+    def testUntrusted(self):
+        """Check that a snapshot cannot execute code when loaded"""
+        path = self.path
+        shutil.copy(os.path.join(TESTDIR, 'setup-awkward.ini'), path)
+        (header, packages, nparsed) = self.ingest(path)
+        snapshot = SetupIniFetcher.CachePaths(self.cachedir, self.iniURL)[0] \
+                    + MasterPackageList.SnapshotSuffix
+        self.assertTrue(os.path.isfile(snapshot))
+
+        marker = os.path.join(self._tmpdir.name, 'exploited')
+        class Payload:
+            def __reduce__(self):
+                return (open, (marker, 'w'))
+        with open(snapshot, 'wb') as fp:
+            pickle.dump(Payload(), fp)
+
+        (header2, packages2, nparsed2) = self.ingest(path)
+        self.assertFalse(os.path.exists(marker))
+        self.assertEqual(nparsed2, nparsed)
+        self.assertEqual(sorted(packages2), sorted(packages))
+
+    def testLocalFile(self):
+        """Check that no snapshot is made of a local setup.ini"""
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        shutil.copy(os.path.join(TESTDIR, 'setup-awkward.ini'), path)
+        pkglist = MasterPackageList(iniURL='file:' + path,
+                                    Viewer=SilentBuildViewer(),
+                                    CacheDir=self.cachedir)
+        self.assertGreater(len(pkglist.GetPackageDict()), 0)
+        self.assertFalse(os.path.exists(self.cachedir))
+
+    def testLargeIndex(self):
+        path = self.path
+        pkgnames = makeLargeSetupIni(path)
+
+        (header, packages, nparsed) = self.ingest(path)
+        self.assertEqual(len(packages), len(pkgnames))
+
+        (header2, packages2, nparsed2) = self.ingest(path)
+        self.assertEqual(nparsed2, 0)
+        self.assertEqual(header2, header)
+        self.assertEqual(len(packages2), len(pkgnames))
+        for pkg in pkgnames[::97]:
+            self.assertEqual(dict(packages2[pkg].Items()),
+                             dict(packages[pkg].Items()))
+
+
+
+class RegexPackageList(MasterPackageList):
+    """Reference parser for setup.ini, using the regular expression
+    by which earlier versions of MasterPackageList classified lines"""
+    RE_DBline = re.compile(r'''
+          ((?P<relinfo>^(release|arch|setup-\S+)) :
+                                \s+ (?P<relParam>\S+) $)
+        | (?P<comment>\# .* $)
+        | (?P<package>^@ \s+ (?P<pkgName> \S+) $)
+        | (?P<epoch>^\[ (?P<epochName>[a-z]+) \] $)
+        | ((?P<field>^[a-zA-Z][-a-zA-Z0-9]+) : \s+ (?P<fieldVal> .*) $)
+        | (?P<blank>^\s* $)
+        ''', re.VERBOSE)
+
+    def _ingestOrdinaryLine(self, line, lineno=None):
+        matches = self.RE_DBline.match(line)
+        if not matches:
+            raise SyntaxError("Unrecognized content on line {0:d}" \
+                                .format(lineno or 0))
+
+        if matches.group('relinfo'):
+            self._ini_header[matches.group('relinfo')] = matches.group('relParam')
+        elif matches.group('package'):
+            self._finalizePackage()
+            self._pkgname = matches.group('pkgName')
+            self._epoch = 'curr'
+            self._fieldname = None
+        elif matches.group('epoch'):
+            self._epoch = matches.group('epochName')
+        elif matches.group('field'):
+            self._ingestField(matches.group('field'),
+                              matches.group('fieldVal'))
+
+
+
+class testLineParser(unittest.TestCase):
+    """Tests of classification of lines within setup.ini"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def parseWith(self, cls, path):
+        pkglist = cls(iniURL='file:' + path, Viewer=SilentBuildViewer())
+        (header, packages) = pkglist.GetHeaderAndPackages()
+        return (header, { pkg: dict(info.Items())
+                            for (pkg, info) in packages.items() })
+
+    def testParity(self):
+        path = os.path.join(TESTDIR, 'setup-awkward.ini')
+        self.assertEqual(self.parseWith(MasterPackageList, path),
+                         self.parseWith(RegexPackageList, path))
+
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        makeLargeSetupIni(path, npkgs=500)
+        self.assertEqual(self.parseWith(MasterPackageList, path),
+                         self.parseWith(RegexPackageList, path))
+
+    def testLines(self):
+        lines = [ 'release: cygwin\n', 'release: two words\n',
+                  'arch:x86_64\n', 'setup-version:\t\t2.9\n',
+                  'setup-: x\n', 'setup-v.x: 1\n', 'setup-timestamp: 12 \n',
+                  '# comment\n', '#\n', '@ pkg\n', '@pkg\n', '@ pkg \n',
+                  '@  \n', '@ two names\n', '[prev]\n', '[prev] \n',
+                  '[]\n', '[Prev]\n', '[test]', '\n', '', ' \t \n',
+                  ' indented: value\n', 'x: value\n', 'xy: value\n',
+                  'requires:   \t \n', 'requires:\n', 'requires:',
+                  'version: 1.2  \n', 'version: 1.2\r\n',
+                  'sdesc: "quoted"\n', 'ldesc: "multi\n',
+                  'message: pkg "text"\n', 'bad_name: value\n',
+                  'name:value\n', 'na.me: value\n', 'ñame: value\n',
+                  '"quoted": value\n', '-field: value\n', '3d: value\n' ]
+        for line in lines:
+            outcomes = []
+            for cls in (MasterPackageList, RegexPackageList):
+                pkglist = cls(Viewer=SilentBuildViewer())
+                pkglist._ini_header = {}
+                pkglist._ini_packages = {}
+                pkglist._pkgname = None
+                pkglist._pkgtxt = []
+                pkglist._pkgdict = PackageSummary()
+                pkglist._epoch = None
+                pkglist._fieldname = None
+                pkglist._inquote = False
+                try:
+                    pkglist._ingestOrdinaryLine(line, lineno=1)
+                except SyntaxError:
+                    outcomes.append('SyntaxError')
+                    continue
+                outcomes.append((pkglist._ini_header, pkglist._pkgname,
+                                 pkglist._epoch, pkglist._inquote,
+                                 dict(pkglist._pkgdict.Items())))
+            self.assertEqual(outcomes[0], outcomes[1], msg=repr(line))
+
+    def testLargeIndex(self):
+        """Compare line classification against regex parser
+        over an entire (synthetic) setup.ini"""
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        pkgnames = makeLargeSetupIni(path, npkgs=2000)
+
+        results = {}
+        for cls in (RegexPackageList, MasterPackageList):
+            pkglist = cls(iniURL='file:' + path, Viewer=SilentBuildViewer())
+            (header, packages) = pkglist.GetHeaderAndPackages()
+            results[cls] = (header, { pkg: dict(info.Items())
+                                        for (pkg, info) in packages.items() })
+        self.assertEqual(len(results[MasterPackageList][1]), len(pkgnames))
+        self.assertEqual(results[MasterPackageList],
+                         results[RegexPackageList])
+
+
+
+class DictPackageSummary:
+    """Reference implementation of PackageSummary, as a dictionary
+    keyed by (field, epoch) tuples, as used by earlier versions of pmcyg"""
+    def __init__(self):
+        self._pkginfo = {}
+        self._epochs = set()
+
+    def Set(self, field, value, epoch=None):
+        self._pkginfo[(field, epoch)] = value
+        self._epochs.add(epoch)
+
+
+
+class testPackageSummary(unittest.TestCase):
+    """Tests of compact storage of package information"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testAccess(self):
+        info = PackageSummary()
+        info.Set('sdesc', 'Summary', 'curr')
+        info.Set('requires', 'bash coreutils', 'curr')
+        info.Set('depends2', 'cygwin, zlib', 'prev')
+        info.Set('install', 'new.tar.xz', 'curr')
+        info.Set('install', 'old.tar.xz', 'prev')
+        info.Set('TEXT', '@ pkg')
+        info.Set('never-seen-before', 'value', 'test')
+
+        self.assertEqual(info.GetAny('sdesc'), 'Summary')
+        self.assertEqual(info.GetAny('install', ['prev']), 'old.tar.xz')
+        self.assertEqual(info.GetAny('TEXT', ['prev']), '@ pkg')
+        self.assertIsNone(info.GetAny('depends2'))
+        self.assertIsNone(info.GetAny('unknown-field'))
+        self.assertEqual(info.GetAll('install'), ['new.tar.xz', 'old.tar.xz'])
+        self.assertEqual(info.GetAll('install', ['prev', 'test']),
+                         ['old.tar.xz'])
+        self.assertEqual(info.GetDependencies(), ['bash', 'coreutils'])
+        self.assertTrue(info.HasFileContent())
+        self.assertEqual(len(list(info.Items())), 7)
+
+        restored = pickle.loads(pickle.dumps(info))
+        self.assertEqual(dict(restored.Items()), dict(info.Items()))
+        self.assertEqual(PackageSummary().GetAll('install'), [])
+
+    def testEpochDependencies(self):
+        info = PackageSummary()
+        info.Set('depends2', 'cygwin, libfoo1', 'curr')
+        info.Set('requires', 'bash', 'curr')
+        info.Set('depends2', 'cygwin, libfoo0', 'prev')
+        info.Set('depends2', 'cygwin, libfoo2, libbar', 'test')
+
+        self.assertEqual(info.GetDependencies(),
+                         ['bash', 'cygwin', 'libfoo1'])
+        self.assertEqual(info.GetDependencies(['prev']),
+                         ['cygwin', 'libfoo0'])
+        self.assertEqual(info.GetDependencies(['curr', 'prev', 'test']),
+                         ['bash', 'cygwin', 'libbar', 'libfoo0',
+                          'libfoo1', 'libfoo2'])
+        self.assertEqual(info.GetDependencies(['absent']), [])
+        self.assertEqual(info.GetDependencies({'prev'}),
+                         ['cygwin', 'libfoo0'])
+        self.assertEqual(info.GetDependencies(ep for ep in ('curr', 'prev')),
+                         ['bash', 'cygwin', 'libfoo0', 'libfoo1'])
+
+        # Dependencies should only be parsed once per epoch:
+        with unittest.mock.patch.object(PackageSummary, 'GetAny') as getany:
+            self.assertEqual(info.GetDependencies(['prev', 'curr']),
+                             ['bash', 'cygwin', 'libfoo0', 'libfoo1'])
+            getany.assert_not_called()
+
+        info.Set('depends2', 'cygwin, libfoo3', 'prev')
+        self.assertEqual(info.GetDependencies(['prev']),
+                         ['cygwin', 'libfoo3'])
+        restored = pickle.loads(pickle.dumps(info))
+        self.assertEqual(restored.GetDependencies(['test']),
+                         ['cygwin', 'libbar', 'libfoo2'])
+
+    def testEpochExpansion(self):
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        with open(path, 'wt', encoding='utf-8') as fp:
+            fp.write('release: cygwin\narch: x86_64\n\n'
+                     '@ app\nsdesc: "Application"\ndepends2: libnew\n'
+                     '[prev]\ndepends2: libold\n\n'
+                     '@ libnew\nsdesc: "New library"\n\n'
+                     '@ libold\nsdesc: "Old library"\n')
+        for lazy in (False, True):
+            masterList = MasterPackageList(iniURL='file:' + path,
+                                           Viewer=SilentBuildViewer(),
+                                           Lazy=lazy)
+            pkgProc = PkgSetProcessor(masterList)
+            self.assertEqual(pkgProc.ExpandDependencies(['app']),
+                             ['app', 'libnew'])
+            self.assertEqual(pkgProc.ExpandDependencies(['app'], ['prev']),
+                             ['app', 'libold'])
+            self.assertEqual(pkgProc.ExpandDependencies(['app'],
+                                                        ['curr', 'prev']),
+                             ['app', 'libnew', 'libold'])
+
+    def testEpochContraction(self):
+        """Check that contraction reverses expansion within
+        the same, possibly non-default, epochs"""
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        with open(path, 'wt', encoding='utf-8') as fp:
+            fp.write('release: cygwin\narch: x86_64\n\n'
+                     '@ app\nsdesc: "Application"\ndepends2: libnew\n'
+                     '[prev]\ndepends2: libold\n\n'
+                     '@ libnew\nsdesc: "New library"\n\n'
+                     '@ libold\nsdesc: "Old library"\n')
+        messages = []
+        class RecordingViewer(SilentBuildViewer):
+            def _output(self, text, severity):
+                messages.append(text)
+
+        masterList = MasterPackageList(iniURL='file:' + path,
+                                       Viewer=RecordingViewer())
+        pkgProc = PkgSetProcessor(masterList)
+        for epochs in (['prev'], ['curr', 'prev']):
+            full = pkgProc.ExpandDependencies(['app', 'libnew'], epochs)
+            contracted = pkgProc.ContractDependencies(full, epochs=epochs)
+            self.assertEqual(pkgProc.ExpandDependencies(contracted, epochs),
+                             full, msg=epochs)
+        self.assertEqual(pkgProc.ContractDependencies(full,
+                                                      epochs=['curr', 'prev']),
+                         ['app'])
+        self.assertIn("Cannot find epoch 'prev' for libnew\n", messages)
+
+    def testQualifiedFields(self):
+        """Check that fields named after individual packages
+        do not enlarge the field table shared by all packages"""
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        with open(path, 'wt', encoding='utf-8') as fp:
+            fp.write('release: cygwin\narch: x86_64\n\n')
+            for idx in range(300):
+                fp.write('@ qualified{0:d}\nsdesc: "Package {0:d}"\n'
+                         'message: qualified{0:d} "Please note\n'
+                         'this"\n[prev]\nmessage: q{0:d} "Old"\n\n'
+                         .format(idx))
+        nfields = len(PackageSummary._fieldNames)
+        for workers in (1, 2):
+            masterList = MasterPackageList(iniURL='file:' + path,
+                                           Viewer=SilentBuildViewer(),
+                                           Workers=workers)
+            packages = masterList.GetPackageDict()
+            info = packages['qualified17']
+            self.assertIn('note\nthis', info.GetAny('message_qualified17'))
+            self.assertEqual(len(info.GetAll('message_q17')), 1)
+            self.assertIsNone(info.GetAny('message_qualified18'))
+            self.assertIn(('message_q17', 'prev'), dict(info.Items()))
+            restored = pickle.loads(pickle.dumps(info))
+            self.assertEqual(dict(restored.Items()), dict(info.Items()))
+        self.assertLessEqual(len(PackageSummary._fieldNames), nfields + 2)
+
+    def testMemory(self):
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        makeLargeSetupIni(path, npkgs=4000)
+
+        usage = {}
+        for summary in (DictPackageSummary, PackageSummary):
+            with unittest.mock.patch('pmcyg.core.PackageSummary', summary):
+                pkglist = MasterPackageList(iniURL='file:' + path,
+                                            Viewer=SilentBuildViewer())
+                tracemalloc.start()
+                packages = pkglist.GetPackageDict()
+                (usage[summary], peak) = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self.assertEqual(len(packages), 4000)
+                del packages, pkglist
+
+        # Both structures hold the same strings, so the saving
+        # derives entirely from the containers in which they are held:
+        self.assertLess(usage[PackageSummary],
+                        0.75 * usage[DictPackageSummary])
+
+
+
+class testLazyIndex(unittest.TestCase):
+    """Tests of deferred parsing of package descriptions"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def ingest(self, path, lazy, cachedir=None, iniURL=None):
+        pkglist = MasterPackageList(iniURL=(iniURL or 'file:' + path),
+                                    Viewer=SilentBuildViewer(),
+                                    CacheDir=cachedir, Lazy=lazy)
+        return (pkglist,) + pkglist.GetHeaderAndPackages()
+
+    def checkParity(self, path):
+        (eagerList, header, eager) = self.ingest(path, lazy=False)
+        (lazyList, lazyHeader, lazy) = self.ingest(path, lazy=True)
+        self.assertEqual(lazyHeader, header)
+        self.assertEqual(sorted(lazy), sorted(eager))
+        for (pkg, info) in eager.items():
+            self.assertIsInstance(lazy[pkg], LazyPackageSummary)
+            self.assertEqual(lazy[pkg].GetText(), info.GetText())
+            self.assertEqual(dict(lazy[pkg].Items()), dict(info.Items()))
+            self.assertEqual(lazy[pkg].GetDependencies(),
+                             info.GetDependencies())
+        return lazy
+
+    def testParity(self):
+        self.checkParity(os.path.join(TESTDIR, 'setup-awkward.ini'))
+
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        makeLargeSetupIni(path, npkgs=500)
+        self.checkParity(path)
+
+    def testQuotedHeaders(self):
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        with open(path, 'wt', encoding='utf-8') as fp:
+            fp.write('release: cygwin\n\n@ first\nsdesc: "First"\n'
+                     'ldesc: "Long description,\n@ notapackage\nstill'
+                     ' quoted"\ncategory: Base\n\n@ second\n'
+                     'sdesc: "Second"\n')
+        lazy = self.checkParity(path)
+        self.assertEqual(sorted(lazy), [ 'first', 'second' ])
+        self.assertEqual(lazy['first'].GetAny('category'), 'Base')
+
+    def testEmbeddedQuotes(self):
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        with open(path, 'wt', encoding='utf-8') as fp:
+            fp.write('release: cygwin\n\n@ a\nsdesc: "First"\n'
+                     'ldesc: "foo "bar\n@ b\nbaz"\ncategory: Base\n\n'
+                     '@ c\nsdesc: "Third"\n')
+        lazy = self.checkParity(path)
+        self.assertEqual(sorted(lazy), [ 'a', 'c' ])
+        self.assertEqual(lazy['a'].GetAny('ldesc'), 'foo "bar\n@ b\nbaz')
+        self.assertEqual(lazy['a'].GetAny('category'), 'Base')
+
+    def testDeferred(self):
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        pkgnames = makeLargeSetupIni(path, npkgs=2000)
+
+        (pkglist, header, packages) = self.ingest(path, lazy=True)
+        parsed = []
+        original = pkglist._parsePackageText
+        def countingParse(text):
+            parsed.append(text)
+            return original(text)
+        next(iter(packages.values()))._source.parser = countingParse
+
+        self.assertEqual(header['arch'], 'x86_64')
+        self.assertEqual(len(packages), 2000)
+        self.assertTrue(packages[pkgnames[0]].GetText() \
+                            .startswith('@ ' + pkgnames[0]))
+        self.assertEqual(parsed, [])
+
+        self.assertTrue(packages[pkgnames[7]].HasFileContent())
+        packages[pkgnames[7]].GetAny('install')
+        packages[pkgnames[9]].GetAll('install')
+        self.assertEqual(len(parsed), 2)
+
+    def testSnapshot(self):
+        mirror = LocalMirror(npkgs=0)
+        self.addCleanup(mirror.close)
+        path = os.path.join(mirror.topdir, 'setup.ini')
+        iniURL = mirror.url + 'setup.ini'
+        pkgnames = makeLargeSetupIni(path, npkgs=200)
+        cachedir = os.path.join(self._tmpdir.name, 'cache')
+
+        (pkglist, header, packages) = self.ingest(path, True, cachedir, iniURL)
+        expected = packages[pkgnames[-1]].GetAll('install')
+        (pkglist2, header2, packages2) = self.ingest(path, True,
+                                                     cachedir, iniURL)
+        self.assertIsInstance(packages2[pkgnames[-1]], LazyPackageSummary)
+        self.assertEqual(packages2[pkgnames[-1]].GetAll('install'), expected)
+
+        # Snapshots are specific to whether parsing is deferred:
+        (pkglist3, header3, packages3) = self.ingest(path, False,
+                                                     cachedir, iniURL)
+        self.assertNotIsInstance(packages3[pkgnames[-1]], LazyPackageSummary)
+        self.assertEqual(packages3[pkgnames[-1]].GetAll('install'), expected)
+
+    def testLargeIndex(self):
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        pkgnames = makeLargeSetupIni(path)
+
+        results = {}
+        for lazy in (False, True):
+            (pkglist, header, packages) = self.ingest(path, lazy)
+            parsed = []
+            if lazy:
+                original = pkglist._parsePackageText
+                def countingParse(text):
+                    parsed.append(text)
+                    return original(text)
+                next(iter(packages.values()))._source.parser = countingParse
+            deps = [ packages[pkg].GetDependencies()
+                        for pkg in pkgnames[:100] ]
+            text = '\n'.join(packages[pkg].GetText() for pkg in pkgnames)
+            self.assertEqual(len(packages), len(pkgnames))
+            results[lazy] = (deps, text)
+
+        # Only packages whose fields were needed should have been parsed:
+        self.assertEqual(len(parsed), 100)
+        self.assertEqual(results[True], results[False])
+
+
+class testParallelParsing(unittest.TestCase):
+    """Tests of parsing setup.ini within a pool of processes"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def ingest(self, path, workers):
+        pkglist = MasterPackageList(iniURL='file:' + path,
+                                    Viewer=SilentBuildViewer(),
+                                    Workers=workers)
+        return pkglist.GetHeaderAndPackages()
+
+    def checkParity(self, path, workers=4):
+        (header, serial) = self.ingest(path, 1)
+        (parHeader, parallel) = self.ingest(path, workers)
+        self.assertEqual(parHeader, header)
+        self.assertEqual(list(parallel), list(serial))
+        for (pkg, info) in serial.items():
+            self.assertEqual(dict(parallel[pkg].Items()), dict(info.Items()))
+        return parallel
+
+    def testParity(self):
+        self.checkParity(os.path.join(TESTDIR, 'setup-awkward.ini'))
+
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        makeLargeSetupIni(path, npkgs=300)
+        self.checkParity(path, workers=3)
+
+    def testQuotedBoundaries(self):
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        with open(path, 'wt', encoding='utf-8') as fp:
+            fp.write('release: cygwin\narch: x86_64\n\n')
+            for idx in range(40):
+                fp.write('@ pkg{0:d}\nsdesc: "Package {0:d}"\n'
+                         'ldesc: "Multi-line description\n@ fake{0:d}\n'
+                         '[prev]\nversion: 0.{0:d}"\n'
+                         'version: 1.{0:d}\n\n'.format(idx))
+        packages = self.checkParity(path, workers=8)
+        self.assertEqual(len(packages), 40)
+        self.assertIn('@ fake17', packages['pkg17'].GetAny('ldesc'))
+        self.assertEqual(packages['pkg17'].GetAll('version'), ['1.17'])
+
+    def testEmbeddedQuotes(self):
+        """Check that chunks are divided where the serial parser would
+        end a quotation, regardless of any quotes within it"""
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        with open(path, 'wt', encoding='utf-8') as fp:
+            fp.write('release: cygwin\narch: x86_64\n\n')
+            for idx in range(40):
+                fp.write('@ pkg{0:d}\nsdesc: "Package {0:d}"\n'
+                         'ldesc: "foo "bar\n@ fake{0:d}\n"quoted" word\n'
+                         '@ other{0:d}\nbaz"\n'
+                         'message: pkg{0:d} "Note \n@ extra{0:d}\n"\n'
+                         'version: 1.{0:d}\n\n'.format(idx))
+        packages = self.checkParity(path, workers=8)
+        self.assertEqual(len(packages), 40)
+        self.assertIn('@ other17', packages['pkg17'].GetAny('ldesc'))
+        self.assertIn('@ extra17', packages['pkg17'].GetAny('message_pkg17'))
+        self.assertEqual(packages['pkg17'].GetAll('version'), ['1.17'])
+
+    def testLineNumbers(self):
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        makeLargeSetupIni(path, npkgs=200)
+        with open(path, 'rt', encoding='utf-8') as fp:
+            lines = fp.readlines()
+        lines.insert(len(lines) - 5, '!unrecognized\n')
+        with open(path, 'wt', encoding='utf-8') as fp:
+            fp.writelines(lines)
+
+        with self.assertRaisesRegex(SyntaxError,
+                                    'line {0:d}$'.format(len(lines) - 5)):
+            self.ingest(path, 4)
+
+    def testFieldMapping(self):
+        self.assertIsNone(PackageSummary._fieldMapping(
+                                list(PackageSummary._fieldNames)))
+
+        info = PackageSummary._fromArrays(('curr', 'prev'),
+                                          ([ 'a', None, 'b' ], [ 'c' ]),
+                                          PackageSummary._fieldMapping(
+                                            [ 'version', 'sdesc',
+                                              'never-seen-remotely' ]))
+        self.assertEqual(dict(info.Items()),
+                         { ('version', 'curr'): 'a',
+                           ('never-seen-remotely', 'curr'): 'b',
+                           ('version', 'prev'): 'c' })
+
+    def testLargeIndex(self):
+        path = os.path.join(self._tmpdir.name, 'setup.ini')
+        pkgnames = makeLargeSetupIni(path, npkgs=8000)
+        packages = self.checkParity(path, workers=4)
+        self.assertEqual(len(packages), len(pkgnames))
+
+
+class testIncrementalIngest(unittest.TestCase):
+    """Tests of reusing unchanged package descriptions on reloading setup.ini"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmpdir.name, 'setup.ini')
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def rewrite(self, substitutions):
+        with open(self.path, 'rt', encoding='utf-8') as fp:
+            text = fp.read()
+        for (old, new) in substitutions:
+            self.assertIn(old, text)
+            text = text.replace(old, new, 1)
+        with open(self.path, 'wt', encoding='utf-8') as fp:
+            fp.write(text)
+
+    def testReuse(self):
+        pkgnames = makeLargeSetupIni(self.path, npkgs=300)
+        pkglist = MasterPackageList(iniURL='file:' + self.path,
+                                    Viewer=SilentBuildViewer())
+        original = dict(pkglist.GetPackageDict())
+        categories = pkglist.GetCategories()
+        self.assertIsNone(pkglist.GetChangedPackages())
+
+        pkglist.SetSourceURL('file:' + self.path, reload=True)
+        self.assertEqual(pkglist.GetChangedPackages(), set())
+        for (pkg, info) in pkglist.GetPackageDict().items():
+            self.assertIs(info, original[pkg])
+
+        self.rewrite([ ('@ {0}\nsdesc: "'.format(pkgnames[10]),
+                        '@ {0}\nsdesc: "Revised '.format(pkgnames[10])),
+                       ('@ {0}\n'.format(pkgnames[20]),
+                        '@ newcomer\nsdesc: "New"\ncategory: Novel\n\n'
+                        '@ {0}\n'.format(pkgnames[20])),
+                       ('@ {0}\n'.format(pkgnames[30]),
+                        '@ {0}-renamed\n'.format(pkgnames[30])) ])
+        pkglist.SetSourceURL('file:' + self.path, reload=True)
+        packages = pkglist.GetPackageDict()
+        self.assertEqual(pkglist.GetChangedPackages(),
+                         { pkgnames[10], 'newcomer', pkgnames[30],
+                           pkgnames[30] + '-renamed' })
+        self.assertTrue(packages[pkgnames[10]].GetAny('sdesc') \
+                            .startswith('Revised '))
+        self.assertIsNot(packages[pkgnames[10]], original[pkgnames[10]])
+        self.assertIs(packages[pkgnames[11]], original[pkgnames[11]])
+        self.assertNotIn(pkgnames[30], packages)
+
+        # The result should be indistinguishable from a fresh ingest:
+        fresh = MasterPackageList(iniURL='file:' + self.path,
+                                  Viewer=SilentBuildViewer())
+        self.assertEqual(pkglist.GetHeaderInfo(), fresh.GetHeaderInfo())
+        self.assertEqual(list(packages), list(fresh.GetPackageDict()))
+        for (pkg, info) in fresh.GetPackageDict().items():
+            self.assertEqual(dict(packages[pkg].Items()), dict(info.Items()))
+        updated = pkglist.GetCategories()
+        self.assertEqual(updated, fresh.GetCategories())
+        self.assertEqual(updated['Novel'], ['newcomer'])
+        self.assertNotEqual(updated, categories)
+
+    def testSnapshot(self):
+        mirror = LocalMirror(npkgs=0)
+        self.addCleanup(mirror.close)
+        self.path = os.path.join(mirror.topdir, 'setup.ini')
+        iniURL = mirror.url + 'setup.ini'
+        pkgnames = makeLargeSetupIni(self.path, npkgs=100)
+        cachedir = os.path.join(self._tmpdir.name, 'cache')
+        pkglist = MasterPackageList(iniURL=iniURL,
+                                    Viewer=SilentBuildViewer(),
+                                    CacheDir=cachedir)
+        pkglist.GetPackageDict()
+
+        pkglist.SetSourceURL(iniURL, reload=True)
+        self.assertEqual(pkglist.GetChangedPackages(), set())
+        self.rewrite([ ('@ {0}\n'.format(pkgnames[5]),
+                        '@ {0}\nmessage: "Changed"\n'.format(pkgnames[5])) ])
+        pkglist.SetSourceURL(iniURL, reload=True)
+        self.assertEqual(pkglist.GetChangedPackages(), { pkgnames[5] })
+
+    def testLargeIndex(self):
+        pkgnames = makeLargeSetupIni(self.path)
+        pkglist = MasterPackageList(iniURL='file:' + self.path,
+                                    Viewer=SilentBuildViewer())
+        pkglist.GetCategories()
+        graph = pkglist.GetDependencyGraph()
+
+        self.rewrite([ ('@ {0}\nsdesc: "'.format(pkg),
+                        '@ {0}\nsdesc: "Revised '.format(pkg))
+                        for pkg in pkgnames[::100] ])
+        parsed = []
+        original = pkglist._parsePackageText
+        def countingParse(text, firstLine=None):
+            parsed.append(firstLine)
+            return original(text, firstLine)
+        pkglist._parsePackageText = countingParse
+        pkglist.SetSourceURL('file:' + self.path, reload=True)
+        self.assertEqual(len(pkglist.GetChangedPackages()), 120)
+        self.assertEqual(len(parsed), 120)
+        self.assertIsNot(pkglist.GetDependencyGraph(), graph)
+        self.assertEqual(pkglist.GetCategories()['All'], sorted(pkgnames))
+
+    def testLineNumbers(self):
+        pkgnames = makeLargeSetupIni(self.path, npkgs=200)
+        pkglist = MasterPackageList(iniURL='file:' + self.path,
+                                    Viewer=SilentBuildViewer())
+        pkglist.GetPackageDict()
+
+        with open(self.path, 'rt', encoding='utf-8') as fp:
+            lines = fp.readlines()
+        pos = lines.index('@ {0}\n'.format(pkgnames[150]))
+        lines.insert(pos + 1, '!unrecognized\n')
+        with open(self.path, 'wt', encoding='utf-8') as fp:
+            fp.writelines(lines)
+
+        pkglist.SetSourceURL('file:' + self.path, reload=True)
+        with self.assertRaisesRegex(SyntaxError,
+                                    'line {0:d}$'.format(pos + 2)):
+            pkglist.GetPackageDict()
+
+
+def referenceDependencies(pkginfo, epoch):
+    """Parse the dependencies of a package afresh, on every query"""
+    deps = set()
+    for (field, sep) in (('depends2', ','), ('requires', None)):
+        value = pkginfo.GetAny(field, [epoch])
+        if value:
+            deps.update(d.strip() for d in value.split(sep))
+    return sorted(deps)
+
+
+def referenceExpand(pkgdict, selected, epochs=['curr']):
+    """Dependency expansion, as implemented by earlier versions of pmcyg,
+    by repeatedly querying each PackageSummary"""
+    additions = set(selected)
+    packages = set()
+    while additions:
+        pkg = additions.pop()
+        packages.add(pkg)
+        for epoch in epochs:
+            for req in referenceDependencies(pkgdict[pkg], epoch):
+                if req in pkgdict and req not in packages:
+                    additions.add(req)
+    return sorted(packages)
+
+
+class testDependencyGraph(unittest.TestCase):
+    """Tests of integer-indexed graph of package dependencies"""
+    @classmethod
+    def setUpClass(cls):
+        cls._tmpdir = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls._tmpdir.name, 'setup.ini')
+        cls.pkgnames = makeLargeSetupIni(cls.path, npkgs=3000)
+        with open(cls.path, 'at', encoding='utf-8') as fp:
+            fp.write('@ dangling\nsdesc: "Broken"\ncategory: Misc\n'
+                     'requires: {0} nonexistent\n\n'.format(cls.pkgnames[3]))
+            fp.write('@ loop-a\nsdesc: "Cyclic"\ncategory: Misc\n'
+                     'requires: loop-b {0}\n\n'
+                     '@ loop-b\nsdesc: "Cyclic"\ncategory: Misc\n'
+                     'requires: loop-a\n'.format(cls.pkgnames[5]))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmpdir.cleanup()
+
+    def setUp(self):
+        self.masterList = MasterPackageList(iniURL='file:' + self.path,
+                                            Viewer=SilentBuildViewer())
+        self.pkgProc = PkgSetProcessor(self.masterList)
+
+    def testStructure(self):
+        pkgdict = self.masterList.GetPackageDict()
+        graph = self.masterList.GetDependencyGraph()
+        self.assertIs(self.masterList.GetDependencyGraph(), graph)
+        self.assertEqual(len(graph), len(pkgdict))
+
+        nedges = 0
+        for (pkg, info) in pkgdict.items():
+            idx = graph.GetId(pkg)
+            self.assertEqual(graph.GetName(idx), pkg)
+            deps = [ graph.GetName(r) for r in graph.Requires(idx) ]
+            self.assertEqual(deps, [ d for d in info.GetDependencies()
+                                        if d in pkgdict ])
+            for req in graph.Requires(idx):
+                self.assertIn(idx, graph.RequiredBy(req))
+            nedges += len(deps)
+        self.assertEqual(sum(len(graph.RequiredBy(idx))
+                             for idx in range(len(graph))), nedges)
+        self.assertEqual(graph.Unresolved(),
+                         { graph.GetId('dangling'): [ 'nonexistent' ] })
+        self.assertIsNone(graph.GetId('nonexistent'))
+
+        self.masterList.SetSourceURL('file:' + self.path, reload=True)
+        self.assertIsNot(self.masterList.GetDependencyGraph(), graph)
+
+    def testExpand(self):
+        pkgdict = self.masterList.GetPackageDict()
+        rng = random.Random(7)
+        for trial in range(20):
+            selected = rng.sample(self.pkgnames, rng.randint(1, 30))
+            for epochs in (['curr'], ['curr', 'prev']):
+                self.assertEqual(
+                    self.pkgProc.ExpandDependencies(selected, epochs),
+                    referenceExpand(pkgdict, selected, epochs))
+
+        self.assertEqual(self.pkgProc.ExpandDependencies([]), [])
+        self.assertEqual(self.pkgProc.ExpandDependencies(['dangling']),
+                         referenceExpand(pkgdict, ['dangling']))
+        with self.assertRaises(PMCygException):
+            self.pkgProc.ExpandDependencies(['dangling', 'no-such-package'])
+        self.assertIn('no-such-package',
+                      self.pkgProc.ExpandDependencies(['no-such-package'],
+                                                      ignoreUnresolved=True))
+
+    def testContract(self):
+        graph = self.masterList.GetDependencyGraph()
+        rng = random.Random(11)
+        for trial in range(10):
+            selected = rng.sample(self.pkgnames, rng.randint(1, 40))
+            full = self.pkgProc.ExpandDependencies(selected)
+            contracted = self.pkgProc.ContractDependencies(full)
+            self.assertLessEqual(len(contracted), len(full))
+            self.assertEqual(self.pkgProc.ExpandDependencies(contracted),
+                             full)
+
+            # No retained package should be a dependency of another:
+            for pkg in contracted:
+                others = [ graph.GetId(p) for p in contracted if p != pkg ]
+                self.assertNotIn(graph.GetId(pkg), graph.Closure(others))
+
+        everything = sorted(self.masterList.GetPackageDict())
+        contracted = self.pkgProc.ContractDependencies(everything)
+        self.assertEqual(self.pkgProc.ExpandDependencies(contracted),
+                         everything)
+        self.assertEqual(len([ p for p in contracted
+                                if p.startswith('loop-') ]), 1)
+
+    def testComponents(self):
+        graph = self.masterList.GetDependencyGraph()
+        (component, ncomponents) = graph.Components()
+        self.assertEqual(len(component), len(graph))
+        self.assertEqual(set(component), set(range(ncomponents)))
+
+        for idx in range(len(graph)):
+            for req in graph.Requires(idx):
+                self.assertLessEqual(component[req], component[idx])
+                if component[req] == component[idx]:
+                    self.assertIn(idx, graph.Closure([ req ]))
+        self.assertEqual(component[graph.GetId('loop-a')],
+                         component[graph.GetId('loop-b')])
+        self.assertEqual(ncomponents, len(graph) - 1)
+
+    def testLoops(self):
+        path = os.path.join(self._tmpdir.name, 'loops.ini')
+        with open(path, 'wt', encoding='utf-8') as fp:
+            fp.write('release: cygwin\narch: x86_64\n\n')
+            for (pkg, reqs) in (('gcc-g++', 'gcc-mingw-g++ libc'),
+                                ('gcc-mingw-g++', 'gcc-g++'),
+                                ('libc', ''), ('tool', 'gcc-g++'),
+                                ('ring-a', 'ring-b'), ('ring-b', 'ring-c'),
+                                ('ring-c', 'ring-a libc'),
+                                ('solo', '')):
+                fp.write('@ {0}\nsdesc: "{0}"\nrequires: {1}\n\n' \
+                            .format(pkg, reqs))
+        masterList = MasterPackageList(iniURL='file:' + path,
+                                       Viewer=SilentBuildViewer())
+        pkgProc = PkgSetProcessor(masterList)
+        contract = lambda pkgs: pkgProc.ContractDependencies(pkgs)
+
+        self.assertEqual(contract(['gcc-g++', 'gcc-mingw-g++', 'libc']),
+                         ['gcc-g++'])
+        self.assertEqual(contract(['gcc-g++', 'gcc-mingw-g++', 'libc',
+                                   'tool', 'solo']), ['solo', 'tool'])
+        self.assertEqual(contract(['ring-c', 'ring-b', 'ring-a', 'libc']),
+                         ['ring-a'])
+        self.assertEqual(contract(['ring-c', 'libc', 'obsolete']),
+                         ['obsolete', 'ring-c'])
+        self.assertEqual(contract([]), [])
+
+    def testExpandMany(self):
+        pkgdict = self.masterList.GetPackageDict()
+        graph = self.masterList.GetDependencyGraph()
+        rng = random.Random(5)
+        selections = [ rng.sample(self.pkgnames, rng.randint(0, 30))
+                        for i in range(15) ]
+        selections.append([ 'loop-b', 'dangling' ])
+        selections.append([ 'loop-a' ])
+
+        for epochs in (['curr'], ['curr', 'prev']):
+            expected = [ self.pkgProc.ExpandDependencies(sel, epochs)
+                            for sel in selections ]
+            self.assertEqual(self.pkgProc.ExpandMany(selections, epochs),
+                             expected)
+            self.assertEqual(self.pkgProc.ExpandMany(selections[::-1],
+                                                     epochs),
+                             expected[::-1])
+
+        with self.assertRaises(PMCygException):
+            self.pkgProc.ExpandMany([ [ 'no-such-package' ] ])
+        self.assertEqual(self.pkgProc.ExpandMany([ [ 'no-such-package' ] ],
+                                                 ignoreUnresolved=True),
+                         [ [ 'no-such-package' ] ])
+
+        # Closures should be shared by all packages within a loop,
+        # and discarded when the package list is cleared:
+        self.assertIs(graph.MemoizedClosure([ graph.GetId('loop-a') ]),
+                      graph.MemoizedClosure([ graph.GetId('loop-b') ]))
+        self.masterList.ClearCache()
+        self.assertIsNot(self.masterList.GetDependencyGraph(), graph)
+
+    def testMemoization(self):
+        rng = random.Random(9)
+        common = rng.sample(self.pkgnames[-1000:], 40)
+        selections = [ common + rng.sample(self.pkgnames, 10)
+                        for i in range(40) ]
+        expected = [ self.pkgProc.ExpandDependencies(sel)
+                        for sel in selections ]
+
+        graph = self.masterList.GetDependencyGraph()
+        self.assertEqual(self.pkgProc.ExpandMany(selections), expected)
+        memo = dict(graph._closures[('curr',)])
+        self.assertGreater(len(memo), 0)
+
+        # Repeated queries should be answered entirely from the memo:
+        self.assertEqual(self.pkgProc.ExpandMany(selections), expected)
+        self.assertEqual(graph._closures[('curr',)], memo)
+        for (comp, closure) in memo.items():
+            self.assertIs(graph._closures[('curr',)][comp], closure)
+
+    def closureSize(self, pkgs, epochs=['curr']):
+        pkgdict = self.masterList.GetPackageDict()
+        return sum(self.pkgProc._packageSize(pkg, epochs)
+                    for pkg in referenceExpand(pkgdict, pkgs, epochs))
+
+    def testDominators(self):
+        graph = self.masterList.GetDependencyGraph()
+        rng = random.Random(13)
+        selected = rng.sample(self.pkgnames, 12) + [ 'loop-a', 'dangling' ]
+        seeds = [ graph.GetId(pkg) for pkg in selected ]
+        (order, idom) = graph.Dominators(seeds)
+        self.assertEqual(set(order), graph.Closure(seeds))
+        rank = { idx: pos for (pos, idx) in enumerate(order) }
+
+        def reachableAvoiding(avoid):
+            visited = set(s for s in seeds if s != avoid)
+            stack = list(visited)
+            while stack:
+                for tgt in graph.Requires(stack.pop()):
+                    if tgt != avoid and tgt not in visited:
+                        visited.add(tgt)
+                        stack.append(tgt)
+            return visited
+
+        for idx in rng.sample(order, 40) + seeds:
+            dom = idom[idx]
+            if idx in seeds:
+                self.assertIsNone(dom)
+                continue
+            if dom is not None:
+                self.assertLess(rank[dom], rank[idx])
+                self.assertNotIn(idx, reachableAvoiding(dom))
+                # No package dominated by dom should also dominate idx:
+                for other in graph.Closure([ dom ]):
+                    if other not in (dom, idx) and idom.get(other) == dom:
+                        self.assertIn(idx, reachableAvoiding(other))
+            else:
+                self.assertTrue(any(idx in reachableAvoiding(s)
+                                    for s in seeds))
+
+    def testSizeAttribution(self):
+        rng = random.Random(17)
+        for trial in range(3):
+            selected = rng.sample(self.pkgnames, 15) + [ 'loop-a' ]
+            selected.append(rng.choice(self.pkgnames[:100]))
+            (report, total) = self.pkgProc.AttributeSizes(selected)
+            self.assertEqual(total, self.closureSize(selected))
+            self.assertEqual(sorted(pkg for (pkg, ex, sh) in report),
+                             sorted(set(selected)))
+            self.assertEqual(report, sorted(report,
+                                            key=lambda r: (-r[1], r[0])))
+
+            for (pkg, exclusive, shared) in report:
+                others = [ p for p in selected if p != pkg ]
+                self.assertEqual(exclusive,
+                                 total - self.closureSize(others))
+                self.assertEqual(exclusive + shared,
+                                 self.closureSize([ pkg ]))
+
+        with self.assertRaises(PMCygException):
+            self.pkgProc.AttributeSizes([ 'no-such-package' ])
+
+    def testSizeReport(self):
+        listing = os.path.join(self._tmpdir.name, 'packages.txt')
+        with open(listing, 'wt', encoding='utf-8') as fp:
+            fp.write('\n'.join(self.pkgnames[-3:] + [ 'loop-b', '' ]))
+
+        builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                            Viewer=SilentBuildViewer())
+        builder.setup_ini_url = 'file:' + self.path
+        builder.SetOption('IncludeBase', False)
+        stream = io.StringIO()
+        builder.SizeReport(PackageSet([ listing ]), stream)
+
+        lines = stream.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('#'))
+        self.assertEqual(sorted(line.split()[-1] for line in lines[1:-1]),
+                         sorted(self.pkgnames[-3:] + [ 'loop-b' ]))
+        self.assertTrue(lines[-1].startswith('# Total size: '))
+
+    def testExplain(self):
+        pkgdict = self.masterList.GetPackageDict()
+        pkgProc = PkgSetProcessor(self.masterList)
+        self.assertRaises(PMCygException, pkgProc.Explain, 'loop-a')
+
+        selected = [ self.pkgnames[-1], self.pkgnames[-40], 'dangling' ]
+        expanded = pkgProc.ExpandDependencies(selected, recordPaths=True,
+                                              ignoreUnresolved=True)
+
+        # Reference breadth-first distances from the selection:
+        distances = dict.fromkeys(selected, 0)
+        frontier = list(selected)
+        while frontier:
+            successors = []
+            for pkg in frontier:
+                for req in referenceDependencies(pkgdict[pkg], 'curr'):
+                    if req in pkgdict and req not in distances:
+                        distances[req] = distances[pkg] + 1
+                        successors.append(req)
+            frontier = successors
+
+        for pkg in expanded:
+            if pkg not in pkgdict:
+                continue
+            path = pkgProc.Explain(pkg)
+            self.assertIn(path[0], selected)
+            self.assertEqual(path[-1], pkg)
+            self.assertEqual(len(path), distances[pkg] + 1)
+            for (parent, child) in zip(path[:-1], path[1:]):
+                self.assertIn(child, referenceDependencies(pkgdict[parent],
+                                                           'curr'))
+
+        self.assertEqual(pkgProc.Explain('dangling'), [ 'dangling' ])
+        self.assertIsNone(pkgProc.Explain('loop-b'))
+        self.assertIsNone(pkgProc.Explain('nonexistent'))
+
+    def testWhy(self):
+        listing = os.path.join(self._tmpdir.name, 'why.txt')
+        with open(listing, 'wt', encoding='utf-8') as fp:
+            fp.write('loop-b\n')
+
+        builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                            Viewer=SilentBuildViewer())
+        builder.setup_ini_url = 'file:' + self.path
+        builder.SetOption('IncludeBase', False)
+        stream = io.StringIO()
+        builder.ExplainPackages(PackageSet([ listing ]),
+                                [ 'loop-b', 'loop-a', 'dangling' ], stream)
+
+        self.assertEqual(stream.getvalue().splitlines(),
+                         [ 'loop-b: selected',
+                           'loop-a: required by loop-b',
+                           'dangling: not included' ])
+
+    def testClosureWeights(self):
+        pkgdict = self.masterList.GetPackageDict()
+        graph = self.masterList.GetDependencyGraph()
+        everything = sorted(pkgdict)
+        seeds = [ graph.GetId(pkg) for pkg in everything ]
+        weights = [ self.pkgProc._packageSize(pkg, ['curr'])
+                        for pkg in everything ]
+
+        (report, total) = self.pkgProc.AttributeSizes(everything)
+        reference = [ sum(weights[idx] for idx in graph.Closure([ seed ]))
+                        for seed in seeds ]
+
+        self.assertEqual(graph.ClosureWeights(seeds, weights), reference)
+        self.assertEqual(total, sum(weights))
+        closureSizes = dict(zip(everything, reference))
+        for (pkg, exclusive, shared) in report:
+            self.assertEqual(exclusive + shared, closureSizes[pkg])
+        self.assertLessEqual(sum(exclusive
+                                    for (pkg, exclusive, shared) in report),
+                             total)
+
+    def testReferenceExpansion(self):
+        pkgdict = self.masterList.GetPackageDict()
+        rng = random.Random(3)
+        selections = [ rng.sample(self.pkgnames, 50) for i in range(20) ]
+        selections.append(list(pkgdict))
+
+        reference = [ referenceExpand(pkgdict, sel) for sel in selections ]
+        expanded = [ self.pkgProc.ExpandDependencies(sel)
+                        for sel in selections ]
+        self.assertEqual(expanded, reference)
+
+
 class testPkgSetProcessor(unittest.TestCase):
     def setUp(self):
         self.masterList = MasterPackageList(Viewer=SilentBuildViewer())
@@ -260,9 +1811,9 @@ class testPkgSetProcessor(unittest.TestCase):
 class testBuilder(unittest.TestCase):
     def setUp(self):
         self._tmpdir = tempfile.TemporaryDirectory()
-        self.builder = PMbuilder(Viewer=SilentBuildViewer())
+        self.builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                                 Viewer=SilentBuildViewer())
         self.builder.setup_ini_url = getSetupURL()
-        self.builder.SetTargetDir(self._tmpdir.name)
         self.makeTemplate = self.builder._pkgProc.MakeTemplate
 
     def tearDown(self):
@@ -301,7 +1852,8 @@ class testBuilder(unittest.TestCase):
 
     def testDummyDownloads(self):
         for arch in [ 'x86_64' ]:
-            builder = PMbuilder(Viewer=SilentBuildViewer())
+            builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                                Viewer=SilentBuildViewer())
             builder.SetOption('DummyDownload', True)
             builder.SetArch(arch)
 
@@ -361,6 +1913,938 @@ class testBuilder(unittest.TestCase):
 
 
 
+class testDownloading(unittest.TestCase):
+    """Tests of package downloading from a local HTTP mirror"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = LocalMirror(delay=0.05)
+
+    def tearDown(self):
+        self.mirror.close()
+        self._tmpdir.cleanup()
+
+    def mkBuilder(self, **kwargs):
+        builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                            Viewer=SilentBuildViewer(), **kwargs)
+        self.mirror.configure(builder, self._tmpdir.name)
+        return builder
+
+    def checkMirrored(self, builder):
+        counts = builder._fetchStats.Counts()
+        self.assertEqual(counts['Fail'], 0)
+        self.assertEqual(counts['Total'], len(self.mirror.packages))
+        for (relpath, payload) in self.mirror.packages.values():
+            with open(os.path.join(self._tmpdir.name, relpath), 'rb') as fp:
+                self.assertEqual(fp.read(), payload)
+
+    def mkPkgSet(self):
+        pkgset = PackageSet()
+        pkgset.extend(self.mirror.packages.keys())
+        return pkgset
+
+    def testSerial(self):
+        builder = self.mkBuilder()
+        builder.BuildMirror(self.mkPkgSet())
+        self.checkMirrored(builder)
+
+    def testPersistence(self):
+        builder = self.mkBuilder()
+        builder.BuildMirror(self.mkPkgSet())
+        self.checkMirrored(builder)
+        self.assertEqual(self.mirror.connections, 1)
+
+    def testConcurrent(self):
+        builder = self.mkBuilder(DownloadWorkers=6)
+        pkgset = self.mkPkgSet()
+        builder.BuildMirror(pkgset)
+        self.checkMirrored(builder)
+        self.assertEqual(builder._fetchStats.Counts()['New'],
+                         len(self.mirror.packages))
+
+        builder.BuildMirror(pkgset)
+        self.checkMirrored(builder)
+        self.assertEqual(builder._fetchStats.Counts()['Already'],
+                         len(self.mirror.packages))
+
+    def testDuplicates(self):
+        """Check that repeated entries are not fetched concurrently"""
+        (relpath, payload) = self.mirror.packages['pkg5']
+        downloads = [ (relpath, len(payload),
+                       hashlib.sha512(payload).hexdigest()) ] * 4
+        for engine in ('threads', 'asyncio'):
+            builder = self.mkBuilder(Engine=engine, DownloadWorkers=4,
+                                     MaxRetries=0)
+            tgtpath = os.path.join(self._tmpdir.name, relpath)
+            if os.path.isfile(tgtpath):
+                os.remove(tgtpath)
+            builder._garbage.IndexCurrentFiles(self._tmpdir.name)
+            augdownloads = builder._preparePaths(downloads)
+            self.assertEqual(len(augdownloads), 1)
+            builder._fetchStats = FetchStats(downloads[:1])
+
+            scheduler = builder._makeRetryScheduler(augdownloads)
+            builder._fetchAll(scheduler)
+            self.assertEqual(builder._fetchStats.Counts()['Fail'], 0,
+                             msg=engine)
+            with open(tgtpath, 'rb') as fp:
+                self.assertEqual(fp.read(), payload, msg=engine)
+
+
+
+class testScheduling(unittest.TestCase):
+    """Tests of size-aware ordering of concurrent downloads"""
+    def testMakespan(self):
+        predict = PMbuilder._predictMakespan
+        self.assertEqual(predict([], 3), 0)
+        self.assertEqual(predict([ 5, 4, 3, 3, 3 ], 2), 10)
+        self.assertEqual(predict([ 3, 3, 3, 4, 5 ], 2), 11)
+        self.assertEqual(predict([ 1, 2, 3 ], 1), 6)
+
+    def testTransferModel(self):
+        stats = FetchStats()
+        self.assertIsNone(stats.TransferModel())
+        for size in [ 1000, 5000, 20000, 80000 ]:
+            stats.AddNew('pkg', size, 0.1 + size / 1e5)
+        (latency, rate) = stats.TransferModel()
+        self.assertAlmostEqual(latency, 0.1)
+        self.assertAlmostEqual(rate, 1e5)
+
+    def testOrdering(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mirror = LocalMirror(npkgs=16, delay=0.02)
+            builder = PMbuilder(BuildDirectory=tmpdir,
+                                Viewer=SilentBuildViewer(), DownloadWorkers=4)
+            mirror.configure(builder, tmpdir)
+            builder._garbage.IndexCurrentFiles(tmpdir)
+
+            downloads = [ (relpath, len(payload), 'hash')
+                            for (relpath, payload) in mirror.packages.values() ]
+            scheduled = builder._scheduleDownloads(
+                                    builder._preparePaths(downloads))
+            self.assertEqual([ size for (ref, size, hash, tgt) in scheduled ],
+                             sorted((size for (ref, size, hash) in downloads),
+                                    reverse=True))
+
+            pkgset = PackageSet()
+            pkgset.extend(mirror.packages.keys())
+            builder.BuildMirror(pkgset)
+            mirror.close()
+
+            makespan = builder._fetchStats.Makespan()
+            self.assertGreater(makespan['Predicted'], 0)
+            self.assertGreater(makespan['Actual'], 0)
+
+            # Packages already present should be expected to take no time:
+            scheduled = builder._scheduleDownloads(scheduled)
+            self.assertEqual(builder._fetchStats.Makespan()['Predicted'], 0)
+
+    def testSharedSources(self):
+        """Check that a source tarball shared by several packages
+        is scheduled, and downloaded, only once"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mirror = LocalMirror(npkgs=8, delay=0.02)
+            srcpath = '{0}/release/pkg/pkg-1.0-1-src.tar.xz'.format(mirror.arch)
+            srcdata = os.urandom(1 << 12)
+            os.makedirs(os.path.join(mirror.topdir, os.path.dirname(srcpath)))
+            with open(os.path.join(mirror.topdir, srcpath), 'wb') as fp:
+                fp.write(srcdata)
+            srcline = 'source: {0} {1:d} {2}'.format(srcpath, len(srcdata),
+                                        hashlib.sha512(srcdata).hexdigest())
+            inipath = os.path.join(mirror.topdir, mirror.arch, 'setup.ini')
+            with open(inipath, 'rt', encoding='utf-8') as fp:
+                text = fp.read()
+            with open(inipath, 'wt', encoding='utf-8') as fp:
+                fp.write(re.sub(r'(?m)^(install: .*)$',
+                                lambda m: m.group(1) + '\n' + srcline, text))
+
+            builder = PMbuilder(BuildDirectory=tmpdir,
+                                Viewer=SilentBuildViewer(),
+                                DownloadWorkers=4, MaxRetries=0)
+            mirror.configure(builder, tmpdir)
+            builder.SetOption('IncludeSources', True)
+
+            downloads = [ (srcpath, len(srcdata), 'hash') ] * 3 \
+                        + [ (relpath, len(payload), 'hash')
+                                for (relpath, payload)
+                                    in mirror.packages.values() ]
+            augdownloads = [ (ref, size, hash, os.path.join(tmpdir, ref))
+                                for (ref, size, hash) in downloads ]
+            scheduled = builder._scheduleDownloads(augdownloads)
+            self.assertEqual(len(scheduled), len(mirror.packages) + 1)
+            self.assertEqual(len(set(scheduled)), len(scheduled))
+            predicted = builder._fetchStats.Makespan()['Predicted']
+            builder._scheduleDownloads(augdownloads[2:])
+            self.assertEqual(builder._fetchStats.Makespan()['Predicted'],
+                             predicted)
+
+            pkgset = PackageSet()
+            pkgset.extend(mirror.packages.keys())
+            builder.BuildMirror(pkgset)
+            mirror.close()
+
+            counts = builder._fetchStats.Counts()
+            self.assertEqual(counts['Fail'], 0)
+            self.assertEqual(counts['New'], len(mirror.packages) + 1)
+            with open(os.path.join(tmpdir, srcpath), 'rb') as fp:
+                self.assertEqual(fp.read(), srcdata)
+
+
+class testResumption(unittest.TestCase):
+    """Tests of resuming interrupted downloads via HTTP Range requests"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = LocalMirror(npkgs=4, maxsize=1<<18)
+        self.builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                                 Viewer=SilentBuildViewer())
+        self.mirror.configure(self.builder, self._tmpdir.name)
+
+    def tearDown(self):
+        self.mirror.close()
+        self._tmpdir.cleanup()
+
+    def mkDownload(self, pkg):
+        (relpath, payload) = self.mirror.packages[pkg]
+        pkghash = hashlib.sha512(payload).hexdigest()
+        tgtpath = os.path.join(self._tmpdir.name, os.path.basename(relpath))
+        return (self.mirror.url + relpath, len(payload), pkghash, tgtpath)
+
+    def testThreadedResume(self):
+        self.checkResume(self.builder._downloadSingle)
+
+    def testAsyncResume(self):
+        fetcher = AsyncDownloader(self.builder)
+        def download(*args):
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(fetcher._download(*args))
+            finally:
+                fetcher._closeIdle()
+                loop.close()
+        self.checkResume(download)
+
+    def checkResume(self, download):
+        (relpath, payload) = self.mirror.packages['pkg1']
+        (mirpath, pkgsize, pkghash, tgtpath) = self.mkDownload('pkg1')
+        partpath = tgtpath + PMbuilder.PartialSuffix
+        cutoff = pkgsize // 3
+        self.mirror.faults[relpath] = cutoff
+
+        (outcome, errmsg) = download(mirpath, pkgsize, pkghash, tgtpath)
+        self.assertNotEqual(outcome, PMbuilder.DL_Success)
+        self.assertFalse(os.path.exists(tgtpath))
+        self.assertEqual(os.path.getsize(partpath), cutoff)
+
+        (outcome, errmsg) = download(mirpath, pkgsize, pkghash, tgtpath)
+        self.assertEqual(outcome, PMbuilder.DL_Success)
+        self.assertFalse(os.path.exists(partpath))
+        self.assertEqual(self.mirror.ranges,
+                         [ ('/' + relpath, cutoff, pkgsize) ])
+        with open(tgtpath, 'rb') as fp:
+            self.assertEqual(fp.read(), payload)
+
+    def testCompletePart(self):
+        (relpath, payload) = self.mirror.packages['pkg2']
+        (mirpath, pkgsize, pkghash, tgtpath) = self.mkDownload('pkg2')
+        with open(tgtpath + PMbuilder.PartialSuffix, 'wb') as fp:
+            fp.write(payload)
+        (outcome, errmsg) = self.builder._downloadSingle(mirpath, pkgsize,
+                                                         pkghash, tgtpath)
+        self.assertEqual(outcome, PMbuilder.DL_Success)
+        self.assertTrue(os.path.isfile(tgtpath))
+
+    def testCorruptTarget(self):
+        """Check that a corrupt local copy is replaced from the mirror,
+        rather than being reported as a fault of the mirror"""
+        (relpath, payload) = self.mirror.packages['pkg1']
+        (mirpath, pkgsize, pkghash, tgtpath) = self.mkDownload('pkg1')
+        fetcher = AsyncDownloader(self.builder)
+        def asyncDownload(*args):
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(fetcher._download(*args))
+            finally:
+                fetcher._closeIdle()
+                loop.close()
+
+        for download in (self.builder._downloadSingle, asyncDownload):
+            with open(tgtpath, 'wb') as fp:
+                fp.write(bytes(pkgsize))
+            (outcome, errmsg) = download(mirpath, pkgsize, pkghash, tgtpath)
+            self.assertEqual(outcome, PMbuilder.DL_Success)
+            with open(tgtpath, 'rb') as fp:
+                self.assertEqual(fp.read(), payload)
+
+    def testCorruptPart(self):
+        (mirpath, pkgsize, pkghash, tgtpath) = self.mkDownload('pkg3')
+        partpath = tgtpath + PMbuilder.PartialSuffix
+        with open(partpath, 'wb') as fp:
+            fp.write(b'garbage')
+        (outcome, errmsg) = self.builder._downloadSingle(mirpath, pkgsize,
+                                                         pkghash, tgtpath)
+        self.assertEqual(outcome, PMbuilder.DL_HashError)
+        self.assertFalse(os.path.exists(partpath))
+
+        (outcome, errmsg) = self.builder._downloadSingle(mirpath, pkgsize,
+                                                         pkghash, tgtpath)
+        self.assertEqual(outcome, PMbuilder.DL_Success)
+
+
+
+class testSegmentation(unittest.TestCase):
+    """Tests of parallel downloading of large files as byte-ranges"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = LocalMirror(npkgs=1)
+        self.mirror.rate = 1 << 22
+        self.builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                                 Viewer=SilentBuildViewer(),
+                                 SegmentThreshold=(1 << 20),
+                                 DownloadSegments=4)
+        self.mirror.configure(self.builder, self._tmpdir.name)
+
+        self.payload = os.urandom(3 << 20)
+        self.pkghash = hashlib.sha512(self.payload).hexdigest()
+        with open(os.path.join(self.mirror.topdir, 'large.tar.xz'),
+                  'wb') as fp:
+            fp.write(self.payload)
+        self.mirpath = self.mirror.url + 'large.tar.xz'
+
+    def tearDown(self):
+        self.mirror.close()
+        self._tmpdir.cleanup()
+
+    def download(self, tgtname, segments):
+        self.builder.SetOption('DownloadSegments', segments)
+        tgtpath = os.path.join(self._tmpdir.name, tgtname)
+        (outcome, errmsg) = self.builder._downloadSingle(self.mirpath,
+                                    len(self.payload), self.pkghash, tgtpath)
+
+        self.assertEqual(outcome, PMbuilder.DL_Success, msg=errmsg)
+        with open(tgtpath, 'rb') as fp:
+            self.assertEqual(fp.read(), self.payload)
+
+    def testRanges(self):
+        """Check that segmented downloads cover the file in disjoint ranges"""
+        self.download('serial.tar.xz', 1)
+        self.assertEqual(self.mirror.ranges, [])
+
+        self.download('segmented.tar.xz', 4)
+        self.assertEqual(len(self.mirror.ranges), 4)
+        spans = sorted((start, end)
+                        for (path, start, end) in self.mirror.ranges)
+        self.assertEqual(spans[0][0], 0)
+        self.assertEqual(spans[-1][1], len(self.payload))
+        for (prev, nxt) in zip(spans, spans[1:]):
+            self.assertEqual(prev[1], nxt[0])
+
+    def testAsyncEngine(self):
+        """Check that the asyncio engine also segments large packages"""
+        self.builder.SetOption('Engine', 'asyncio')
+        self.builder.SetOption('DownloadWorkers', 2)
+        downloads = [ ('large.tar.xz', len(self.payload), self.pkghash) ]
+        self.builder._garbage.IndexCurrentFiles(self._tmpdir.name)
+        augdownloads = self.builder._preparePaths(downloads)
+        self.builder._fetchStats = FetchStats(downloads)
+
+        self.builder._fetchAll(self.builder._makeRetryScheduler(augdownloads))
+        self.assertEqual(self.builder._fetchStats.Counts()['New'], 1)
+        self.assertEqual(len(self.mirror.ranges), 4)
+        with open(augdownloads[0][3], 'rb') as fp:
+            self.assertEqual(fp.read(), self.payload)
+
+    def testSegmentFailure(self):
+        """Check that failure of first segment leaves resumable prefix"""
+        self.mirror.rate = None
+        self.mirror.faults['large.tar.xz'] = 1000
+        tgtpath = os.path.join(self._tmpdir.name, 'retry.tar.xz')
+        partpath = tgtpath + PMbuilder.PartialSuffix
+
+        (outcome, errmsg) = self.builder._downloadSingle(self.mirpath,
+                                    len(self.payload), self.pkghash, tgtpath)
+        self.assertNotEqual(outcome, PMbuilder.DL_Success)
+        self.assertEqual(os.path.getsize(partpath), 1000)
+
+        self.mirror.ranges = []
+        self.download('retry.tar.xz', 4)
+        self.assertEqual(min(start for (path, start, end)
+                                    in self.mirror.ranges), 1000)
+        self.assertEqual(sum(end - start
+                                for (path, start, end) in self.mirror.ranges),
+                         len(self.payload) - 1000)
+
+
+    @unittest.skipUnless(os.name == 'posix', 'requires POSIX signals')
+    def testInterrupted(self):
+        """Check that Ctrl-C leaves a resumable prefix, not a file
+        preallocated to the full size of the package"""
+        self.mirror.rate = 1 << 20
+        tgtpath = os.path.join(self._tmpdir.name, 'interrupted.tar.xz')
+        partpath = tgtpath + PMbuilder.PartialSuffix
+
+        timer = threading.Timer(0.3, os.kill, (os.getpid(), signal.SIGINT))
+        timer.start()
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                self.builder._downloadSingle(self.mirpath, len(self.payload),
+                                             self.pkghash, tgtpath)
+        finally:
+            timer.cancel()
+        prefix = os.path.getsize(partpath)
+        self.assertLess(prefix, len(self.payload))
+        self.assertFalse(os.path.exists(partpath + PMbuilder.SegmentSuffix))
+
+        self.mirror.rate = None
+        self.mirror.ranges = []
+        self.download('interrupted.tar.xz', 4)
+        self.assertEqual(min(start for (path, start, end)
+                                    in self.mirror.ranges), prefix)
+
+    def testKilled(self):
+        """Check recovery from a segmented download which was killed
+        while its ".part" file was preallocated"""
+        tgtpath = os.path.join(self._tmpdir.name, 'killed.tar.xz')
+        partpath = tgtpath + PMbuilder.PartialSuffix
+        with open(partpath, 'wb') as fp:
+            fp.write(self.payload[:5000])
+            fp.truncate(len(self.payload))
+        with open(partpath + PMbuilder.SegmentSuffix, 'wt') as fp:
+            fp.write('5000\n')
+
+        self.mirror.rate = None
+        self.download('killed.tar.xz', 4)
+        self.assertEqual(min(start for (path, start, end)
+                                    in self.mirror.ranges), 5000)
+        self.assertFalse(os.path.exists(partpath + PMbuilder.SegmentSuffix))
+
+
+
+class testStreamHashing(unittest.TestCase):
+    """Tests that downloads are hashed without re-reading from disk"""
+    class _checker(HashChecker):
+        def __init__(self):
+            self.fileReads = 0
+
+        def __call__(self, *args, **kwargs):
+            self.fileReads += 1
+            return HashChecker.__call__(self, *args, **kwargs)
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = LocalMirror(npkgs=6)
+        self.builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                                 Viewer=SilentBuildViewer())
+        self.mirror.configure(self.builder, self._tmpdir.name)
+        self.builder._hashCheck = testStreamHashing._checker()
+
+    def tearDown(self):
+        self.mirror.close()
+        self._tmpdir.cleanup()
+
+    def testSinglePass(self):
+        pkgset = PackageSet()
+        pkgset.extend(self.mirror.packages.keys())
+        self.builder.BuildMirror(pkgset)
+        self.assertEqual(self.builder._fetchStats.Counts()['New'], 6)
+        self.assertEqual(self.builder._hashCheck.fileReads, 0)
+
+        self.builder.BuildMirror(pkgset)
+        self.assertEqual(self.builder._fetchStats.Counts()['Already'], 6)
+        self.assertEqual(self.builder._hashCheck.fileReads, 6)
+
+    def testDigest(self):
+        pool = ConnectionPool()
+        (relpath, payload) = self.mirror.packages['pkg0']
+        tgtpath = os.path.join(self._tmpdir.name, 'pkg0')
+        for algo in [ 'md5', 'sha512' ]:
+            digest = hashlib.new(algo)
+            pool.retrieve(self.mirror.url + relpath, tgtpath, digest=digest)
+            self.assertEqual(digest.hexdigest(),
+                             hashlib.new(algo, payload).hexdigest())
+        pool.close()
+
+
+
+class testMirrorStriping(unittest.TestCase):
+    """Tests of downloading spread across several local mirrors"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.primary = LocalMirror(npkgs=40, maxsize=1<<12)
+        self.slow = LocalMirror(delay=0.3, source=self.primary)
+        self.builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                                 Viewer=SilentBuildViewer(),
+                                 DownloadWorkers=4,
+                                 ExtraMirrors=[ self.slow.url ])
+        self.primary.configure(self.builder, self._tmpdir.name)
+        self.pkgset = PackageSet()
+        self.pkgset.extend(self.primary.packages.keys())
+
+    def tearDown(self):
+        self.slow.close()
+        self.primary.close()
+        self._tmpdir.cleanup()
+
+    def testWeighting(self):
+        for engine in [ 'threads', 'asyncio' ]:
+            with tempfile.TemporaryDirectory() as tgtdir:
+                self.builder.SetTargetDir(tgtdir)
+                self.builder.SetOption('Engine', engine)
+                (self.primary.requests, self.slow.requests) = (0, 0)
+                self.builder.BuildMirror(self.pkgset)
+
+                counts = self.builder._fetchStats.Counts()
+                self.assertEqual(counts['New'], len(self.primary.packages))
+                self.assertGreater(self.slow.requests, 0)
+                self.assertGreater(self.primary.requests,
+                                   2 * self.slow.requests)
+
+                usage = self.builder._striper.Usage()
+                self.assertEqual([ m for (m, b, r) in usage ],
+                                 [ self.primary.url, self.slow.url ])
+                self.assertGreater(usage[0][2], usage[1][2])
+
+    def testSelection(self):
+        self.builder.SetOption('ExtraMirrors', [ self.slow.url.rstrip('/'),
+                                                 self.primary.url ])
+        self.assertEqual(self.builder._selectMirrors(),
+                         [ self.primary.url, self.slow.url ])
+
+        striper = MirrorStriper([ 'http://a/', 'http://b/' ])
+        self.assertEqual(striper.Acquire(1000), 'http://a/')
+        self.assertEqual(striper.Acquire(1000), 'http://b/')
+        striper.Release('http://a/', 1000, 0.001)
+        self.assertEqual(striper.Acquire(1000), 'http://a/')
+
+    def testPrimaryChange(self):
+        """Check that choosing a new primary mirror retains
+        the other stripes and the health of each mirror"""
+        self.builder.BuildMirror(self.pkgset)
+        striper = self.builder._striper
+        striper.Release(self.slow.url, 0, 0.1, False)
+        health = dict((m, (nok, nfail))
+                        for (m, nok, nfail, s) in striper.Health())
+
+        self.builder.mirror_url = 'http://127.0.0.1:1/pub/cygwin'
+        self.assertIs(self.builder._striper, striper)
+        self.assertEqual(striper.Mirrors(),
+                         [ 'http://127.0.0.1:1/pub/cygwin/', self.slow.url ])
+        revised = dict((m, (nok, nfail))
+                        for (m, nok, nfail, s) in striper.Health())
+        self.assertEqual(revised[self.primary.url], health[self.primary.url])
+        self.assertEqual(revised[self.slow.url], health[self.slow.url])
+        self.assertEqual(revised[self.slow.url][1], 1)
+
+
+
+class testMirrorFailover(unittest.TestCase):
+    """Tests of moving downloads away from failing mirror sites"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testFailover(self):
+        striper = MirrorStriper(['a/', 'b/'], failover=2)
+        for idx in range(2):
+            self.assertEqual(striper.Acquire(10, 'pkg'), 'a/')
+            striper.Release('a/', 10, 0.1, False, key='pkg')
+        self.assertEqual(striper.Acquire(10, 'pkg'), 'b/')
+        striper.Release('b/', 10, 0.1, True, key='pkg')
+        self.assertEqual(striper.Acquire(10, 'other'), 'a/')
+
+        striper.Release('a/', 10, 0.1, False, key='other', permanent=True)
+        self.assertEqual(striper.Acquire(10, 'other'), 'b/')
+
+    def testStandby(self):
+        striper = MirrorStriper(['a/'], fallbacks=lambda: ['a/', 'c/', 'd/'],
+                                failover=1)
+        self.assertEqual(striper.Acquire(10, 'pkg'), 'a/')
+        striper.Release('a/', 10, 0.1, False, key='pkg')
+        self.assertEqual(striper.Acquire(10, 'pkg'), 'c/')
+        striper.Release('c/', 10, 0.1, False, key='pkg')
+        self.assertEqual(striper.Acquire(10, 'pkg'), 'd/')
+        self.assertEqual(striper.Mirrors(), ['a/'])
+
+    def testStandbyUnlocked(self):
+        """Check that other downloads can proceed while standby mirrors
+        are being found"""
+        probing = threading.Event()
+        proceed = threading.Event()
+        def fallbacks():
+            probing.set()
+            proceed.wait(10)
+            return ['b/']
+        striper = MirrorStriper(['a/'], fallbacks=fallbacks, failover=1)
+        self.assertEqual(striper.Acquire(10, 'pkg'), 'a/')
+        striper.Release('a/', 10, 0.1, False, key='pkg')
+
+        chosen = []
+        thread = threading.Thread(
+                    target=lambda: chosen.append(striper.Acquire(10, 'pkg')))
+        thread.start()
+        self.assertTrue(probing.wait(10))
+        self.assertEqual(striper.Acquire(10, 'other'), 'a/')
+        striper.Release('a/', 10, 0.1, True, key='other')
+        proceed.set()
+        thread.join(10)
+        self.assertEqual(chosen, ['b/'])
+
+    def testCircuitBreaker(self):
+        striper = MirrorStriper(['a/', 'b/'], errorThreshold=0.5)
+        tripped = [ striper.Release('a/', 10, 0.1, False)
+                        for idx in range(MirrorStriper.BreakerMinimum) ]
+        self.assertEqual(tripped, [False] * (len(tripped) - 1) + [True])
+        self.assertTrue(all(striper.Acquire(1 << 30) == 'b/'
+                                for idx in range(4)))
+        self.assertEqual([ (m, s) for (m, nok, nfail, s) in striper.Health() ],
+                         [ ('a/', True), ('b/', False) ])
+
+        # Successful trial download after cool-down should restore mirror:
+        striper.BreakerCooldown = 0.0
+        self.assertEqual(striper.Acquire(0), 'a/')
+        striper.Release('a/', 0, 0.1, True)
+        self.assertEqual(striper.Health()[0], ('a/', 1, 4, False))
+
+    def testHalfSynced(self):
+        primary = LocalMirror(npkgs=6)
+        standby = LocalMirror(source=primary)
+        try:
+            builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                                Viewer=SilentBuildViewer(), RetryDelay=0.1)
+            primary.configure(builder, self._tmpdir.name)
+            builder._mirrordict = {
+                'Local': { 'Loopback': [ ('primary', primary.url),
+                                         ('standby', standby.url) ] } }
+            (relpath, payload) = primary.packages['pkg2']
+            primary.missing.add(relpath)
+
+            pkgset = PackageSet()
+            pkgset.extend(primary.packages.keys())
+            builder.BuildMirror(pkgset)
+            self.assertEqual(builder._fetchStats.Counts()['Fail'], 0)
+            with open(os.path.join(self._tmpdir.name, relpath), 'rb') as fp:
+                self.assertEqual(fp.read(), payload)
+            self.assertEqual(standby.requests, 1)
+            self.assertEqual(builder._striper.Health(),
+                             [ (primary.url, 5, 1, False),
+                               (standby.url, 1, 0, False) ])
+        finally:
+            standby.close()
+            primary.close()
+
+
+
+class testAsyncDownloading(unittest.TestCase):
+    """Tests of asyncio download engine against a high-latency local mirror"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = LocalMirror(npkgs=40, maxsize=1<<12, delay=0.2)
+        self.builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                                 Viewer=SilentBuildViewer(),
+                                 Engine='asyncio', DownloadWorkers=40)
+        self.mirror.configure(self.builder, self._tmpdir.name)
+        self.pkgset = PackageSet()
+        self.pkgset.extend(self.mirror.packages.keys())
+
+    def tearDown(self):
+        self.mirror.close()
+        self._tmpdir.cleanup()
+
+    def testLatency(self):
+        t0 = time.time()
+        self.builder.BuildMirror(self.pkgset)
+        elapsed = time.time() - t0
+
+        counts = self.builder._fetchStats.Counts()
+        self.assertEqual(counts['New'], len(self.mirror.packages))
+        for (relpath, payload) in self.mirror.packages.values():
+            with open(os.path.join(self._tmpdir.name, relpath), 'rb') as fp:
+                self.assertEqual(fp.read(), payload)
+
+        # Serial downloading would take 40 * 0.2s:
+        self.assertLess(elapsed, 3.0)
+
+    def testCancellation(self):
+        self.mirror.delay = 1.0
+        self.builder.SetOption('DownloadWorkers', 4)
+        timer = threading.Timer(1.5, self.builder.Cancel)
+        timer.start()
+        t0 = time.time()
+        self.builder.BuildMirror(self.pkgset)
+        timer.join()
+
+        self.assertLess(time.time() - t0, 5.0)
+        counts = self.builder._fetchStats.Counts()
+        self.assertLess(counts['New'], len(self.mirror.packages))
+        self.assertEqual(counts['Fail'], 0)
+
+    def testCorruption(self):
+        (relpath, payload) = self.mirror.packages['pkg3']
+        with open(os.path.join(self.mirror.topdir, relpath), 'ab') as fp:
+            fp.write(b'extra')
+        downloads = [ (relpath, len(payload),
+                       hashlib.sha512(payload).hexdigest()) ]
+        self.builder._garbage.IndexCurrentFiles(self._tmpdir.name)
+        augdownloads = self.builder._preparePaths(downloads)
+        self.builder._fetchStats = FetchStats(downloads)
+
+        scheduler = RetryScheduler(augdownloads, maxRetries=1, baseDelay=0.05)
+        fetcher = AsyncDownloader(self.builder)
+        fetcher.FetchAll(scheduler)
+        self.assertEqual(scheduler.Attempts(augdownloads[0]), 2)
+        self.assertEqual(self.builder._fetchStats.Counts()['Fail'], 1)
+        self.assertFalse(os.path.exists(augdownloads[0][3]))
+
+    def testHeaderTimeout(self):
+        """Check that connections are closed if the mirror stalls"""
+        class RecordingDownloader(AsyncDownloader):
+            writers = []
+            async def _acquire(self, key, parts):
+                (reader, writer, reused) = \
+                        await AsyncDownloader._acquire(self, key, parts)
+                self.writers.append(writer)
+                return (reader, writer, reused)
+
+        self.mirror.delay = 1.0
+        (relpath, payload) = self.mirror.packages['pkg4']
+        downloads = [ (relpath, len(payload),
+                       hashlib.sha512(payload).hexdigest()) ]
+        self.builder._garbage.IndexCurrentFiles(self._tmpdir.name)
+        augdownloads = self.builder._preparePaths(downloads)
+        self.builder._fetchStats = FetchStats(downloads)
+
+        scheduler = RetryScheduler(augdownloads, maxRetries=1, baseDelay=0.05)
+        fetcher = RecordingDownloader(self.builder, timeout=0.2)
+        fetcher.FetchAll(scheduler)
+        self.assertEqual(scheduler.FailureCounts(),
+                         { PMbuilder.DL_Timeout: 2 })
+        self.assertEqual(len(fetcher.writers), 2)
+        self.assertTrue(all(writer.transport.is_closing()
+                                for writer in fetcher.writers))
+
+    def testOffloading(self):
+        """Check that hashing of existing files avoids the event-loop"""
+        self.builder.BuildMirror(self.pkgset)
+
+        threads = []
+        hashCheck = self.builder._hashCheck
+        def recordThread(*args):
+            threads.append(threading.current_thread())
+            return hashCheck(*args)
+        self.builder._hashCheck = recordThread
+        self.builder.BuildMirror(self.pkgset)
+
+        counts = self.builder._fetchStats.Counts()
+        self.assertEqual(counts['Fail'], 0)
+        self.assertEqual(counts['New'], 0)
+        self.assertGreaterEqual(len(threads), len(self.mirror.packages))
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+
+class testMirrorRanking(unittest.TestCase):
+    """Tests of automatic selection of the fastest mirror site"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.slow = LocalMirror(npkgs=6, delay=0.4)
+        self.fast = LocalMirror(source=self.slow)
+        self.medium = LocalMirror(source=self.slow, delay=0.2)
+        self.mirrors = [ self.slow, self.fast, self.medium ]
+
+        self.builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                                 Viewer=SilentBuildViewer())
+        self.slow.configure(self.builder, self._tmpdir.name)
+        self.builder._mirrordict = {
+            'Local': { 'Loopback': [ ('m{0:d}'.format(idx), mirror.url)
+                                        for (idx, mirror)
+                                            in enumerate(self.mirrors) ] } }
+
+    def tearDown(self):
+        for mirror in reversed(self.mirrors):
+            mirror.close()
+        self._tmpdir.cleanup()
+
+    def testRanking(self):
+        unreachable = 'http://127.0.0.1:1/'
+        ranking = self.builder.RankMirrors(
+                        candidates=[ m.url for m in self.mirrors ]
+                                    + [ unreachable ])
+        self.assertEqual([ URL for (URL, ttfb, rate) in ranking ],
+                         [ self.fast.url, self.medium.url, self.slow.url ])
+        (URL, ttfb, rate) = ranking[-1]
+        self.assertGreaterEqual(ttfb, 0.4)
+
+        # Repeated ranking should use cached results:
+        nrequests = [ m.requests for m in self.mirrors ]
+        self.assertEqual(self.builder.RankMirrors()[0][0], self.fast.url)
+        self.assertEqual([ m.requests for m in self.mirrors ], nrequests)
+        self.builder.RankMirrors(reload=True)
+        self.assertTrue(all(m.requests > n for (m, n)
+                                in zip(self.mirrors, nrequests)))
+
+    def testPersistence(self):
+        self.builder._enableCache()
+        candidates = [ m.url for m in self.mirrors ]
+        ranking = self.builder.RankMirrors(candidates=candidates)
+
+        # A later run sharing the build directory should reuse the probes:
+        nrequests = [ m.requests for m in self.mirrors ]
+        builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                            Viewer=SilentBuildViewer())
+        self.assertEqual(builder.RankMirrors(candidates=candidates), ranking)
+        self.assertEqual([ m.requests for m in self.mirrors ], nrequests)
+
+        # ...unless those probes have expired:
+        builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                            Viewer=SilentBuildViewer(),
+                            MirrorProbeLifetime=0)
+        builder.RankMirrors(candidates=candidates)
+        self.assertTrue(all(m.requests > n for (m, n)
+                                in zip(self.mirrors, nrequests)))
+
+    def testStaleness(self):
+        stale = LocalMirror(npkgs=2)
+        self.mirrors.append(stale)
+        xzpath = os.path.join(stale.topdir, stale.arch, 'setup.xz')
+        oldtime = time.time() - 30 * 86400
+        os.utime(xzpath, (oldtime, oldtime))
+
+        ranking = self.builder.RankMirrors(
+                        candidates=[ stale.url, self.medium.url ])
+        self.assertEqual([ URL for (URL, ttfb, rate) in ranking ],
+                         [ self.medium.url ])
+
+    def testAutoMirror(self):
+        self.builder.SetOption('AutoMirror', True)
+        self.builder.setup_ini_url = None
+        pkgset = PackageSet()
+        pkgset.extend(self.slow.packages.keys())
+        nrequests = self.slow.requests
+        self.builder.BuildMirror(pkgset)
+
+        self.assertEqual(self.builder.mirror_url, self.fast.url)
+        self.assertEqual(self.builder._fetchStats.Counts()['Fail'], 0)
+        self.assertGreater(self.fast.requests,
+                           len(self.slow.packages) + 1)
+        # The slow mirror should only have been probed,
+        # beyond supplying the installer at its configured URL:
+        self.assertEqual(self.slow.requests, nrequests + 2)
+
+
+
+class testRetryScheduling(unittest.TestCase):
+    """Tests of per-download retries with exponential backoff"""
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = LocalMirror(npkgs=8)
+
+    def tearDown(self):
+        self.mirror.close()
+        self._tmpdir.cleanup()
+
+    def mkBuilder(self, **kwargs):
+        builder = PMbuilder(BuildDirectory=self._tmpdir.name,
+                            Viewer=SilentBuildViewer(), **kwargs)
+        self.mirror.configure(builder, self._tmpdir.name)
+        builder.SetOption('RetryDelay', 0.2)
+        return builder
+
+    def testBackoff(self):
+        scheduler = RetryScheduler(['a', 'b'], maxRetries=3,
+                                   baseDelay=1.0, maxDelay=3.0,
+                                   retryLimits={ PMbuilder.DL_NotFound: 1 })
+        self.assertEqual(scheduler.Next(), 'a')
+        for limit in (1.0, 2.0, 3.0):
+            delay = scheduler.Failed('a', PMbuilder.DL_Timeout)
+            self.assertTrue(0.5 * limit <= delay <= limit)
+        self.assertIsNone(scheduler.Failed('a', PMbuilder.DL_Timeout))
+
+        self.assertEqual(scheduler.Next(), 'b')
+        self.assertIsNotNone(scheduler.Failed('b', PMbuilder.DL_NotFound))
+        self.assertIsNone(scheduler.Failed('b', PMbuilder.DL_NotFound))
+        self.assertEqual(scheduler.FailureCounts(),
+                         { PMbuilder.DL_Timeout: 4, PMbuilder.DL_NotFound: 2 })
+
+    def testOverlap(self):
+        """Check that other downloads proceed while a failure waits"""
+        builder = self.mkBuilder()
+        (relpath, payload) = self.mirror.packages['pkg0']
+        self.mirror.faults[relpath] = len(payload) // 2
+        fetched = []
+        def download(mirpath, *args, _original=builder._downloadSingle):
+            fetched.append(os.path.basename(mirpath))
+            return _original(mirpath, *args)
+        builder._downloadSingle = download
+
+        pkgset = PackageSet()
+        pkgset.extend(self.mirror.packages.keys())
+        builder.BuildMirror(pkgset)
+        self.assertEqual(builder._fetchStats.Counts()['Fail'], 0)
+        with open(os.path.join(self._tmpdir.name, relpath), 'rb') as fp:
+            self.assertEqual(fp.read(), payload)
+        self.assertEqual(len(fetched), len(self.mirror.packages) + 1)
+        self.assertEqual(fetched[0], os.path.basename(relpath))
+        self.assertEqual(fetched[-1], os.path.basename(relpath))
+
+    def testAsyncRetry(self):
+        builder = self.mkBuilder(Engine='asyncio', DownloadWorkers=4)
+        (relpath, payload) = self.mirror.packages['pkg2']
+        self.mirror.faults[relpath] = len(payload) // 2
+
+        pkgset = PackageSet()
+        pkgset.extend(self.mirror.packages.keys())
+        builder.BuildMirror(pkgset)
+        self.assertEqual(builder._fetchStats.Counts()['Fail'], 0)
+        with open(os.path.join(self._tmpdir.name, relpath), 'rb') as fp:
+            self.assertEqual(fp.read(), payload)
+
+    def testUnexpectedError(self):
+        """Check that an exception outside a download attempt
+        is reported, rather than leaving other workers waiting"""
+        for engine in ('threads', 'asyncio'):
+            builder = self.mkBuilder(Engine=engine, DownloadWorkers=4,
+                                     MaxRetries=0)
+            (relpath, payload) = self.mirror.packages['pkg3']
+            def release(mirror, DLsummary, *args,
+                        _original=builder._releaseMirror):
+                if DLsummary[0] == relpath:
+                    raise OSError('Simulated failure')
+                return _original(mirror, DLsummary, *args)
+            builder._releaseMirror = release
+
+            pkgset = PackageSet()
+            pkgset.extend(self.mirror.packages.keys())
+            errors = []
+            def build():
+                try:
+                    builder.BuildMirror(pkgset)
+                except OSError as ex:
+                    errors.append(ex)
+            thread = threading.Thread(target=build, daemon=True)
+            thread.start()
+            thread.join(30)
+            self.assertFalse(thread.is_alive(), msg=engine)
+            self.assertEqual([ str(ex) for ex in errors ],
+                             [ 'Simulated failure' ], msg=engine)
+
+    def testNotFound(self):
+        builder = self.mkBuilder(MaxRetries=4)
+        (relpath, payload) = self.mirror.packages['pkg1']
+        os.remove(os.path.join(self.mirror.topdir, relpath))
+        downloads = [ (relpath, len(payload),
+                       hashlib.sha512(payload).hexdigest()) ]
+        builder._garbage.IndexCurrentFiles(self._tmpdir.name)
+        augdownloads = builder._preparePaths(downloads)
+        builder._fetchStats = FetchStats(downloads)
+
+        scheduler = builder._makeRetryScheduler(augdownloads)
+        builder._fetchAll(scheduler)
+        self.assertEqual(scheduler.FailureCounts(),
+                         { PMbuilder.DL_NotFound: 2 })
+        self.assertEqual(builder._fetchStats.Counts()['Fail'], 1)
+
+
+
 class testPackageSets(unittest.TestCase):
     def setUp(self):
         pass
@@ -494,9 +2978,9 @@ class testPackageLists(unittest.TestCase):
             url = urllib.parse.urljoin(self._urlprefix, cfg)
 
             with tempfile.TemporaryDirectory() as tmpdir:
-                builder = PMbuilder(Viewer=SilentBuildViewer())
+                builder = PMbuilder(BuildDirectory=tmpdir,
+                                    Viewer=SilentBuildViewer())
                 builder.setup_ini_url = url
-                builder.SetTargetDir(tmpdir)
 
                 if 'make' in builder._masterList.GetPackageDict():
                     deps = builder._resolveDependencies(['make'])